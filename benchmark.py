@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2010, Tim Weber
+# All rights reserved.
+
+# Licensed under the 3-clause BSD license.
+# Please see the file LICENSE that came with this software
+# for additional information.
+
+"""
+Microbenchmarks for wardrobe's configuration and command-line layer.
+
+Run this file to print the time per call of each benchmark, the memory used
+per BackupRun and the time it takes a new process to load a fleet's
+configuration and spawn its first subprocess. With --json, the results are
+written to stdout as a JSON object instead, to be compared between versions.
+"""
+
+import gc
+import optparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+	import json
+except ImportError:
+	import simplejson as json
+
+from wardrobe import *
+
+
+
+def measure(func, mintime=0.2):
+	"""
+	Call func repeatedly for at least mintime seconds and return the average
+	time per call in seconds.
+	"""
+	count = 1
+	while True:
+		start = time.time()
+		for i in xrange(count):
+			func()
+		elapsed = time.time() - start
+		if elapsed >= mintime:
+			return elapsed / count
+		count *= 2
+
+
+
+def chain(depth):
+	"""
+	Return the last of depth Defaultables, each defaulting to the previous
+	one, the first one holding a value.
+	"""
+	d = Defaultable(42)
+	for i in xrange(depth - 1):
+		d = Defaultable(d)
+	return d
+
+
+
+def bench_defaultable(depth):
+	"""Reading the value of a Defaultable at the end of a chain."""
+	d = chain(depth)
+	return lambda: d.value
+
+
+
+def bench_defaultable_invalidated(depth):
+	"""
+	Reading the value of a Defaultable at the end of a chain after the root's
+	value has been changed.
+	"""
+	d = chain(depth)
+	root = d
+	while root.parent is not None:
+		root = root.parent
+	def func():
+		root.value = 42
+		return d.value
+	return func
+
+
+
+def template():
+	"""
+	Return a BackupRun with some options and filters set, as a template for
+	a group of hosts would have.
+	"""
+	run = BackupRun()
+	run.acls = run.eas = False
+	run.preservenumericalids = True
+	run.verbosity = 5
+	run.remoteschema = 'ssh -C %s rdiff-backup --server'
+	run.filters.extend(Exclude('/proc/*'), Exclude('/sys/*'),
+	                   ExcludeDeviceFiles(), Include('/var/www'),
+	                   MaxFileSize(1000000))
+	return run
+
+
+
+def bench_backuprun_init(parent):
+	"""Creating a BackupRun, based on a template or not."""
+	if parent:
+		t = template()
+		return lambda: BackupRun(t)
+	return lambda: BackupRun()
+
+
+
+def bench_backuprun_cmdline(kind):
+	"""
+	Computing the command line of a host's BackupRun, created from a
+	template, a frozen template or by setting everything on the run itself.
+	"""
+	source = Source('/', 'web-01.example.com')
+	destination = Destination('/var/backup/data/web-01.example.com')
+	if kind == 'standalone':
+		run = template()
+		run.source = source
+		run.destination = destination
+	elif kind == 'child':
+		run = template().child(source, destination)
+	else:
+		run = template().freeze().child(source, destination)
+	return lambda: run.cmdline
+
+
+
+def bench_backuprun_override(depth):
+	"""
+	Computing the command line of a host's BackupRun overriding an option of
+	a chain of depth templates, so that no prefix can be reused.
+	"""
+	t = template()
+	for i in xrange(depth - 1):
+		t = BackupRun(t)
+	run = t.child(Source('/', 'web-01.example.com'),
+	              Destination('/var/backup/data/web-01.example.com'))
+	run.terminalverbosity = 3
+	return lambda: run.cmdline
+
+
+
+def nested(count):
+	"""
+	Return count Exclude filters in nested lists of at most ten items, as
+	accepted by FilterSet.extend().
+	"""
+	r = [Exclude('/srv/%d/*' % i) for i in xrange(count)]
+	while len(r) > 10:
+		r = [r[i:i + 10] for i in xrange(0, len(r), 10)]
+	return r
+
+
+
+def nestedset(items):
+	"""Return a FilterSet with a nested FilterSet for each nested list."""
+	r = FilterSet()
+	for item in items:
+		if isinstance(item, list):
+			r.extend(nestedset(item))
+		else:
+			r.extend(item)
+	return r
+
+
+
+def bench_filterset_params(count):
+	"""Computing the parameters of nested FilterSets of count filters."""
+	s = nestedset(nested(count))
+	return lambda: s.params
+
+
+
+def bench_filterset_extend(count):
+	"""Extending an empty FilterSet by nested lists of count filters."""
+	items = nested(count)
+	return lambda: FilterSet().extend(items)
+
+
+
+def bench_generate(hosts):
+	"""
+	Generating Source and Destination for each of a number of host names in
+	turn with PullCompleteHost.
+	"""
+	g = PullCompleteHost('/var/backup/data')
+	names = ['web-%d.example.com' % i for i in xrange(hosts)]
+	state = {'index': 0}
+	def func():
+		i = state['index']
+		state['index'] = (i + 1) % hosts
+		return g.generate(names[i])
+	return func
+
+
+
+benchmarks = []
+for depth in (1, 2, 5, 10, 20):
+	benchmarks.append(('defaultable.value', {'depth': depth},
+	                   bench_defaultable, (depth,)))
+	benchmarks.append(('defaultable.value invalidated', {'depth': depth},
+	                   bench_defaultable_invalidated, (depth,)))
+for parent in (False, True):
+	benchmarks.append(('backuprun.init', {'parent': parent},
+	                   bench_backuprun_init, (parent,)))
+for kind in ('standalone', 'child', 'frozen'):
+	benchmarks.append(('backuprun.cmdline', {'template': kind},
+	                   bench_backuprun_cmdline, (kind,)))
+for depth in (1, 10, 50):
+	benchmarks.append(('backuprun.cmdline override', {'depth': depth},
+	                   bench_backuprun_override, (depth,)))
+for count in (10, 100, 1000, 10000):
+	benchmarks.append(('filterset.params', {'filters': count},
+	                   bench_filterset_params, (count,)))
+	benchmarks.append(('filterset.extend', {'filters': count},
+	                   bench_filterset_extend, (count,)))
+for hosts in (1, 1000):
+	benchmarks.append(('pullcompletehost.generate', {'hosts': hosts},
+	                   bench_generate, (hosts,)))
+
+
+
+def rss():
+	"""
+	Return the resident set size of this process in bytes, or None if it
+	cannot be determined.
+	"""
+	try:
+		f = open('/proc/self/statm')
+		try:
+			return int(f.read().split()[1]) * resource.getpagesize()
+		finally:
+			f.close()
+	except (IOError, IndexError, ValueError):
+		return None
+
+
+
+def memory(factory, count=20000):
+	"""
+	Return the number of bytes the memory of this process grows by per
+	object when keeping count objects created by factory, or None if it
+	cannot be determined.
+	"""
+	gc.collect()
+	before = rss()
+	objects = [factory() for i in xrange(count)]
+	after = rss()
+	if before is None or after is None:
+		return None
+	del objects
+	return float(after - before) / count
+
+
+
+def memories():
+	"""
+	Return a list of (name, params, bytes) tuples describing the memory used
+	per BackupRun.
+	"""
+	t = template()
+	frozen = t.freeze()
+	source = Source('/', 'web-01.example.com')
+	destination = Destination('/var/backup/data/web-01.example.com')
+	return [
+		('backuprun.memory', {'parent': False}, memory(BackupRun)),
+		('backuprun.memory', {'parent': True}, memory(lambda: BackupRun(t))),
+		('backuprun.memory', {'parent': 'frozen'},
+		 memory(lambda: frozen.child(source, destination))),
+		]
+
+
+
+def fleet(directory, templates, hosts):
+	"""
+	Write the JSON configuration of a fleet with the given numbers of
+	templates, each with a filter set of its own, and hosts, spread evenly
+	over the templates, into directory and return its path.
+	"""
+	config = {
+		'filters': {'base': ['exclude /proc/*', 'exclude /sys/*',
+		                     'exclude-device-files']},
+		'templates': {'base': {'filters': 'base', 'acls': False,
+		                       'verbosity': 5}},
+		'generators': {'pull': {'basedir': '/var/backup/data'}},
+		'groups': {},
+		}
+	for i in xrange(templates):
+		config['filters']['f%d' % i] = ['exclude /srv/%d/%d' % (i, j)
+		                                for j in xrange(20)]
+		config['templates']['t%d' % i] = {'parent': 'base',
+		                                  'filters': ['f%d' % i]}
+		config['groups']['g%d' % i] = {'template': 't%d' % i,
+		                               'generator': 'pull', 'hosts': [
+			'h%d-%d.example.com' % (i, j) for j in xrange(hosts // templates)]}
+	path = os.path.join(directory, 'fleet.json')
+	f = open(path, 'w')
+	try:
+		json.dump(config, f)
+	finally:
+		f.close()
+	return path
+
+
+
+# Run in a new process: load the configuration, queue all hosts and spawn a
+# subprocess for the first one, then print the time.
+startupscript = '''
+import subprocess, sys, time
+from wardrobe import *
+config = Config(sys.argv[1], sys.argv[2])
+jobs = config.addto(BackupQueue())
+jobs[0].run.cmdline
+subprocess.Popen(['true']).wait()
+print repr(time.time())
+'''
+
+
+
+def startup(path, cached, repeat=5):
+	"""
+	Return the shortest time in seconds from starting a new Python process
+	to it spawning the first subprocess for the fleet configured at path,
+	with or without an up to date cache.
+	"""
+	cache = path + '.cache'
+	directory = os.path.dirname(os.path.abspath(__file__))
+	best = None
+	for i in xrange(repeat):
+		if cached:
+			Config(path, cache)
+		elif os.path.exists(cache):
+			os.remove(cache)
+		start = time.time()
+		p = subprocess.Popen([sys.executable, '-c', startupscript, path,
+		                      cache], stdout=subprocess.PIPE, cwd=directory)
+		output = p.communicate()[0]
+		if p.returncode:
+			raise RuntimeError('startup benchmark failed')
+		elapsed = float(output) - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+
+
+def startups():
+	"""
+	Return a list of (name, params, seconds) tuples describing the startup
+	time of fleets of several sizes, with and without a cache.
+	"""
+	r = []
+	directory = tempfile.mkdtemp()
+	try:
+		for (templates, hosts) in ((10, 100), (300, 1000), (300, 10000)):
+			path = fleet(directory, templates, hosts)
+			for cached in (False, True):
+				r.append(('startup', {'templates': templates, 'hosts': hosts,
+				                      'cached': cached},
+				          startup(path, cached)))
+	finally:
+		shutil.rmtree(directory)
+	return r
+
+
+
+def label(name, params):
+	"""Return a benchmark's name followed by its sorted parameters."""
+	return ' '.join([name] + ['%s=%s' % (k, params[k]) for k in sorted(params)])
+
+
+
+def main(argv=None):
+	parser = optparse.OptionParser(usage='%prog [options]')
+	parser.add_option('--json', action='store_true',
+	                  help='write the results as JSON')
+	parser.add_option('--mintime', type='float', default=0.2,
+	                  metavar='SECONDS',
+	                  help='run each benchmark for at least SECONDS [%default]')
+	parser.add_option('--no-startup', dest='startup', action='store_false',
+	                  default=True, help='skip the startup benchmarks')
+	(options, args) = parser.parse_args(argv)
+	results = {'python': sys.version.split()[0], 'time': [], 'memory': [],
+	           'startup': []}
+	for (name, params, setup, args) in benchmarks:
+		t = measure(setup(*args), options.mintime)
+		results['time'].append({'name': name, 'params': params, 'seconds': t})
+		if not options.json:
+			sys.stdout.write('%-55s %10.3f us\n'
+			                 % (label(name, params), t * 1000000))
+	for (name, params, size) in memories():
+		results['memory'].append({'name': name, 'params': params,
+		                          'bytes': size})
+		if not options.json:
+			if size is None:
+				size = float('nan')
+			sys.stdout.write('%-55s %10.0f B\n' % (label(name, params), size))
+	if options.startup:
+		for (name, params, t) in startups():
+			results['startup'].append({'name': name, 'params': params,
+			                           'seconds': t})
+			if not options.json:
+				sys.stdout.write('%-55s %10.3f ms\n'
+				                 % (label(name, params), t * 1000))
+	if options.json:
+		json.dump(results, sys.stdout, indent=1, sort_keys=True)
+		sys.stdout.write('\n')
+
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2010, Tim Weber
+# All rights reserved.
+
+# Licensed under the 3-clause BSD license.
+# Please see the file LICENSE that came with this software
+# for additional information.
+
+"""
+A stand-in for rdiff-backup, for load testing without real hosts.
+
+It is run as "fakerdiff.py [options] -- RDIFF-BACKUP-ARGUMENTS" and pretends
+to back up the source to the destination, the last two arguments: it prints
+progress like rdiff-backup with a verbosity of 5, takes a random amount of
+time and, if it succeeds, writes a session_statistics file and a
+current_mirror marker into the destination's rdiff-backup-data directory.
+It can also be told to fail or to hang, optionally leaving behind a child
+that ignores SIGTERM and keeps the output open, like a stuck ssh. The
+destination has to be local.
+
+It does not import wardrobe, so that it starts quickly.
+"""
+
+import optparse
+import os
+import random
+import signal
+import sys
+import time
+
+
+
+def distribution(spec):
+	"""
+	Return a function returning random durations in seconds as described by
+	spec: "fixed:S", "uniform:MIN:MAX", "exponential:MEAN", "normal:MEAN:SD"
+	or "lognormal:MU:SIGMA". Negative durations are returned as 0.
+	"""
+	parts = spec.split(':')
+	try:
+		args = [float(p) for p in parts[1:]]
+	except ValueError:
+		raise ValueError('invalid duration %r' % spec)
+	functions = {
+		'fixed': (1, lambda rng, s: s),
+		'uniform': (2, lambda rng, a, b: rng.uniform(a, b)),
+		'exponential': (1, lambda rng, mean: rng.expovariate(1.0 / mean)),
+		'normal': (2, lambda rng, mean, sd: rng.normalvariate(mean, sd)),
+		'lognormal': (2, lambda rng, mu, sigma: rng.lognormvariate(mu, sigma)),
+		}
+	if parts[0] not in functions or len(args) != functions[parts[0]][0]:
+		raise ValueError('invalid duration %r' % spec)
+	function = functions[parts[0]][1]
+	return lambda rng: max(function(rng, *args), 0)
+
+
+
+def timestamp(t):
+	"""Return the rdiff-backup timestamp of t, in UTC."""
+	return time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(t))
+
+
+
+def size(value):
+	"""Return a size formatted like in a session_statistics file."""
+	for (unit, factor) in (('GB', 1 << 30), ('MB', 1 << 20), ('KB', 1 << 10)):
+		if value >= factor:
+			return '%d (%.2f %s)' % (value, float(value) / factor, unit)
+	return '%d (%d bytes)' % (value, value)
+
+
+
+def statistics(rng, start, end):
+	"""
+	Return the contents of a session_statistics file for a session from
+	start to end, with plausible random numbers.
+	"""
+	files = int(rng.lognormvariate(10, 1)) + 1
+	filesize = files * int(rng.lognormvariate(11, 1))
+	new = int(files * rng.uniform(0, 0.01))
+	deleted = int(files * rng.uniform(0, 0.01))
+	changed = int(files * rng.uniform(0, 0.05))
+	newsize = new * int(rng.lognormvariate(10, 1))
+	deletedsize = deleted * int(rng.lognormvariate(10, 1))
+	changedsize = changed * int(rng.lognormvariate(11, 1))
+	incrementsize = int((changedsize + deletedsize) * rng.uniform(0.05, 0.5))
+	lines = [
+		'StartTime %.2f (%s)' % (start, time.ctime(start)),
+		'EndTime %.2f (%s)' % (end, time.ctime(end)),
+		'ElapsedTime %.2f (%.2f seconds)' % (end - start, end - start),
+		'SourceFiles %d' % files,
+		'SourceFileSize %s' % size(filesize),
+		'MirrorFiles %d' % (files - new + deleted),
+		'MirrorFileSize %s' % size(filesize - newsize + deletedsize),
+		'NewFiles %d' % new,
+		'NewFileSize %s' % size(newsize),
+		'DeletedFiles %d' % deleted,
+		'DeletedFileSize %s' % size(deletedsize),
+		'ChangedFiles %d' % changed,
+		'ChangedSourceSize %s' % size(changedsize),
+		'ChangedMirrorSize %s' % size(changedsize),
+		'IncrementFiles %d' % (new + deleted + changed),
+		'IncrementFileSize %s' % size(incrementsize),
+		'TotalDestinationSizeChange %s' % size(newsize + incrementsize),
+		'Errors 0',
+		]
+	return ''.join(['%s\n' % l for l in lines])
+
+
+
+def finish(destination, rng, start):
+	"""
+	Write the session_statistics file and replace the current_mirror marker
+	in the destination, like a successful backup.
+	"""
+	datadir = os.path.join(destination, 'rdiff-backup-data')
+	if not os.path.isdir(datadir):
+		os.makedirs(datadir)
+	stamp = timestamp(start)
+	f = open(os.path.join(datadir, 'session_statistics.%s.data' % stamp), 'w')
+	try:
+		f.write(statistics(rng, start, time.time()))
+	finally:
+		f.close()
+	marker = 'current_mirror.%s.data' % stamp
+	f = open(os.path.join(datadir, marker), 'w')
+	try:
+		f.write('PID %d\n' % os.getpid())
+	finally:
+		f.close()
+	for name in os.listdir(datadir):
+		if name.startswith('current_mirror.') and name != marker:
+			os.remove(os.path.join(datadir, name))
+
+
+
+def main(argv=None):
+	parser = optparse.OptionParser(
+		usage='%prog [options] -- RDIFF-BACKUP-ARGUMENTS')
+	parser.add_option('--duration', default='fixed:1', metavar='DIST',
+	                  help='distribution of the duration in seconds, see '
+	                       'distribution() [%default]')
+	parser.add_option('--output', type='int', default=100, metavar='LINES',
+	                  help='number of files to report as processed [%default]')
+	parser.add_option('--fail', type='float', default=0, metavar='P',
+	                  help='probability of failing [%default]')
+	parser.add_option('--exitcode', type='int', default=1, metavar='CODE',
+	                  help='exit code when failing [%default]')
+	parser.add_option('--error', metavar='MESSAGE',
+	                  default='Fatal Error: Lost connection to the remote '
+	                          'system',
+	                  help='message to print to stderr when failing')
+	parser.add_option('--hang', type='float', default=0, metavar='P',
+	                  help='probability of hanging [%default]')
+	parser.add_option('--hangtime', type='float', default=86400,
+	                  metavar='SECONDS',
+	                  help='how long to hang [%default]')
+	parser.add_option('--stubborn', action='store_true',
+	                  help='when hanging, also hang in a child ignoring '
+	                       'SIGTERM')
+	parser.add_option('--seed', metavar='SEED',
+	                  help='seed making the behavior for each destination '
+	                       'reproducible')
+	(options, args) = parser.parse_args(argv)
+	if len(args) < 2:
+		parser.error('expected source and destination')
+	try:
+		duration = distribution(options.duration)
+	except ValueError, e:
+		parser.error(str(e))
+	(source, destination) = args[-2:]
+	start = time.time()
+	if options.seed is None:
+		rng = random.Random()
+	else:
+		rng = random.Random('%s %s' % (options.seed, destination))
+	seconds = duration(rng)
+	failing = rng.random() < options.fail
+	hanging = rng.random() < options.hang
+	out = sys.stdout
+	out.write('Starting increment operation %s to %s\n'
+	          % (source, destination))
+	out.flush()
+	if hanging:
+		if options.stubborn and os.fork() == 0:
+			signal.signal(signal.SIGTERM, signal.SIG_IGN)
+			time.sleep(options.hangtime)
+			os._exit(0)
+		time.sleep(options.hangtime)
+	# Spread the output over the duration in up to ten bursts.
+	bursts = max(min(options.output, 10), 1)
+	done = 0
+	for burst in xrange(bursts):
+		count = options.output * (burst + 1) // bursts - done
+		for i in xrange(count):
+			out.write('Processing changed file data/%d/file%d\n'
+			          % (burst, done + i))
+		done += count
+		out.flush()
+		if failing and burst >= bursts // 2:
+			sys.stderr.write('%s\n' % options.error)
+			return options.exitcode
+		time.sleep(seconds / bursts)
+	finish(destination, rng, start)
+	return 0
+
+
+
+if __name__ == '__main__':
+	sys.exit(main())
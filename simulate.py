@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2010, Tim Weber
+# All rights reserved.
+
+# Licensed under the 3-clause BSD license.
+# Please see the file LICENSE that came with this software
+# for additional information.
+
+"""
+Load test for wardrobe's orchestration: back up a fleet of synthetic hosts
+with a BackupQueue, using fakerdiff.py instead of rdiff-backup.
+
+Run this file to print the throughput, the latency of starting and reaping
+jobs and the CPU time and memory used by this process, which runs the
+queue. With --json, the results are written to stdout as a JSON object.
+Options not known to this file are passed on to fakerdiff.py, for example
+"--duration lognormal:0:0.5 --fail 0.02".
+"""
+
+import optparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+	import json
+except ImportError:
+	import simplejson as json
+
+from wardrobe import *
+
+
+
+class Timeout(Schedule):
+	"""Schedule terminating jobs that have been running for too long."""
+
+	def __init__(self, seconds):
+		"""Create a schedule terminating jobs after seconds."""
+		self.seconds = seconds
+
+	def plan(self, jobs):
+		"""Run all jobs in the order they have been added."""
+		return (list(jobs), {})
+
+	def expired(self, job, now):
+		"""Terminate the job if it has been running for too long."""
+		if now - job.started >= self.seconds:
+			return 'timeout'
+		return None
+
+
+
+def percentiles(values):
+	"""
+	Return a dict with the mean, median, 95th percentile and maximum of a
+	list of numbers, or None if it is empty.
+	"""
+	if not values:
+		return None
+	values = sorted(values)
+	return {
+		'mean': sum(values) / len(values),
+		'p50': values[len(values) // 2],
+		'p95': values[min(int(len(values) * 0.95), len(values) - 1)],
+		'max': values[-1],
+		}
+
+
+
+def simulate(hosts, workers, stub, timeout=60, history=True):
+	"""
+	Back up the given number of synthetic hosts into a temporary directory
+	with a BackupQueue of workers, running fakerdiff.py with the list of
+	options stub for each, and return a dict describing the results.
+	
+	Jobs running longer than timeout seconds are terminated. If history is
+	set, the runs are recorded in a RunHistory in memory, as a real setup
+	would.
+	"""
+	directory = tempfile.mkdtemp()
+	try:
+		template = BackupRun()
+		template.command = [sys.executable, os.path.join(
+			os.path.dirname(os.path.abspath(__file__)), 'fakerdiff.py')
+			] + stub + ['--']
+		template.verbosity = 5
+		if history:
+			template.history = RunHistory(':memory:')
+		generator = PullCompleteHost(directory)
+		queue = BackupQueue(workers, schedule=Timeout(timeout))
+		names = ['host%05d.example.com' % i for i in xrange(hosts)]
+		before = resource.getrusage(resource.RUSAGE_SELF)
+		start = time.time()
+		queue.addhosts(names, generator, template)
+		added = time.time()
+		jobs = queue.run()
+		end = time.time()
+		after = resource.getrusage(resource.RUSAGE_SELF)
+		# Each job after the first workers ones takes the worker of the job
+		# that finished the earliest among those not replaced yet, so it
+		# could have started then.
+		finishes = sorted([job.finished for job in jobs])
+		starts = sorted([job.started for job in jobs])
+		startlatency = [s - f for (s, f) in zip(starts[workers:], finishes)]
+		reaplatency = []
+		for job in jobs:
+			if job.succeeded:
+				for s in job.run.destination.sessionstatistics(1):
+					reaplatency.append(job.finished - s['EndTime'])
+		cpu = (after.ru_utime - before.ru_utime) + \
+		      (after.ru_stime - before.ru_stime)
+		return {
+			'hosts': hosts,
+			'workers': workers,
+			'stub': stub,
+			'addseconds': added - start,
+			'runseconds': end - added,
+			'throughput': len(jobs) / (end - added),
+			'succeeded': len([j for j in jobs if j.succeeded]),
+			'failed': len([j for j in jobs if j.succeeded is False and
+			               j.terminated is None]),
+			'terminated': len([j for j in jobs if j.terminated is not None]),
+			'startlatency': percentiles(startlatency),
+			'reaplatency': percentiles(reaplatency),
+			'cpuseconds': cpu,
+			'cpuperjob': cpu / max(len(jobs), 1),
+			# ru_maxrss is in kilobytes on Linux.
+			'maxrss': after.ru_maxrss * 1024,
+			}
+	finally:
+		shutil.rmtree(directory)
+
+
+
+def report(results):
+	"""Write the results of simulate() to stdout in a readable form."""
+	w = sys.stdout.write
+	w('%d hosts, %d workers, fakerdiff.py %s\n'
+	  % (results['hosts'], results['workers'], ' '.join(results['stub'])))
+	w('queued in %.3f s, ran in %.3f s, %.1f jobs/s\n'
+	  % (results['addseconds'], results['runseconds'],
+	     results['throughput']))
+	w('%d succeeded, %d failed, %d terminated\n'
+	  % (results['succeeded'], results['failed'], results['terminated']))
+	for name in ('startlatency', 'reaplatency'):
+		p = results[name]
+		if p is not None:
+			w('%s: mean %.1f ms, p50 %.1f ms, p95 %.1f ms, max %.1f ms\n'
+			  % (name, p['mean'] * 1000, p['p50'] * 1000, p['p95'] * 1000,
+			     p['max'] * 1000))
+	w('cpu %.3f s, %.2f ms per job, max rss %.1f MB\n'
+	  % (results['cpuseconds'], results['cpuperjob'] * 1000,
+	     results['maxrss'] / 1048576.0))
+
+
+
+def main(argv=None):
+	if argv is None:
+		argv = sys.argv[1:]
+	parser = optparse.OptionParser(usage='%prog [options] [STUB-OPTIONS]')
+	parser.add_option('--hosts', type='int', default=1000,
+	                  help='number of hosts to back up [%default]')
+	parser.add_option('--workers', type='int', default=50,
+	                  help='number of concurrent jobs [%default]')
+	parser.add_option('--timeout', type='float', default=60,
+	                  metavar='SECONDS',
+	                  help='terminate jobs after SECONDS [%default]')
+	parser.add_option('--no-history', dest='history', action='store_false',
+	                  default=True, help='do not record the runs')
+	parser.add_option('--json', action='store_true',
+	                  help='write the results as JSON')
+	# Pass everything else on to fakerdiff.py.
+	ours = []
+	stub = []
+	i = 0
+	while i < len(argv):
+		name = argv[i].split('=', 1)[0]
+		if parser.has_option(name) or name in ('-h', '--help'):
+			ours.append(argv[i])
+			option = parser.get_option(name)
+			if '=' not in argv[i] and option is not None and \
+			   option.takes_value() and i + 1 < len(argv):
+				i += 1
+				ours.append(argv[i])
+		else:
+			stub.append(argv[i])
+		i += 1
+	(options, args) = parser.parse_args(ours)
+	results = simulate(options.hosts, options.workers, stub, options.timeout,
+	                   options.history)
+	if options.json:
+		json.dump(results, sys.stdout, indent=1, sort_keys=True)
+		sys.stdout.write('\n')
+	else:
+		report(results)
+
+
+
+if __name__ == '__main__':
+	main()
@@ -26,11 +26,12 @@ unix.filters = unixfilter
 # "/var/backup/data/a.dotsunited.de".
 generator = PullCompleteHost('/var/backup/data')
 
-# Sequencially and unconditionally backup these hosts.
-for host in ('a.dotsunited.de', 'b.dotsunited.de'):
-	# Create a new backup run based on our template from above.
-	r = BackupRun(unix)
-	# Take source and destination from the generator.
-	(r.source, r.destination) = generator.generate(host)
-	# Run.
-	r.run()
+# Backup these hosts, running at most two rdiff-backup processes at once.
+q = BackupQueue(2)
+# Create a new backup run based on our template from above for each host, taking
+# source and destination from the generator.
+q.addhosts(('a.dotsunited.de', 'b.dotsunited.de'), generator, unix)
+# Run. A failing host does not stop the others; check the results instead.
+for job in q.run():
+	if not job.succeeded:
+		print 'backup of %s failed' % job.host
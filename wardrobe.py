@@ -9,14 +9,38 @@
 
 
 
+import ConfigParser
+import StringIO
 import atexit
-import copy
+import cPickle
+import calendar
+import csv
 import errno
+import fcntl
+import hashlib
+import heapq
+import optparse
 import os
+import pipes
+import random
 import re
+import select
+import signal
+import socket
+import sqlite3
+import stat
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+import weakref
+
+try:
+	import json
+except ImportError:
+	# Python 2.5 does not have json, but simplejson provides the same API.
+	import simplejson as json
 
 
 
@@ -25,11 +49,60 @@ class SettingCombinationError(StandardError):
 
 
 
+class FrozenError(StandardError):
+	"""You have tried to modify a frozen template."""
+
+
+
+class CollisionError(StandardError):
+	"""Two different hosts would be backed up to the same destination."""
+
+
+
+class ConfigError(StandardError):
+	"""A configuration file is malformed or refers to undefined names."""
+
+
+
+_timeregex = re.compile(r'^(\d{4})-(\d\d)-(\d\d)T(\d\d)[:-](\d\d)[:-](\d\d)'
+                        r'(Z|([-+])(\d\d)[:-](\d\d))$')
+
+def parsetime(value):
+	"""
+	Convert a timestamp as used by rdiff-backup in file names (for example
+	"2010-05-11T23:42:05+02:00") to seconds since the epoch.
+	
+	Timestamps written with --use-compatible-timestamps, which use dashes
+	instead of colons, are recognized as well. Raise ValueError if value is
+	not a valid timestamp.
+	"""
+	m = _timeregex.match(value)
+	if m is None:
+		raise ValueError('invalid rdiff-backup timestamp: %r' % value)
+	t = calendar.timegm([int(x) for x in m.group(1, 2, 3, 4, 5, 6)])
+	if m.group(8):
+		offset = int(m.group(9)) * 3600 + int(m.group(10)) * 60
+		if m.group(8) == '+':
+			t -= offset
+		else:
+			t += offset
+	return t
+
+
+
 class Locker(object):
 	"""
 	Filesystem-based atomic locking.
 	
-	Please note that this class is not designed to be thread-safe.
+	The lock is a directory that is created atomically. Inside it, a file
+	records the owner's process ID, host name and the time the lock was
+	acquired. This allows to detect locks left behind by crashed processes and
+	to reclaim them.
+	
+	An instance may be shared between threads, but it represents a single
+	lock: if one thread holds it, the others will get a StateError when trying
+	to lock it again. To have threads compete for the same lock, give each of
+	them its own instance.
 	"""
 
 	class AcquireError(StandardError):
@@ -38,6 +111,16 @@ class Locker(object):
 	class StateError(StandardError):
 		"""The operation is not valid in the current state."""
 
+	_ownerfile = 'owner'
+	"""The name of the file inside the lock directory describing the owner."""
+
+	_ownergrace = 60
+	"""
+	Seconds after which a lock directory without an owner file is considered
+	stale. Such directories are either left by older versions of this class or
+	by a process that crashed right after creating the directory.
+	"""
+
 	def _getpath(self):
 		"""
 		The complete path to the locking directory.
@@ -65,16 +148,88 @@ class Locker(object):
 
 	locked = property(_getlocked)
 
-	def __init__(self, locknow = False, directory = 'wardrobe.lock.d'):
+	def _getmaxage(self):
+		"""
+		If set, locks that have been held for longer than this number of
+		seconds are considered stale, even if their owner is still running.
+		
+		Defaults to None, which means that only locks whose owner process does
+		no longer exist are stale.
+		"""
+		return self._maxage
+
+	def _setmaxage(self, value):
+		if not (isinstance(value, (int, long, float)) or value is None):
+			raise TypeError('maxage has to be a number or None')
+		self._maxage = value
+
+	maxage = property(_getmaxage, _setmaxage)
+
+	def _getowner(self):
+		"""
+		A tuple (pid, hostname, started) describing the current holder of the
+		lock, no matter whether it is this instance or not. Read-only.
+		
+		None if the lock is not held or the owner could not be determined.
+		"""
+		try:
+			f = open(os.path.join(self.path, self._ownerfile))
+			try:
+				(pid, hostname, started) = f.read().split('\n')[:3]
+			finally:
+				f.close()
+			return (int(pid), hostname, float(started))
+		except (IOError, ValueError):
+			return None
+
+	owner = property(_getowner)
+
+	def _getstale(self):
+		"""
+		Whether the lock is held by someone who will never release it.
+		Read-only.
+		
+		This is the case if its owner process ran on this host and no longer
+		exists, if it is older than maxage or if it has no owner information
+		and is older than a grace period.
+		"""
+		owner = self.owner
+		if owner is None:
+			try:
+				mtime = os.stat(self.path).st_mtime
+			except OSError:
+				return False
+			return time.time() - mtime > self._ownergrace
+		(pid, hostname, started) = owner
+		if self.maxage is not None and time.time() - started > self.maxage:
+			return True
+		if hostname != socket.gethostname():
+			# We cannot check processes on other hosts.
+			return False
+		try:
+			os.kill(pid, 0)
+		except OSError, e:
+			return e.errno == errno.ESRCH
+		return False
+
+	stale = property(_getstale)
+
+	def __init__(self, locknow = False, directory = 'wardrobe.lock.d',
+	             maxage = None):
 		"""
 		Initialize a new locker that will use the directory in the system's
 		temp directory for locking.
 		
 		If locknow is set, the lock will be requested instantly; creating an
 		instance will fail if it can not be acquired.
+		
+		You may supply maxage as a convenience.
 		"""
-		self.path = directory
+		self._mutex = threading.RLock()
 		self._locked = False
+		self._atexit = False
+		self.path = directory
+		self.maxage = maxage
 		if locknow:
 			self.lock()
 
@@ -84,23 +239,104 @@ class Locker(object):
 		"""
 		self.unlockIfLocked()
 
-	def _lock(self):
+	def _remove(self, path):
 		"""
-		Acquire the lock, assuming that all state checks have already been made.
+		Remove a lock directory and the owner file in it, if any.
+		"""
+		try:
+			os.unlink(os.path.join(path, self._ownerfile))
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				raise e
+		os.rmdir(path)
+
+	def _reclaim(self):
+		"""
+		Remove the lock directory if it is stale. Return whether it has been
+		removed.
+		
+		Reclaiming is itself protected by a second lock directory, so that two
+		processes can not both decide that a lock is stale and then remove a
+		lock that one of them has just acquired.
 		"""
-		# Try to acquire the lock.
+		guard = self.path + '.reclaim'
 		try:
-			os.mkdir(self.path)
+			os.mkdir(guard)
 		except OSError, e:
-			if e.errno == errno.EEXIST:
+			if e.errno != errno.EEXIST:
+				raise e
+			# Someone else is reclaiming. Remove the guard only if it has
+			# obviously been left behind by a crashed process.
+			try:
+				if time.time() - os.stat(guard).st_mtime > self._ownergrace:
+					os.rmdir(guard)
+			except OSError:
+				pass
+			return False
+		try:
+			# Check again, the lock might have been reclaimed in the meantime.
+			if not self.stale:
+				return False
+			try:
+				self._remove(self.path)
+			except OSError:
+				return False
+			return True
+		finally:
+			os.rmdir(guard)
+
+	def _trylock(self):
+		"""
+		Try to create the lock directory once, reclaiming it if it is stale.
+		
+		Return whether the lock has been acquired.
+		"""
+		for attempt in (1, 2):
+			try:
+				os.mkdir(self.path)
+			except OSError, e:
+				if e.errno != errno.EEXIST:
+					raise e
 				# The directory (i.e. the lock) already exists.
-				raise self.AcquireError(
-					"could not acquire lock '%s'" % self._path
-					)
-			raise e
+				if attempt == 1 and self.stale and self._reclaim():
+					continue
+				return False
+			break
+		try:
+			f = open(os.path.join(self.path, self._ownerfile), 'w')
+			try:
+				f.write('%d\n%s\n%f\n' % (
+					os.getpid(), socket.gethostname(), time.time()))
+			finally:
+				f.close()
+		except:
+			os.rmdir(self.path)
+			raise
+		return True
+
+	def _lock(self, timeout=0):
+		"""
+		Acquire the lock, assuming that all state checks have already been made.
+		"""
+		if timeout is not None:
+			deadline = time.time() + timeout
+		delay = 0.05
+		while not self._trylock():
+			wait = delay
+			if timeout is not None:
+				# Try once more right at the deadline.
+				wait = min(delay, deadline - time.time())
+				if wait <= 0:
+					raise self.AcquireError(
+						"could not acquire lock '%s'" % self._path
+						)
+			time.sleep(wait)
+			delay = min(delay * 2, 1)
 		# We acquired the lock successfully. Register an atexit.
 		self._locked = True
-		atexit.register(self.unlockIfLocked)
+		if not self._atexit:
+			atexit.register(self.unlockIfLocked)
+			self._atexit = True
 		return True
 
 	def _unlock(self):
@@ -109,34 +345,46 @@ class Locker(object):
 		"""
 		# Try to release the lock. OSErrors will propagate.
 		# Warning: Without state checks, the directory will be removed even if
-		# it was not created by this instance! (However, only empty directories
-		# will be removed.)
-		os.rmdir(self.path)
+		# it was not created by this instance!
+		self._remove(self.path)
 		self._locked = False
 		return True
 
-	def lock(self):
+	def lock(self, timeout=0):
 		"""
 		Acquire the lock.
 		
+		If the lock is held by someone else, wait for at most timeout seconds
+		for it to be released. A timeout of None means to wait forever; the
+		default of 0 means not to wait at all.
+		
 		If already locked, a StateError is raised. If the lock could not be
 		acquired, an AcquireError is raised. Return True.
 		"""
-		if self.locked:
-			raise self.StateError('already locked, cannot lock again')
-		return self._lock()
+		self._mutex.acquire()
+		try:
+			if self.locked:
+				raise self.StateError('already locked, cannot lock again')
+			return self._lock(timeout)
+		finally:
+			self._mutex.release()
 
-	def lockIfUnlocked(self):
+	def lockIfUnlocked(self, timeout=0):
 		"""
 		Acquire the lock if this instance is not already holding one.
 		
 		If a lock is already held, return True. If not, one is acquired and True
-		is returned. If acquiring fails, an AcquireError is raised.
+		is returned. If acquiring fails, an AcquireError is raised. See lock()
+		for the meaning of timeout.
 		"""
-		# Don't lock again if we already own a lock.
-		if self.locked:
-			return True
-		return self._lock()
+		self._mutex.acquire()
+		try:
+			# Don't lock again if we already own a lock.
+			if self.locked:
+				return True
+			return self._lock(timeout)
+		finally:
+			self._mutex.release()
 
 	def unlock(self):
 		"""
@@ -145,9 +393,13 @@ class Locker(object):
 		If not locked, a StateError is raised. If the lock can not be released,
 		an error (most likely OSError) is raised. Return True.
 		"""
-		if not self.locked:
-			raise self.StateError('not locked, cannot unlock')
-		return self._unlock()
+		self._mutex.acquire()
+		try:
+			if not self.locked:
+				raise self.StateError('not locked, cannot unlock')
+			return self._unlock()
+		finally:
+			self._mutex.release()
 
 	def unlockIfLocked(self):
 		"""
@@ -156,8 +408,152 @@ class Locker(object):
 		If no lock is held, return True. Else, behave like unlock(), except that
 		no StateError will be raised.
 		"""
-		if self.locked:
-			self._unlock()
+		self._mutex.acquire()
+		try:
+			if self.locked:
+				self._unlock()
+			return True
+		finally:
+			self._mutex.release()
+
+
+
+class LockRegistry(object):
+	"""
+	A set of named Locker locks, for example one per host or destination.
+	
+	All locks live in a common directory. Names may contain any characters;
+	they are mapped to unique directory names. This class is thread-safe.
+	"""
+
+	def _getdirectory(self):
+		"""
+		The directory containing the lock directories. Read-only.
+		
+		A relative path passed to the constructor will be qualified by
+		prepending the system's temp directory to it.
+		"""
+		return self._directory
+
+	directory = property(_getdirectory)
+
+	def __init__(self, directory='wardrobe.locks.d', maxage=None):
+		"""
+		Create a new registry storing its locks in directory, which will be
+		created if it does not exist yet.
+		
+		maxage will be passed to the Locker instances; see there.
+		"""
+		if not isinstance(directory, str):
+			raise TypeError('directory has to be a string')
+		if not os.path.isabs(directory):
+			directory = os.path.join(tempfile.gettempdir(), directory)
+		self._directory = directory
+		self.maxage = maxage
+		self._lockers = {}
+		self._held = {}
+		self._mutex = threading.Lock()
+		try:
+			os.makedirs(directory)
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				raise e
+
+	def _dirname(self, name):
+		"""
+		Return the lock directory name for a lock name.
+		
+		Unusual characters are replaced and a hash of the original name is
+		appended to keep names like "a/b" and "a_b" apart.
+		"""
+		return '%s-%s.lock.d' % (re.sub('[^A-Za-z0-9.-]', '_', name)[-100:],
+		                         hashlib.md5(name).hexdigest()[:8])
+
+	def locker(self, name):
+		"""
+		Return the Locker for the given name, creating it if necessary.
+		
+		Use lock() and unlock() instead of locking the returned instance
+		directly if you want the registry to arbitrate between threads.
+		"""
+		if not isinstance(name, str):
+			raise TypeError('name has to be a string')
+		self._mutex.acquire()
+		try:
+			if name not in self._lockers:
+				self._lockers[name] = Locker(
+					directory=os.path.join(self.directory, self._dirname(name)),
+					maxage=self.maxage)
+			return self._lockers[name]
+		finally:
+			self._mutex.release()
+
+	def lock(self, name, timeout=0):
+		"""
+		Acquire the lock with the given name. See Locker.lock().
+		
+		Threads using the same registry compete for the lock like different
+		processes do: if another thread holds it, this one waits for at most
+		timeout seconds.
+		"""
+		if timeout is not None:
+			deadline = time.time() + timeout
+		delay = 0.05
+		while True:
+			self._mutex.acquire()
+			try:
+				if name not in self._held:
+					self._held[name] = True
+					break
+			finally:
+				self._mutex.release()
+			wait = delay
+			if timeout is not None:
+				# Try once more right at the deadline.
+				wait = min(delay, deadline - time.time())
+				if wait <= 0:
+					raise Locker.AcquireError(
+						"could not acquire lock '%s'" % name)
+			time.sleep(wait)
+			delay = min(delay * 2, 1)
+		try:
+			if timeout is not None:
+				timeout = max(deadline - time.time(), 0)
+			return self.locker(name).lock(timeout)
+		except:
+			self._release(name)
+			raise
+
+	def _release(self, name):
+		"""Mark the named lock as not being held by any thread."""
+		self._mutex.acquire()
+		try:
+			self._held.pop(name, None)
+		finally:
+			self._mutex.release()
+
+	def unlock(self, name):
+		"""
+		Release the lock with the given name. See Locker.unlock().
+		
+		The lock is no longer held by the calling thread afterwards, even if
+		removing its directory failed.
+		"""
+		try:
+			return self.locker(name).unlock()
+		finally:
+			self._release(name)
+
+	def locked(self, name):
+		"""
+		Return whether this registry is currently holding the named lock.
+		"""
+		self._mutex.acquire()
+		try:
+			locker = self._lockers.get(name)
+		finally:
+			self._mutex.release()
+		return locker is not None and locker.locked
 
 
 
@@ -168,15 +564,20 @@ class Defaultable(object):
 	Using this class, you can cascade and template options: If you leave value
 	unset, but point parent to another Defaultable, that Defaultable's value
 	will be used when trying to read the value.
+	
+	The resolved value is cached, so reading it does not walk the chain of
+	parents each time. Every Defaultable knows the ones using it as their
+	parent and invalidates their caches when its value, defaulting or parent
+	changes.
 	"""
 
+	__slots__ = ('_parent', '_children', '_cached', '_cache', '_defaulting',
+	             '_value', '_checktype', '__weakref__')
+
 	def __str__(self):
 		"""Return value.__str__()."""
 		return self.value.__str__()
 
-	_checktype = None
-	"""If set to a type, value has to be an instance of this type."""
-
 	def _getparent(self):
 		"""
 		The parent of this Defaultable.
@@ -191,10 +592,47 @@ class Defaultable(object):
 	def _setparent(self, value):
 		if not (isinstance(value, Defaultable) or value is None):
 			raise TypeError('parent has to be a Defaultable instance')
+		if self._parent is not None:
+			del self._parent._children[self]
+		if value is not None:
+			if value._children is None:
+				value._children = weakref.WeakKeyDictionary()
+			value._children[self] = True
 		self._parent = value
+		self._invalidate()
 
 	parent = property(_getparent, _setparent)
 
+	def _getdefaulting(self):
+		"""
+		Whether the value of the parent is used instead of the local one.
+		
+		Setting value sets this to False. Set it to True to use the parent's
+		value again.
+		"""
+		return self._defaulting
+
+	def _setdefaulting(self, value):
+		self._defaulting = bool(value)
+		self._invalidate()
+
+	defaulting = property(_getdefaulting, _setdefaulting)
+
+	def _invalidate(self):
+		"""
+		Forget the cached value of this instance and of all instances using it
+		as their (possibly indirect) parent.
+		"""
+		if not self._cached:
+			# Reading a child's value caches its parent's value first. So if
+			# this cache is empty, there are no caches below that depend on it.
+			return
+		self._cached = False
+		self._cache = None
+		if self._children is not None:
+			for child in self._children.keys():
+				child._invalidate()
+
 	def _getvalue(self):
 		"""
 		The value of this Defaultable, or that of its parent.
@@ -207,17 +645,20 @@ class Defaultable(object):
 		the value of the parent. Else it will return the stored value, or None
 		if no value has been stored yet.
 		"""
-		if self.defaulting and not (self.parent is None):
-			return self.parent.value
-		else:
-			return self._value
+		if not self._cached:
+			if self._defaulting and not (self._parent is None):
+				self._cache = self._parent.value
+			else:
+				self._cache = self._value
+			self._cached = True
+		return self._cache
 
 	def _setvalue(self, value):
 		if isinstance(self._checktype, type) and \
 			not isinstance(value, self._checktype):
 			raise TypeError('value has to be a %s' % self._checktype.__name__)
-		self.defaulting = False
 		self._value = value
+		self.defaulting = False
 
 	value = property(_getvalue, _setvalue)
 
@@ -234,14 +675,21 @@ class Defaultable(object):
 		succeed if the new value is an instance of the specified type. The type
 		can currently only be set at construction time.
 		"""
+		# If set to a type, value has to be an instance of this type.
+		self._checktype = None
+		self._parent = None
+		self._children = None
+		self._cached = False
+		self._cache = None
+		# Nothing is cached yet, so the slots can be set directly instead of
+		# through the properties, which would invalidate caches.
 		if isinstance(parentorvalue, Defaultable):
-			self.value = None
+			self._value = None
+			self._defaulting = True
 			self.parent = parentorvalue
-			self.defaulting = True
 		else:
-			self.parent = None
-			self.value = parentorvalue
-			self.defaulting = False
+			self._value = parentorvalue
+			self._defaulting = False
 		if isinstance(checktype, type):
 			self._checktype = checktype
 
@@ -252,6 +700,8 @@ class Ternary(object):
 	Representing three possible truth values: True, False and None (unknown).
 	"""
 
+	__slots__ = ('_value',)
+
 	def _getvalue(self):
 		"""
 		Set or retrieve the ternary value.
@@ -332,6 +782,468 @@ class Source(Place):
 class Destination(Place):
 	"""A destination path, possibly on a remote system."""
 
+	def _getdatadir(self):
+		"""
+		The path to the rdiff-backup-data directory of this destination, or None
+		if the destination is on a remote system. Read-only.
+		"""
+		if self.host is not None:
+			return None
+		return os.path.join(self.string, 'rdiff-backup-data')
+
+	datadir = property(_getdatadir)
+
+	def _getlastbackup(self):
+		"""
+		The time of the last successful backup into this destination, in
+		seconds since the epoch. Read-only.
+		
+		This is determined from the current_mirror marker in the repository. If
+		a backup has been interrupted, there are two markers; the older one
+		denotes the last complete mirror. Return None if the destination is
+		remote or does not contain a repository yet.
+		"""
+		datadir = self.datadir
+		if datadir is None:
+			return None
+		try:
+			names = os.listdir(datadir)
+		except OSError:
+			return None
+		times = []
+		for name in names:
+			if name.startswith('current_mirror.') and name.endswith('.data'):
+				try:
+					times.append(parsetime(name[15:-5]))
+				except ValueError:
+					pass
+		if not times:
+			return None
+		return min(times)
+
+	lastbackup = property(_getlastbackup)
+
+	def sessionstatistics(self, count=1):
+		"""
+		Return a list of the SessionStatistics of the last count backups into
+		this destination, most recent first. A count of None returns all of
+		them.
+		
+		Return an empty list if the destination is remote or does not contain
+		a repository yet.
+		"""
+		datadir = self.datadir
+		if datadir is None:
+			return []
+		try:
+			names = os.listdir(datadir)
+		except OSError:
+			return []
+		files = []
+		for name in names:
+			if name.startswith('session_statistics.'):
+				try:
+					files.append((parsetime(name[19:name.rindex('.')]), name))
+				except ValueError:
+					pass
+		files.sort()
+		files.reverse()
+		return [SessionStatistics(os.path.join(datadir, n))
+		        for (t, n) in files[:count]]
+
+
+
+class SessionStatistics(object):
+	"""
+	The contents of a session_statistics file, which rdiff-backup writes into
+	the rdiff-backup-data directory after each backup.
+	
+	The values are available in the values dict, keyed by their name as used
+	in the file (for example 'ElapsedTime' or 'ChangedFiles'), or by using the
+	instance itself as a dict.
+	"""
+
+	def __init__(self, path):
+		"""
+		Read and parse the given session_statistics file.
+		
+		The session time is taken from the file name.
+		"""
+		self.path = path
+		name = os.path.basename(path)
+		self.time = parsetime(name[19:name.rindex('.')])
+		self.values = {}
+		f = open(path)
+		try:
+			for line in f:
+				fields = line.split()
+				if len(fields) < 2:
+					continue
+				try:
+					if '.' in fields[1]:
+						self.values[fields[0]] = float(fields[1])
+					else:
+						self.values[fields[0]] = int(fields[1])
+				except ValueError:
+					pass
+		finally:
+			f.close()
+
+	def __getitem__(self, key):
+		return self.values[key]
+
+	def get(self, key, default=None):
+		"""Return the value for key if it exists, else default."""
+		return self.values.get(key, default)
+
+	def __repr__(self):
+		return '<SessionStatistics %r>' % self.path
+
+
+
+class RunHistory(object):
+	"""
+	An append-only store of past runs and their session statistics, and of
+	verifications, kept in an SQLite database.
+	
+	Hosts are identified by the host name of the run's Source or, for local
+	sources, by the path of the Destination. This class is thread-safe.
+	"""
+
+	_columns = (
+		('ElapsedTime', 'elapsed', 'REAL'),
+		('SourceFiles', 'sourcefiles', 'INTEGER'),
+		('SourceFileSize', 'sourcefilesize', 'INTEGER'),
+		('MirrorFiles', 'mirrorfiles', 'INTEGER'),
+		('MirrorFileSize', 'mirrorfilesize', 'INTEGER'),
+		('NewFiles', 'newfiles', 'INTEGER'),
+		('NewFileSize', 'newfilesize', 'INTEGER'),
+		('DeletedFiles', 'deletedfiles', 'INTEGER'),
+		('DeletedFileSize', 'deletedfilesize', 'INTEGER'),
+		('ChangedFiles', 'changedfiles', 'INTEGER'),
+		('ChangedSourceSize', 'changedsourcesize', 'INTEGER'),
+		('ChangedMirrorSize', 'changedmirrorsize', 'INTEGER'),
+		('IncrementFiles', 'incrementfiles', 'INTEGER'),
+		('IncrementFileSize', 'incrementfilesize', 'INTEGER'),
+		('TotalDestinationSizeChange', 'totaldestinationsizechange', 'INTEGER'),
+		('Errors', 'errors', 'INTEGER'),
+		)
+	"""(statistics name, column name, SQL type) of the stored statistics."""
+
+	def __init__(self, path):
+		"""
+		Open the history database at path, creating it if necessary.
+		"""
+		self.path = path
+		self._mutex = threading.Lock()
+		self._db = sqlite3.connect(path, check_same_thread=False)
+		self._db.execute(
+			'CREATE TABLE IF NOT EXISTS runs ('
+			'host TEXT NOT NULL, destination TEXT NOT NULL, '
+			'time REAL NOT NULL, returncode INTEGER, wallclock REAL, %s)'
+			% ', '.join(['%s %s' % (c, t) for (n, c, t) in self._columns]))
+		self._db.execute(
+			'CREATE INDEX IF NOT EXISTS runs_host ON runs (host, time)')
+		self._db.execute(
+			'CREATE INDEX IF NOT EXISTS runs_time ON runs (time)')
+		self._db.execute(
+			'CREATE TABLE IF NOT EXISTS verifications ('
+			'host TEXT NOT NULL, destination TEXT NOT NULL, '
+			'time REAL NOT NULL, returncode INTEGER, wallclock REAL)')
+		self._db.execute(
+			'CREATE INDEX IF NOT EXISTS verifications_host '
+			'ON verifications (host, time)')
+		self._db.commit()
+
+	def _query(self, sql, args=()):
+		"""Execute a query and return all resulting rows."""
+		self._mutex.acquire()
+		try:
+			return self._db.execute(sql, args).fetchall()
+		finally:
+			self._mutex.release()
+
+	def record(self, host, destination, result=None, statistics=None):
+		"""
+		Append a run to the history.
+		
+		host and destination are strings. result is the RunResult of the run,
+		if it has been executed by wardrobe; statistics are the
+		SessionStatistics it produced, if any. The time recorded is the session
+		time or, if there are no statistics, the time the run was started.
+		"""
+		if statistics is not None:
+			t = statistics.time
+		elif result is not None:
+			t = result.started
+		else:
+			t = time.time()
+		row = [host, destination, t, None, None]
+		if result is not None:
+			row[3:5] = [result.returncode, result.elapsed]
+		for (name, column, type_) in self._columns:
+			if statistics is None:
+				row.append(None)
+			else:
+				row.append(statistics.get(name))
+		self._mutex.acquire()
+		try:
+			self._db.execute('INSERT INTO runs VALUES (%s)'
+			                 % ', '.join(['?'] * len(row)), row)
+			self._db.commit()
+		finally:
+			self._mutex.release()
+
+	def recordverification(self, host, destination, result):
+		"""
+		Append a verification of host's repository at destination (both
+		strings) with the given RunResult to the history.
+		"""
+		self._mutex.acquire()
+		try:
+			self._db.execute('INSERT INTO verifications VALUES (?, ?, ?, ?, ?)',
+			                 (host, destination, result.started,
+			                  result.returncode, result.elapsed))
+			self._db.commit()
+		finally:
+			self._mutex.release()
+
+	def lastverified(self, host):
+		"""
+		Return the time host has last been verified successfully, or None if it
+		never has been.
+		"""
+		return self._query(
+			'SELECT MAX(time) FROM verifications '
+			'WHERE host = ? AND returncode = 0', (host,))[0][0]
+
+	def durations(self, host, count=10):
+		"""
+		Return the ElapsedTime of the last count runs of host that produced
+		statistics, most recent first.
+		"""
+		return [r[0] for r in self._query(
+			'SELECT elapsed FROM runs WHERE host = ? AND elapsed IS NOT NULL '
+			'ORDER BY time DESC LIMIT ?', (host, count))]
+
+	def last(self, host, count=1):
+		"""
+		Return the last count runs of host, most recent first, as dicts mapping
+		column names to values.
+		"""
+		self._mutex.acquire()
+		try:
+			cursor = self._db.execute(
+				'SELECT * FROM runs WHERE host = ? ORDER BY time DESC LIMIT ?',
+				(host, count))
+			names = [d[0] for d in cursor.description]
+			return [dict(zip(names, r)) for r in cursor.fetchall()]
+		finally:
+			self._mutex.release()
+
+	def total(self, column, since=None, until=None):
+		"""
+		Return the sum of a statistics column (for example
+		'totaldestinationsizechange') over all hosts' runs between since and
+		until (seconds since the epoch, both optional).
+		"""
+		if column not in [c for (n, c, t) in self._columns]:
+			raise ValueError('unknown column %r' % column)
+		sql = 'SELECT TOTAL(%s) FROM runs WHERE 1' % column
+		args = []
+		if since is not None:
+			sql += ' AND time >= ?'
+			args.append(since)
+		if until is not None:
+			sql += ' AND time < ?'
+			args.append(until)
+		return self._query(sql, args)[0][0]
+
+
+
+class RepositoryIndex(object):
+	"""
+	An index of the repositories in a directory, for example the basedir of a
+	PullCompleteHost, and their increments, kept in an SQLite database.
+	
+	refresh() updates the index, rescanning only the repositories whose
+	rdiff-backup-data directory has been modified or whose current_mirror
+	marker has changed since the last refresh. Queries are answered from the
+	database without touching the repositories. This class is thread-safe.
+	"""
+
+	def __init__(self, path, basedir):
+		"""
+		Open the index database at path, creating it if necessary, for the
+		repositories in basedir.
+		"""
+		self.path = path
+		self.basedir = basedir
+		self._mutex = threading.Lock()
+		self._db = sqlite3.connect(path, check_same_thread=False)
+		self._db.execute(
+			'CREATE TABLE IF NOT EXISTS repositories ('
+			'name TEXT PRIMARY KEY, mtime REAL, marker TEXT, current REAL)')
+		# The sizes are those reported by the session statistics of the
+		# session that created the increment.
+		self._db.execute(
+			'CREATE TABLE IF NOT EXISTS increments ('
+			'repository TEXT NOT NULL, time REAL NOT NULL, elapsed REAL, '
+			'mirrorsize INTEGER, incrementsize INTEGER, '
+			'PRIMARY KEY (repository, time))')
+		self._db.commit()
+
+	def _query(self, sql, args=()):
+		"""
+		Execute a query and return all resulting rows as dicts mapping column
+		names to values.
+		"""
+		self._mutex.acquire()
+		try:
+			cursor = self._db.execute(sql, args)
+			names = [d[0] for d in cursor.description]
+			return [dict(zip(names, r)) for r in cursor.fetchall()]
+		finally:
+			self._mutex.release()
+
+	def _scan(self, datadir, known):
+		"""
+		Read the rdiff-backup-data directory of a repository. Return the name
+		of the newest current_mirror marker, the time of the current mirror, a
+		dict mapping the session times not in known to (elapsed, mirrorsize,
+		incrementsize) tuples and a dict of all session times.
+		"""
+		marker = None
+		statistics = {}
+		times = {}
+		for n in os.listdir(datadir):
+			parts = n.split('.')
+			if len(parts) < 3 or parts[0] not in ('current_mirror',
+			   'mirror_metadata', 'session_statistics'):
+				continue
+			try:
+				t = parsetime(parts[1])
+			except ValueError:
+				continue
+			if parts[0] == 'current_mirror':
+				if marker is None or n > marker:
+					marker = n
+			elif parts[0] == 'session_statistics':
+				statistics[t] = n
+			times[t] = True
+		new = {}
+		for t in times:
+			if t in known:
+				continue
+			s = None
+			if t in statistics:
+				s = SessionStatistics(os.path.join(datadir, statistics[t]))
+			if s is None:
+				new[t] = (None, None, None)
+			else:
+				new[t] = (s.get('ElapsedTime'), s.get('MirrorFileSize'),
+				          s.get('IncrementFileSize'))
+		current = None
+		if marker is not None:
+			current = parsetime(marker.split('.')[1])
+		return (marker, current, new, times)
+
+	def refresh(self):
+		"""
+		Bring the index up to date and return the names of the repositories
+		that have been rescanned. Repositories that have disappeared are
+		removed from the index.
+		"""
+		stored = {}
+		for r in self._query('SELECT * FROM repositories'):
+			stored[r['name']] = r
+		rescanned = []
+		present = {}
+		for name in sorted(os.listdir(self.basedir)):
+			datadir = os.path.join(self.basedir, name, 'rdiff-backup-data')
+			try:
+				mtime = os.stat(datadir).st_mtime
+			except OSError:
+				continue
+			present[name] = True
+			old = stored.get(name)
+			if old is not None and old['mtime'] == mtime and \
+			   old['marker'] is not None and \
+			   os.path.exists(os.path.join(datadir, old['marker'])):
+				continue
+			# Sessions without statistics are read again, they might have been
+			# in progress during the last scan.
+			indexed = []
+			known = {}
+			for r in self._query(
+				'SELECT time, elapsed FROM increments WHERE repository = ?',
+				(name,)):
+				indexed.append(r['time'])
+				if r['elapsed'] is not None:
+					known[r['time']] = True
+			(marker, current, new, times) = self._scan(datadir, known)
+			self._mutex.acquire()
+			try:
+				self._db.execute('INSERT OR REPLACE INTO repositories '
+				                 'VALUES (?, ?, ?, ?)',
+				                 (name, mtime, marker, current))
+				for t in indexed:
+					if t not in times:
+						self._db.execute('DELETE FROM increments '
+						                 'WHERE repository = ? AND time = ?',
+						                 (name, t))
+				for (t, values) in new.iteritems():
+					self._db.execute('INSERT OR REPLACE INTO increments '
+					                 'VALUES (?, ?, ?, ?, ?)',
+					                 (name, t) + values)
+				self._db.commit()
+			finally:
+				self._mutex.release()
+			rescanned.append(name)
+		self._mutex.acquire()
+		try:
+			for name in stored:
+				if name not in present:
+					self._db.execute('DELETE FROM repositories WHERE name = ?',
+					                 (name,))
+					self._db.execute('DELETE FROM increments '
+					                 'WHERE repository = ?', (name,))
+			self._db.commit()
+		finally:
+			self._mutex.release()
+		return rescanned
+
+	def repositories(self):
+		"""
+		Return a list of dicts describing all indexed repositories, ordered
+		by name. The keys are 'name', 'current' (the time of the current
+		mirror), 'first' and 'last' (the times of the oldest and newest
+		session), 'increments' (the number of sessions), 'mirrorsize' (the
+		size of the current mirror) and 'incrementsize' (the total size of all
+		increments).
+		"""
+		return self._query(
+			'SELECT r.name AS name, r.current AS current, '
+			'MIN(i.time) AS first, MAX(i.time) AS last, '
+			'COUNT(i.time) AS increments, '
+			'(SELECT mirrorsize FROM increments WHERE repository = r.name '
+			' AND mirrorsize IS NOT NULL ORDER BY time DESC LIMIT 1) '
+			'AS mirrorsize, '
+			'TOTAL(i.incrementsize) AS incrementsize '
+			'FROM repositories r LEFT JOIN increments i '
+			'ON i.repository = r.name GROUP BY r.name ORDER BY r.name')
+
+	def increments(self, name):
+		"""
+		Return a list of dicts describing the sessions of a repository, oldest
+		first. The keys are 'time', 'elapsed', 'mirrorsize' and
+		'incrementsize'; values not known from the session statistics are
+		None.
+		"""
+		return self._query(
+			'SELECT time, elapsed, mirrorsize, incrementsize FROM increments '
+			'WHERE repository = ? ORDER BY time', (name,))
+
 
 
 class SDGenerator(object):
@@ -345,6 +1257,15 @@ class SDGenerator(object):
 	def __init__(self):
 		raise NotImplementedError('has to be subclassed')
 
+	def generateall(self, hosts):
+		"""
+		Lazily generate a (host, Source, Destination) tuple for each of the
+		hosts, which may be any iterable, for example an Inventory.
+		"""
+		for host in hosts:
+			(source, destination) = self.generate(host)
+			yield (host, source, destination)
+
 
 
 class PullCompleteHost(SDGenerator):
@@ -372,6 +1293,7 @@ class PullCompleteHost(SDGenerator):
 
 	def _setregex(self, value):
 		self._regex = re.compile(value)
+		self._dirnames = {}
 
 	regex = property(_getregex, _setregex)
 
@@ -387,6 +1309,7 @@ class PullCompleteHost(SDGenerator):
 		if not isinstance(value, str):
 			raise TypeError('subst has to be a string')
 		self._subst = value
+		self._dirnames = {}
 
 	subst = property(_getsubst, _setsubst)
 
@@ -442,24 +1365,172 @@ class PullCompleteHost(SDGenerator):
 		self.regex = '[^A-Za-z0-9.-]'
 		self.subst = '_'
 
+	def _dirname(self, host):
+		"""
+		Return the name of the subdirectory for host. The substitutions are
+		memoized until regex or subst change.
+		"""
+		try:
+			return self._dirnames[host]
+		except KeyError:
+			r = self._dirnames[host] = self.regex.sub(self.subst, host)
+			return r
+
 	def generate(self, host):
 		"""Generate a Source and Destination pair for the given host."""
 		s = Source('/', host, self.user)
-		d = Destination(os.path.join(self.basedir,
-		                             self.regex.sub(self.subst, host)))
+		d = Destination(os.path.join(self.basedir, self._dirname(host)))
 		return (s, d)
 
+	def generateall(self, hosts):
+		"""
+		Lazily generate a (host, Source, Destination) tuple for each of the
+		hosts, which may be any iterable, for example an Inventory.
+		
+		Hosts listed more than once are only generated the first time. Raise
+		CollisionError when reaching a host whose subdirectory name is the
+		same as that of a different host before it.
+		"""
+		seen = {}
+		for host in hosts:
+			dirname = self._dirname(host)
+			other = seen.get(dirname)
+			if other == host:
+				continue
+			if other is not None:
+				raise CollisionError('%r and %r would both be backed up to %s'
+				                     % (other, host, dirname))
+			seen[dirname] = host
+			(source, destination) = self.generate(host)
+			yield (host, source, destination)
+
+
+
+class Inventory(object):
+	"""
+	The host names listed in a file, read lazily each time the inventory is
+	iterated over, so that large inventories are never held in memory.
+	
+	format is one of 'lines' (one host per line; blank lines and lines
+	starting with '#' are ignored), 'csv' (a header row naming the columns,
+	the host being in the column named field), 'jsonl' (one JSON object per
+	line, the host being its member named field) or 'json' (an array of such
+	objects, or of strings, parsed incrementally). If format is None, it is
+	guessed from the file name's extension, defaulting to 'lines'.
+	"""
+
+	_extensions = {'.csv': 'csv', '.jsonl': 'jsonl', '.json': 'json'}
+	"""Map file name extensions to formats."""
+
+	_chunksize = 65536
+	"""The number of bytes to read at once from JSON files."""
+
+	def __init__(self, path, format=None, field='host'):
+		"""
+		Create a new inventory reading the file at path. You may supply format
+		and field as a convenience.
+		"""
+		if format is None:
+			format = self._extensions.get(os.path.splitext(path)[1], 'lines')
+		if format not in ('lines', 'csv', 'jsonl', 'json'):
+			raise ValueError('unknown format %r' % format)
+		self.path = path
+		self.format = format
+		self.field = field
+
+	def __iter__(self):
+		"""Return an iterator yielding the host names as strings."""
+		f = open(self.path, 'rb')
+		try:
+			for host in getattr(self, '_read' + self.format)(f):
+				if isinstance(host, unicode):
+					host = host.encode('utf-8')
+				if host:
+					yield host
+		finally:
+			f.close()
+
+	def _host(self, item):
+		"""Return the host name of a JSON item."""
+		if isinstance(item, basestring):
+			return item
+		return item.get(self.field)
+
+	def _readlines(self, f):
+		"""Yield the host names of a file in the lines format."""
+		for line in f:
+			line = line.strip()
+			if line and not line.startswith('#'):
+				yield line
+
+	def _readcsv(self, f):
+		"""Yield the host names of a file in the csv format."""
+		for row in csv.DictReader(f):
+			yield (row.get(self.field) or '').strip()
+
+	def _readjsonl(self, f):
+		"""Yield the host names of a file in the jsonl format."""
+		for line in f:
+			if line.strip():
+				yield self._host(json.loads(line))
+
+	def _readjson(self, f):
+		"""Yield the host names of a file in the json format."""
+		decoder = json.JSONDecoder()
+		buffer = ''
+		pos = 0
+		opened = False
+		eof = False
+		while True:
+			# Skip whitespace and the array's punctuation.
+			while pos < len(buffer) and buffer[pos] in ' \t\r\n,[]':
+				if buffer[pos] == ']':
+					return
+				if buffer[pos] == '[':
+					if opened:
+						raise ValueError('nested arrays are not supported')
+					opened = True
+				pos += 1
+			try:
+				if pos == len(buffer):
+					raise ValueError('need more data')
+				(item, end) = decoder.raw_decode(buffer, pos)
+				if end == len(buffer) and not eof:
+					# A number might continue in the next chunk.
+					raise ValueError('need more data')
+			except ValueError:
+				if eof:
+					if pos == len(buffer):
+						raise ValueError('unterminated array in %s'
+						                 % self.path)
+					raise
+				data = f.read(self._chunksize)
+				eof = not data
+				buffer = buffer[pos:] + data
+				pos = 0
+				continue
+			pos = end
+			yield self._host(item)
+
 
 
 class Option(object):
 	"""Class representing a command-line option."""
 
+	__slots__ = ('_name', '_type', '_value')
+
 	def _getname(self):
 		"""The option name as it appears on the command line, without dashes."""
 		return self._name
 
 	name = property(_getname)
 
+	def _gettype(self):
+		"""The type or default value this option has been created with."""
+		return self._type
+
+	type = property(_gettype)
+
 	def _getdashname(self):
 		"""The option name as it appears on the command line, with dashes."""
 		if self._type is Ternary:
@@ -570,6 +1641,8 @@ class Option(object):
 class Filter(object):
 	"""Base class for filter parameters passed to rdiff-backup."""
 
+	__slots__ = ()
+
 	def _getparams(self):
 		"""
 		A list of string parameters suitable for passing to rdiff-backup.
@@ -585,6 +1658,8 @@ class Filter(object):
 class FlagFilter(Filter):
 	"""Base class for flag-style filter parameters."""
 
+	__slots__ = ()
+
 	def _getparams(self):
 		"""A list of one string: This parameter's name."""
 		return ['--%s' % self._param]
@@ -596,6 +1671,8 @@ class FlagFilter(Filter):
 class SingleFilter(Filter):
 	"""Base class for single-value filter parameters."""
 
+	__slots__ = ('_value',)
+
 	def _getvalue(self):
 		"""The value of this parameter (i.e. a path)."""
 		return self._value
@@ -631,6 +1708,8 @@ class SingleFilter(Filter):
 class IntFilter(SingleFilter):
 	"""Base class for single-value filter parameters having an integer value."""
 
+	__slots__ = ()
+
 	def _setvalue(self, value):
 		if not isinstance(value, int):
 			raise TypeError('value has to be an int')
@@ -641,7 +1720,20 @@ class IntFilter(SingleFilter):
 
 
 class FilterSet(Filter):
-	"""A class able to hold a number of filters, useful for grouping."""
+	"""
+	A class able to hold a number of filters, useful for grouping.
+	
+	Copies made with copy() share their list of filters with the original
+	until either of them is extended; nested FilterSets are copied the same
+	way. The Filter instances themselves are always shared, so do not modify
+	them after a copy has been made.
+	
+	Large sets can be spilled into globbing filelists to keep the command line
+	short; see spilldir.
+	"""
+
+	__slots__ = ('_filters', '_shared', '_nested', '_frozen', '_spilldir',
+	             '_spillthreshold')
 
 	def _getparams(self):
 		"""
@@ -650,6 +1742,12 @@ class FilterSet(Filter):
 		
 		Read-only, use the extend() method to add new Filters.
 		"""
+		if self._frozen is not None:
+			return list(self._frozen)
+		if self.spilldir is not None:
+			leaves = self.leaves()
+			if len(leaves) > self.spillthreshold:
+				return self._spill(leaves)
 		r = []
 		for f in self._filters:
 			r.extend(f.params)
@@ -657,16 +1755,176 @@ class FilterSet(Filter):
 
 	params = property(_getparams)
 
-	def __init__(self, *args):
+	def _getspilldir(self):
 		"""
-		Create a new FilterSet.
+		The directory to write globbing filelists to if this set contains more
+		than spillthreshold filters.
 		
-		You may pass any number of Filter instances or sequences of Filter
+		If set, consecutive Include and Exclude filters are written into a file
+		passed with --include-globbing-filelist instead of being passed as
+		separate parameters. Files are named after a hash of their contents,
+		so identical sets share a file. The directory is created if it does
+		not exist. Only the settings of the outermost FilterSet are
+		considered.
+		
+		Defaults to None, which means never to spill.
+		"""
+		return self._spilldir
+
+	def _setspilldir(self, value):
+		if not (isinstance(value, str) or value is None):
+			raise TypeError('spilldir has to be a string or None')
+		self._spilldir = value
+
+	spilldir = property(_getspilldir, _setspilldir)
+
+	def _getspillthreshold(self):
+		"""
+		The number of filters above which this set is spilled into filelists
+		if spilldir is set. Defaults to 100.
+		"""
+		return self._spillthreshold
+
+	def _setspillthreshold(self, value):
+		if not isinstance(value, int):
+			raise TypeError('spillthreshold has to be an int')
+		self._spillthreshold = value
+
+	spillthreshold = property(_getspillthreshold, _setspillthreshold)
+
+	def _spill(self, leaves):
+		"""
+		Return the parameters for the given filters, writing consecutive
+		Include and Exclude filters into globbing filelists.
+		
+		Since rdiff-backup uses the first matching filter, filters repeating a
+		pattern of an earlier Include or Exclude can never match and are left
+		out. The order of all others is kept.
+		"""
+		r = []
+		run = []
+		seen = {}
+		for f in leaves:
+			if type(f) in (Include, Exclude):
+				if f.value in seen:
+					continue
+				seen[f.value] = True
+				# Patterns a filelist can not represent stay on the command line.
+				if '\n' not in f.value and f.value == f.value.strip():
+					run.append(f)
+					continue
+			r.extend(self._spillrun(run))
+			run = []
+			r.extend(f.params)
+		r.extend(self._spillrun(run))
+		return r
+
+	def _spillrun(self, run):
+		"""
+		Write a list of Include and Exclude filters into a globbing filelist
+		and return the parameters referencing it.
+		"""
+		if len(run) < 2:
+			r = []
+			for f in run:
+				r.extend(f.params)
+			return r
+		lines = []
+		for f in run:
+			if isinstance(f, Include):
+				lines.append('+ %s\n' % f.value)
+			else:
+				lines.append('- %s\n' % f.value)
+		content = ''.join(lines)
+		path = os.path.join(self.spilldir, '%s.globbing-filelist'
+		                                   % hashlib.sha1(content).hexdigest())
+		if not os.path.exists(path):
+			try:
+				os.makedirs(self.spilldir)
+			except OSError, e:
+				if e.errno != errno.EEXIST:
+					raise e
+			# Write to a temporary file first so that concurrent runs never see
+			# a partially written file.
+			(fd, tmp) = tempfile.mkstemp(dir=self.spilldir)
+			try:
+				os.write(fd, content)
+			finally:
+				os.close(fd)
+			os.chmod(tmp, 0644)
+			os.rename(tmp, path)
+		return ['--include-globbing-filelist', path]
+
+	def __init__(self, *args):
+		"""
+		Create a new FilterSet.
+		
+		You may pass any number of Filter instances or sequences of Filter
 		instances as arguments.
 		"""
 		self._filters = []
+		self._shared = False
+		# Whether _filters contains FilterSets that can be extended.
+		self._nested = False
+		self._frozen = None
+		self.spilldir = None
+		self.spillthreshold = 100
 		self.extend(args)
 
+	def copy(self):
+		"""
+		Return a copy of this FilterSet that can be extended independently.
+		
+		This is cheap, the list of filters is only copied when either set is
+		extended. Nested FilterSets that are not frozen are copied as well, so
+		extending them does not change the copy. Copies of frozen FilterSets
+		are not frozen.
+		"""
+		r = FilterSet()
+		if self._nested:
+			r._filters = []
+			for f in self._filters:
+				if isinstance(f, FilterSet) and f._frozen is None:
+					f = f.copy()
+				r._filters.append(f)
+			r._nested = True
+		else:
+			r._filters = self._filters
+			r._shared = self._shared = True
+		r.spilldir = self.spilldir
+		r.spillthreshold = self.spillthreshold
+		return r
+
+	def freeze(self):
+		"""
+		Return a frozen copy of this FilterSet.
+		
+		Nested FilterSets are flattened into it and its parameters are computed
+		only once. Trying to extend it raises a FrozenError. Frozen FilterSets
+		return themselves.
+		"""
+		if self._frozen is not None:
+			return self
+		r = FilterSet()
+		r._filters = self.leaves()
+		r._frozen = tuple(self.params)
+		r.spilldir = self.spilldir
+		r.spillthreshold = self.spillthreshold
+		return r
+
+	def leaves(self):
+		"""
+		Return a list of all filters in this FilterSet, with nested FilterSets
+		replaced by the filters they contain.
+		"""
+		r = []
+		for f in self._filters:
+			if isinstance(f, FilterSet):
+				r.extend(f.leaves())
+			else:
+				r.append(f)
+		return r
+
 	def extend(self, *args):
 		"""
 		Add any number of Filter instances to the FilterSet.
@@ -674,10 +1932,17 @@ class FilterSet(Filter):
 		The args may either be Filter instances or sequences of Filter
 		instances.
 		"""
+		if self._frozen is not None:
+			raise FrozenError('cannot extend a frozen FilterSet')
+		if self._shared:
+			self._filters = list(self._filters)
+			self._shared = False
 		for arg in args:
 			# Check whether the argument is a single Filter instance.
 			if isinstance(arg, Filter):
 				self._filters.append(arg)
+				if isinstance(arg, FilterSet) and arg._frozen is None:
+					self._nested = True
 			else:
 				# Check whether the argument is iterable.
 				i = None
@@ -695,54 +1960,63 @@ class FilterSet(Filter):
 
 class Exclude(SingleFilter):
 	"""An --exclude parameter."""
+	__slots__ = ()
 	_param = 'exclude'
 
 
 
 class ExcludeDeviceFiles(FlagFilter):
 	"""An --exclude-device-files parameter."""
+	__slots__ = ()
 	_param = 'exclude-device-files'
 
 
 
 class ExcludeFilelist(SingleFilter):
 	"""An --exclude-filelist parameter."""
+	__slots__ = ()
 	_param = 'exclude-filelist'
 
 
 
 class ExcludeGlobbingFilelist(SingleFilter):
 	"""An --exclude-globbing-filelist parameter."""
+	__slots__ = ()
 	_param = 'exclude-globbing-filelist'
 
 
 
 class ExcludeOtherFilesystems(FlagFilter):
 	"""An --exclude-other-filesystems parameter."""
+	__slots__ = ()
 	_param = 'exclude-other-filesystems'
 
 
 
 class ExcludeRegexp(SingleFilter):
 	"""An --exclude-regexp parameter."""
+	__slots__ = ()
 	_param = 'exclude-regexp'
 
 
 
 class ExcludeSpecialFiles(FlagFilter):
 	"""An --exclude-special-files parameter."""
+	__slots__ = ()
 	_param = 'exclude-special-files'
 
 
 
 class ExcludeSockets(FlagFilter):
 	"""An --exclude-sockets parameter."""
+	__slots__ = ()
 	_param = 'exclude-sockets'
 
 
 
 class ExcludeSymbolicLinks(FlagFilter):
 	"""An --exclude-symbolic-links parameter."""
+	__slots__ = ()
 	_param = 'exclude-symbolic-links'
 
 
@@ -753,205 +2027,4841 @@ class ExcludeSymbolicLinks(FlagFilter):
 
 class Include(SingleFilter):
 	"""An --include parameter."""
+	__slots__ = ()
 	_param = 'include'
 
 
 
 class IncludeFilelist(SingleFilter):
 	"""An --include-filelist parameter."""
+	__slots__ = ()
 	_param = 'include-filelist'
 
 
 
 class IncludeGlobbingFilelist(SingleFilter):
 	"""An --include-globbing-filelist parameter."""
+	__slots__ = ()
 	_param = 'include-globbing-filelist'
 
 
 
 class IncludeRegexp(SingleFilter):
 	"""An --include-regexp parameter."""
+	__slots__ = ()
 	_param = 'include-regexp'
 
 
 
 class IncludeSpecialFiles(FlagFilter):
 	"""An --include-special-files parameter."""
+	__slots__ = ()
 	_param = 'include-special-files'
 
 
 
 class IncludeSymbolicLinks(FlagFilter):
 	"""An --include-symbolic-links parameter."""
+	__slots__ = ()
 	_param = 'include-symbolic-links'
 
 
 
 class MaxFileSize(IntFilter):
 	"""A --max-file-size parameter."""
+	__slots__ = ()
 	_param = 'max-file-size'
 
 
 
 class MinFileSize(IntFilter):
 	"""A --min-file-size parameter."""
+	__slots__ = ()
 	_param = 'min-file-size'
 
 
 
-class BackupRun(object):
+def _globregex(glob):
 	"""
-	Defines options to an rdiff-backup backup-mode run and provides wrappers
-	around it.
+	Translate an rdiff-backup glob pattern into a regular expression string.
+	
+	"**" matches any string, "*" any string not containing a slash, "?" any
+	character but a slash and "[...]" a character class.
 	"""
+	i = 0
+	n = len(glob)
+	r = ''
+	while i < n:
+		c = glob[i]
+		i += 1
+		if c == '*':
+			if glob[i:i + 1] == '*':
+				r += '.*'
+				i += 1
+			else:
+				r += '[^/]*'
+		elif c == '?':
+			r += '[^/]'
+		elif c == '[':
+			j = i
+			if glob[j:j + 1] in ('!', '^'):
+				j += 1
+			if glob[j:j + 1] == ']':
+				j += 1
+			j = glob.find(']', j)
+			if j == -1:
+				r += '\\['
+			else:
+				chars = glob[i:j].replace('\\', '\\\\')
+				if chars[:1] in ('!', '^'):
+					chars = '^' + chars[1:]
+				r += '[%s]' % chars
+				i = j + 1
+		else:
+			r += re.escape(c)
+	return r
 
-	def __getattr__(self, name):
+
+
+class _GlobSelector(object):
+	"""
+	A compiled Include or Exclude glob, as used by Selection.
+	"""
+
+	__slots__ = ('include', '_match', '_scan')
+
+	def __init__(self, glob, include):
 		"""
-		Retrieve one of the virtual properties.
-		
-		These will be served from the _defaultables dict.
+		Compile the glob. include is True for Include semantics, False for
+		Exclude semantics.
 		"""
-		if name in self._defaultables:
-			return self._defaultables[name].value
-		raise AttributeError(name)
+		self.include = include
+		flags = 0
+		if glob.startswith('ignorecase:'):
+			glob = glob[11:]
+			flags = re.IGNORECASE
+		if len(glob) > 1:
+			glob = glob.rstrip('/')
+		# The path itself and everything below it.
+		self._match = re.compile('^%s(/.*)?$' % _globregex(glob), flags)
+		self._scan = None
+		if include:
+			# The directories above what the glob matches have to be scanned
+			# to find the included files.
+			components = glob.split('/')
+			prefixes = []
+			for k in range(1, len(components)):
+				prefix = '/'.join(components[:k]) or '/'
+				if '**' in components[k - 1]:
+					prefixes.append('%s(/.*)?' % _globregex(prefix))
+					break
+				prefixes.append(_globregex(prefix))
+			if prefixes:
+				self._scan = re.compile('^(%s)$' % '|'.join(prefixes), flags)
+
+	def __call__(self, path, st):
+		"""Return 1, 0 or 2 for include, exclude or scan, or None."""
+		if self._match.match(path):
+			return int(self.include)
+		if self._scan is not None and self._scan.match(path) and \
+		   stat.S_ISDIR(st.st_mode):
+			return 2
+		return None
+
+
+
+class SelectionEstimate(object):
+	"""
+	The result of Selection.estimate(): how many files, directories and bytes
+	a backup would contain.
+	"""
 
-	def __setattr__(self, name, value):
+	def __init__(self):
+		"""Create a new estimate with all counters set to zero."""
+		self.files = 0
+		self.directories = 0
+		self.bytes = 0
+		self.excluded = 0
+		self.errors = 0
+
+	def __repr__(self):
+		return '<SelectionEstimate %d files, %d directories, %d bytes>' % (
+			self.files, self.directories, self.bytes)
+
+
+
+class Selection(object):
+	"""
+	Applies a FilterSet to a local directory tree, the way rdiff-backup selects
+	the files to back up.
+	
+	For each path, the first filter that matches decides whether it is
+	included or excluded; paths no filter matches are included. Excluded
+	directories are not descended into. Include globs cause the directories
+	above the paths they match to be scanned; such directories are only
+	included if something inside them is.
+	"""
+
+	def __init__(self, filters, root):
 		"""
-		Set one of the virtual properties.
+		Prepare to evaluate the FilterSet filters on the directory root.
 		
-		These will be served from the _defaultables dict.
+		Filelists referenced by the filters are read now.
 		"""
-		if name[0] == '_' or name in ('source', 'destination', 'filters'):
-			return object.__setattr__(self, name, value)
-		if name in self._defaultables:
-			# First unset defaulting, else the parent will be changed.
-			self._defaultables[name].defaulting = False
-			self._defaultables[name].value.value = value
-			return self._defaultables[name].value.value
-		raise AttributeError(name)
+		if not isinstance(filters, FilterSet):
+			raise TypeError('filters has to be a FilterSet')
+		if len(root) > 1:
+			root = root.rstrip('/')
+		self.root = os.path.abspath(root)
+		self._rootdev = os.lstat(self.root).st_dev
+		self._selectors = []
+		for f in filters.leaves():
+			self._selectors.extend(self._compile(f))
+
+	def _compile(self, f):
+		"""Return a list of selector callables for a single Filter."""
+		t = type(f)
+		if t in (Include, Exclude):
+			return [_GlobSelector(f.value, t is Include)]
+		if t in (IncludeFilelist, ExcludeFilelist, IncludeGlobbingFilelist,
+		         ExcludeGlobbingFilelist):
+			include = t in (IncludeFilelist, IncludeGlobbingFilelist)
+			globbing = t in (IncludeGlobbingFilelist, ExcludeGlobbingFilelist)
+			r = []
+			fl = open(f.value)
+			try:
+				for line in fl:
+					line = line.rstrip('\n')
+					sign = include
+					if line.startswith('+ '):
+						(sign, line) = (True, line[2:])
+					elif line.startswith('- '):
+						(sign, line) = (False, line[2:])
+					if not line:
+						continue
+					if not globbing:
+						line = re.sub(r'([*?[])', r'[\1]', line)
+					r.append(_GlobSelector(line, sign))
+			finally:
+				fl.close()
+			return r
+		if t in (IncludeRegexp, ExcludeRegexp):
+			regex = re.compile(f.value)
+			return [self._selector(lambda path, st: regex.search(path),
+			                       t is IncludeRegexp)]
+		if t is MaxFileSize:
+			return [self._selector(lambda path, st: stat.S_ISREG(st.st_mode)
+			                       and st.st_size > f.value, False)]
+		if t is MinFileSize:
+			return [self._selector(lambda path, st: stat.S_ISREG(st.st_mode)
+			                       and st.st_size < f.value, False)]
+		if t is ExcludeOtherFilesystems:
+			return [self._selector(
+				lambda path, st: st.st_dev != self._rootdev, False)]
+		for (ft, test, include) in (
+			(ExcludeDeviceFiles, self._isdevice, False),
+			(ExcludeSpecialFiles, self._isspecial, False),
+			(IncludeSpecialFiles, self._isspecial, True),
+			(ExcludeSockets, lambda path, st: stat.S_ISSOCK(st.st_mode), False),
+			(ExcludeSymbolicLinks, lambda path, st: stat.S_ISLNK(st.st_mode),
+			 False),
+			(IncludeSymbolicLinks, lambda path, st: stat.S_ISLNK(st.st_mode),
+			 True),
+			):
+			if t is ft:
+				return [self._selector(test, include)]
+		raise TypeError('unsupported filter: %s' % t.__name__)
+
+	def _selector(self, test, include):
+		"""
+		Return a selector callable that includes (or excludes, if include is
+		False) the paths for which test(path, st) is true.
+		"""
+		result = int(include)
+		def selector(path, st):
+			if test(path, st):
+				return result
+			return None
+		return selector
+
+	def _isdevice(self, path, st):
+		"""Return whether st describes a device file."""
+		return stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode)
+
+	def _isspecial(self, path, st):
+		"""Return whether st describes a device, FIFO, socket or symlink."""
+		return self._isdevice(path, st) or stat.S_ISFIFO(st.st_mode) or \
+		       stat.S_ISSOCK(st.st_mode) or stat.S_ISLNK(st.st_mode)
+
+	def decide(self, path, st):
+		"""
+		Return 1 if the path would be included, 0 if it would be excluded and
+		2 if it is a directory that would only be scanned for included files.
+		"""
+		for selector in self._selectors:
+			r = selector(path, st)
+			if r is not None:
+				return r
+		return 1
 
-	def __delattr__(self, name):
+	def walk(self, estimate=None):
 		"""
-		"Delete" one of the virtual properties. This will actually set them back
-		to their default value.
+		Return an iterator yielding (path, stat) tuples for all paths that
+		would be backed up, parents before their contents.
+		
+		If an estimate is given, excluded paths and errors are counted in it.
 		"""
-		if name not in self._defaultables:
-			raise AttributeError(name)
-		if not self._defaultables[name].parent:
-			# We are probably a top-level BackupRun. Instruct the Option to
-			# reset itself to its default, then.
-			self._defaultables[name].value.default()
+		st = os.lstat(self.root)
+		return self._walk(self.root, st, self.decide(self.root, st), estimate)
+
+	def _walk(self, path, st, decision, estimate):
+		"""Walk the tree below path, which has already been decided on."""
+		if decision == 0:
+			if estimate is not None:
+				estimate.excluded += 1
+			return
+		if not stat.S_ISDIR(st.st_mode):
+			yield (path, st)
+			return
+		try:
+			names = os.listdir(path)
+		except OSError:
+			if estimate is not None:
+				estimate.errors += 1
+			names = []
+		names.sort()
+		# A directory that is only scanned is included when the first of its
+		# contents is.
+		pending = decision == 2
+		if not pending:
+			yield (path, st)
+		if path == '/':
+			prefix = '/'
 		else:
-			# Set the Defaultable to be defaulting.
-			self._defaultables[name].defaulting = True
-		return self._defaultables[name].value.value
+			prefix = path + '/'
+		for name in names:
+			child = prefix + name
+			try:
+				childst = os.lstat(child)
+			except OSError:
+				if estimate is not None:
+					estimate.errors += 1
+				continue
+			for r in self._walk(child, childst, self.decide(child, childst),
+			                    estimate):
+				if pending:
+					yield (path, st)
+					pending = False
+				yield r
+
+	def estimate(self):
+		"""
+		Walk the tree and return a SelectionEstimate of what would be backed
+		up.
+		"""
+		e = SelectionEstimate()
+		for (path, st) in self.walk(e):
+			if stat.S_ISDIR(st.st_mode):
+				e.directories += 1
+			else:
+				e.files += 1
+				if stat.S_ISREG(st.st_mode):
+					e.bytes += st.st_size
+		return e
 
-	def _getsource(self):
-		"""The source of the backup run."""
-		return self._source.value
 
-	def _setsource(self, value):
-		if not isinstance(value, Source):
-			raise TypeError('source has to be a Source')
-		self._source.defaulting = False
-		self._source.value = value
 
-	source = property(_getsource, _setsource)
+class RunEvent(object):
+	"""
+	A single line of output of an rdiff-backup process, classified.
+	
+	kind is one of 'phase' (rdiff-backup started a new stage of its work),
+	'file' (a file is being processed), 'warning', 'error' or 'output' (none of
+	the above). stream is 'stdout' or 'stderr'. For 'file' events, path is the
+	file in question, else None.
+	"""
 
-	def _getdestination(self):
-		"""The destination of the backup run."""
-		return self._destination
+	_patterns = (
+		('error', re.compile(r'^(Fatal Error: |Exception .* raised of class |'
+		                     r'Traceback \(most recent call last\):)')),
+		('warning', re.compile(r'^(Warning: |UpdateError |ListError |'
+		                       r'SpecialFileError )')),
+		('phase', re.compile(r'^(Starting (increment|mirror|restore) operation|'
+		                     r'Previous backup seems to have failed|'
+		                     r'Regressing to |Deleting increment|'
+		                     r'Found interrupted initial backup)')),
+		('file', re.compile(r'^(Processing changed file|'
+		                    r'Incrementing mirror file) (?P<path>.*)$')),
+		)
+	"""(kind, regex) tuples, the first matching regex determines the kind."""
+
+	def __init__(self, line, stream='stdout'):
+		"""Create a new event by parsing a line of output."""
+		self.line = line
+		self.stream = stream
+		self.kind = 'output'
+		self.path = None
+		for (kind, regex) in self._patterns:
+			m = regex.match(line)
+			if m is not None:
+				self.kind = kind
+				if 'path' in regex.groupindex:
+					self.path = m.group('path')
+				break
 
-	def _setdestination(self, value):
-		if not isinstance(value, Destination):
-			raise TypeError('destination has to be a Destination')
-		self._destination.defaulting = False
-		self._destination.value = value
+	def __repr__(self):
+		return '<RunEvent %s: %r>' % (self.kind, self.line)
 
-	destination = property(_getdestination, _setdestination)
 
-	def _getfilters(self):
-		"""The FilterSet of the backup run."""
-		return self._filters
 
-	def _setfilters(self, value):
-		if not isinstance(value, FilterSet):
-			raise TypeError('filters has to be a FilterSet')
-		self._filters = value
+class RunResult(object):
+	"""
+	The outcome of a finished rdiff-backup process.
+	"""
 
-	filters = property(_getfilters, _setfilters)
+	def _getsucceeded(self):
+		"""
+		Whether the process has been started and exited with a code of zero.
+		Read-only.
+		"""
+		return self.returncode == 0 and self.error is None
 
-	def _getcmdline(self):
+	succeeded = property(_getsucceeded)
+
+	def _getelapsed(self):
+		"""The wall-clock time in seconds the process took. Read-only."""
+		return self.finished - self.started
+
+	elapsed = property(_getelapsed)
+
+	def _getcputime(self):
 		"""
-		A list of strings representing the command line.
+		The CPU time in seconds (user and system) rdiff-backup and its children
+		have used, or None if unknown. Read-only.
+		"""
+		if self.rusage is None:
+			return None
+		return self.rusage.ru_utime + self.rusage.ru_stime
+
+	cputime = property(_getcputime)
+
+	def __init__(self, cmdline, returncode, started, finished, tail,
+	             rusage=None, error=None):
+		"""
+		Create a new result.
 		
-		Command name, options, source and destination are included.
+		tail is a list of the last lines of output, both stdout and stderr, in
+		the order they have been read. rusage is the resource usage of the
+		process as returned by os.wait4(), if known. returncode is None if it
+		is unknown, because the process has been reaped by someone else, or
+		if the process could not be started; error is the exception raised
+		then.
+		"""
+		self.cmdline = cmdline
+		self.returncode = returncode
+		self.started = started
+		self.finished = finished
+		self.tail = tail
+		self.rusage = rusage
+		self.error = error
+
+	def __repr__(self):
+		return '<RunResult %s after %.1fs>' % (self.returncode, self.elapsed)
+
+
+
+class RunHandle(object):
+	"""
+	A running rdiff-backup process, as returned by BackupRun.start().
+	
+	If output is captured, it is read without blocking and parsed into
+	RunEvents; use events() for a single handle or watch() for several of
+	them. Output is only read while one of these (or wait()) is being called,
+	so do not leave a capturing handle alone for too long, or the process will
+	block on a full pipe.
+	"""
+
+	_taillength = 20
+	"""The number of lines of output to keep for RunResult.tail."""
+
+	def _getpid(self):
+		"""The process ID of the rdiff-backup process. Read-only."""
+		return self._process.pid
+
+	pid = property(_getpid)
+
+	def _getfds(self):
+		"""
+		A list of the file descriptors still to be read from. Read-only.
+		
+		This is useful for select()ing on a number of handles yourself; call
+		read() with a descriptor that is ready.
+		"""
+		return self._streams.keys()
+
+	fds = property(_getfds)
+
+	def _getdone(self):
+		"""
+		Whether the process has exited and all of its output has been read.
 		Read-only.
 		"""
-		# TODO: Make the command customizable.
-		r = ['rdiff-backup']
-		for d in self._defaultables.itervalues():
-			r.extend(d.value.params)
-		r.extend(self.filters.params)
-		r.append(str(self.source))
-		r.append(str(self.destination))
-		return r
+		if self.result is not None:
+			return True
+		if self._streams and not self._killed:
+			return False
+		if not self._reap(False):
+			return False
+		if self._streams:
+			self._abandon()
+		self._finish()
+		return True
 
-	cmdline = property(_getcmdline)
+	done = property(_getdone)
 
-	def __init__(self, parent=None):
+	def __init__(self, cmdline, capture=True, callback=None):
 		"""
-		Create a new backup run, possibly based on the settings of another.
+		Start the given command line.
+		
+		If capture is False, the process will inherit this process' stdout and
+		stderr and no events will be generated. If callback is set, it will be
+		called with the RunResult as soon as the process has finished.
+		
+		The process is started in a session of its own, so that signals sent
+		by terminate() reach its children (like the ssh rdiff-backup spawns)
+		as well, but signals from the terminal do not.
 		"""
-		if parent is not None and not isinstance(parent, BackupRun):
-			raise TypeError('parent has to be a BackupRun')
-		self._defaultables = {}
-		if parent:
-			self._source = Defaultable(parent._source, Source)
-			self._destination = Defaultable(parent._destination, Destination)
-			self._filters = copy.deepcopy(parent.filters)
+		self.cmdline = cmdline
+		self.result = None
+		self._callback = callback
+		self._killed = False
+		self._reaped = False
+		self._returncode = None
+		self._rusage = None
+		self._tail = []
+		self._buffers = {}
+		self._streams = {}
+		if capture:
+			pipe = subprocess.PIPE
 		else:
-			self._source = Defaultable(Source(), Source)
-			self._destination = Defaultable(Destination(), Destination)
-			self._filters = FilterSet()
-		# These are the supported settings, grouped by type or default value.
-		possible = {
-		False: (
-			'create-full-path', 'force', 'never-drop-acls',
-			'override-chars-to-quote', 'preserve-numerical-ids',
-			'use-compatible-timestamps',),
-		True: (
-			'no-acls', 'no-compare-inode', 'no-compression', 'no-eas',
-			'no-file-statistics', 'no-hard-links', 'no-resource-forks',
-			'ssh-no-compression',),
-		Ternary: (
-			'carbonfile',),
-		str: (
-			'group-mapping-file', 'no-compression-regexp', 'remote-schema',
-			'remote-tempdir', 'tempdir', 'user-mapping-file',),
-		int: (
-			'terminal-verbosity', 'verbosity',),
-		}
-		for (type_, tuple_) in possible.iteritems():
-			for name in tuple_:
-				# Create a new Option instance to store our (override) value.
-				o = Option(name, type_)
-				propertyname = o.propertyname
-				# Create a Defaultable and store the Option as its value.
-				d = Defaultable(o, Option)
-				if parent and propertyname in parent._defaultables:
-					# But if there is a parent, default to its value.
-					d.parent = parent._defaultables[propertyname]
-					d.defaulting = True
-				# Store the Defaultable.
-				self._defaultables[propertyname] = d
+			pipe = None
+		self.started = time.time()
+		self._process = subprocess.Popen(cmdline, stdout=pipe, stderr=pipe,
+		                                 close_fds=True, preexec_fn=os.setsid)
+		if capture:
+			for (f, name) in ((self._process.stdout, 'stdout'),
+			                  (self._process.stderr, 'stderr')):
+				self._streams[f.fileno()] = (f, name)
+				self._buffers[f.fileno()] = ''
+
+	def _line(self, line, stream):
+		"""Turn a line of output into an event, remembering it for the tail."""
+		self._tail.append(line)
+		if len(self._tail) > self._taillength:
+			del self._tail[0]
+		return RunEvent(line, stream)
+
+	def read(self, fd):
+		"""
+		Read the output available on the given file descriptor without
+		blocking and return a list of RunEvents for the complete lines read.
+		"""
+		(f, stream) = self._streams[fd]
+		data = os.read(fd, 65536)
+		events = []
+		if not data:
+			# End of file. The remains of the buffer are the last line.
+			f.close()
+			del self._streams[fd]
+			if self._buffers[fd]:
+				events.append(self._line(self._buffers[fd], stream))
+			del self._buffers[fd]
+			return events
+		lines = (self._buffers[fd] + data).split('\n')
+		self._buffers[fd] = lines.pop()
+		for line in lines:
+			events.append(self._line(line.rstrip('\r'), stream))
+		return events
+
+	def _abandon(self):
+		"""
+		Stop reading the output of a killed process. Children that have
+		survived it may keep the pipes open indefinitely.
+		"""
+		for (fd, (f, stream)) in self._streams.items():
+			f.close()
+			if self._buffers[fd]:
+				self._line(self._buffers[fd], stream)
+		self._streams = {}
+		self._buffers = {}
+
+	def poll(self, timeout=0):
+		"""
+		Wait at most timeout seconds for output and return a list of RunEvents
+		for the lines read. A timeout of None means to wait until there is
+		output or the process has exited.
+		"""
+		fds = self.fds
+		if not fds:
+			if timeout is None:
+				self.wait()
+			return []
+		(ready, w, x) = select.select(fds, [], [], timeout)
+		events = []
+		for fd in ready:
+			events.extend(self.read(fd))
+		return events
 
-	def run(self):
+	def events(self):
 		"""
-		Run a backup with these settings.
+		Return an iterator yielding RunEvents as they arrive until the process
+		has exited.
+		"""
+		while not self.done:
+			for event in self.poll(None):
+				yield event
+
+	def _reap(self, block):
+		"""
+		Collect the exit code and the resource usage of the process, waiting
+		for it to exit if block is set. Return whether it has exited.
+		
+		os.wait4() is used instead of Popen.wait() because it returns the
+		resource usage of this very process (and its waited-for children), not
+		the total of all children of this process, some of which might still
+		be running.
 		
-		Always returns True. If rdiff-backup failed, a CalledProcessError will
-		be raised.
+		If someone else has reaped the process already, its exit code is
+		unknown and left as None.
 		"""
-		subprocess.check_call(self.cmdline)
+		if self._reaped:
+			return True
+		if block:
+			flags = 0
+		else:
+			flags = os.WNOHANG
+		try:
+			(pid, status, rusage) = os.wait4(self.pid, flags)
+		except OSError, e:
+			if e.errno != errno.ECHILD:
+				raise e
+			# Someone else has already reaped the process. Popen.wait() would
+			# claim it exited with 0.
+			self._reaped = True
+			return True
+		if pid == 0:
+			return False
+		self._reaped = True
+		if os.WIFSIGNALED(status):
+			self._returncode = -os.WTERMSIG(status)
+		else:
+			self._returncode = os.WEXITSTATUS(status)
+		self._rusage = rusage
+		# Keep Popen from trying to reap the process again.
+		self._process.returncode = self._returncode
 		return True
+
+	def _finish(self):
+		"""Collect the exit code and create the result."""
+		self._reap(True)
+		self.result = RunResult(self.cmdline, self._returncode, self.started,
+		                        time.time(), list(self._tail), self._rusage)
+		if self._callback is not None:
+			self._callback(self.result)
+
+	def wait(self):
+		"""
+		Wait for the process to exit, reading (and discarding) its output, and
+		return the RunResult.
+		"""
+		while self._streams:
+			if not self._killed:
+				self.poll(None)
+			elif self._reap(False):
+				self._abandon()
+			else:
+				self.poll(0.05)
+		if self.result is None:
+			self._finish()
+		return self.result
+
+	def terminate(self, sig=signal.SIGTERM):
+		"""
+		Send a signal (by default SIGTERM) to the process and its children, if
+		they are still running.
+		
+		Once the process has been sent SIGKILL, its output is only read until
+		it has exited.
+		"""
+		if self.result is not None:
+			return
+		if sig == signal.SIGKILL:
+			self._killed = True
+		try:
+			os.killpg(self.pid, sig)
+		except OSError, e:
+			if e.errno != errno.ESRCH:
+				raise e
+
+	def stop(self, grace=30):
+		"""
+		Send SIGTERM to the process and its children and, if they have not
+		exited after grace seconds, SIGKILL. Their output is read and
+		discarded meanwhile. Return the RunResult.
+		"""
+		self.terminate()
+		end = time.time() + grace
+		while not self.done:
+			remaining = end - time.time()
+			if remaining <= 0:
+				self.terminate(signal.SIGKILL)
+				break
+			if self.fds:
+				self.poll(min(remaining, 1))
+			else:
+				# Output is complete, but the process has not exited yet.
+				time.sleep(min(remaining, 0.05))
+		return self.wait()
+
+
+
+def watch(handles, timeout=None):
+	"""
+	Read the output of a number of RunHandles in a single thread.
+	
+	Return an iterator yielding (handle, event) tuples until all handles are
+	done. If timeout is set and no output has arrived for that many seconds,
+	(None, None) is yielded to allow the caller to do other work.
+	"""
+	handles = list(handles)
+	while True:
+		handles = [h for h in handles if not h.done]
+		if not handles:
+			return
+		fds = {}
+		for h in handles:
+			for fd in h.fds:
+				fds[fd] = h
+		if not fds:
+			# Nothing left to read, but some processes have not exited yet.
+			time.sleep(0.05)
+			continue
+		(ready, w, x) = select.select(fds.keys(), [], [], timeout)
+		if not ready:
+			yield (None, None)
+		for fd in ready:
+			for event in fds[fd].read(fd):
+				yield (fds[fd], event)
+
+
+
+class RunHook(object):
+	"""
+	Receives notifications about the runs it has been added to.
+	
+	All methods do nothing by default; override those you are interested in.
+	Hooks are called from the thread that started or finished the run, so if
+	the same hook is attached to runs executed concurrently by several
+	threads, it has to be thread-safe.
+	"""
+
+	def prerun(self, run, cmdline):
+		"""Called with the run and its final command line before it starts."""
+
+	def postrun(self, run, result):
+		"""Called with the run and its RunResult after it has succeeded."""
+
+	def onerror(self, run, result):
+		"""
+		Called with the run and its RunResult after rdiff-backup exited with a
+		non-zero code or could not be started at all.
+		"""
+
+	def _record(self, run, result):
+		"""
+		Return a dict describing a finished run, suitable for serializing.
+		"""
+		r = {
+			'host': run.host,
+			'destination': run.destination.string,
+			'cmdline': result.cmdline,
+			'returncode': result.returncode,
+			'started': result.started,
+			'elapsed': result.elapsed,
+			}
+		if result.error is not None:
+			r['error'] = str(result.error)
+		if result.rusage is not None:
+			r.update({
+				'utime': result.rusage.ru_utime,
+				'stime': result.rusage.ru_stime,
+				'maxrss': result.rusage.ru_maxrss,
+				'inblock': result.rusage.ru_inblock,
+				'oublock': result.rusage.ru_oublock,
+				})
+		return r
+
+
+
+class JSONLinesSink(RunHook):
+	"""
+	A RunHook appending one JSON object per finished run to a file.
+	"""
+
+	def __init__(self, path):
+		"""Create a new sink appending to the file at path."""
+		self.path = path
+		self._mutex = threading.Lock()
+
+	def postrun(self, run, result):
+		"""Append the run to the file."""
+		line = json.dumps(self._record(run, result), sort_keys=True) + '\n'
+		self._mutex.acquire()
+		try:
+			f = open(self.path, 'a')
+			try:
+				f.write(line)
+			finally:
+				f.close()
+		finally:
+			self._mutex.release()
+
+	onerror = postrun
+
+
+
+class PrometheusSink(RunHook):
+	"""
+	A RunHook writing the metrics of the last run of each host to a file in
+	the format of the Prometheus node exporter's textfile collector.
+	
+	The file is rewritten atomically after each run. Hosts are only known to
+	the instance that has seen their runs, so use a single instance per file.
+	"""
+
+	_metrics = (
+		('wardrobe_run_last_start_timestamp_seconds', 'started', 1,
+		 'Time the last run started.'),
+		('wardrobe_run_duration_seconds', 'elapsed', 1,
+		 'Wall-clock duration of the last run.'),
+		('wardrobe_run_exit_code', 'returncode', 1,
+		 'Exit code of the last run.'),
+		('wardrobe_run_cpu_user_seconds', 'utime', 1,
+		 'User CPU time of the last run.'),
+		('wardrobe_run_cpu_system_seconds', 'stime', 1,
+		 'System CPU time of the last run.'),
+		('wardrobe_run_max_rss_bytes', 'maxrss', 1024,
+		 'Maximum resident set size of the last run.'),
+		('wardrobe_run_block_input_operations', 'inblock', 1,
+		 'Block input operations of the last run.'),
+		('wardrobe_run_block_output_operations', 'oublock', 1,
+		 'Block output operations of the last run.'),
+		)
+	"""(metric name, record key, factor, help text) of the exported metrics."""
+
+	def __init__(self, path):
+		"""Create a new sink writing to the file at path."""
+		self.path = path
+		self._hosts = {}
+		self._mutex = threading.Lock()
+
+	def _escape(self, value):
+		"""Escape a label value."""
+		return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+		                 .replace('\n', '\\n')
+
+	def postrun(self, run, result):
+		"""Remember the run's metrics and rewrite the file."""
+		record = self._record(run, result)
+		self._mutex.acquire()
+		try:
+			self._hosts[record['host']] = record
+			lines = []
+			for (name, key, factor, help) in self._metrics:
+				lines.append('# HELP %s %s' % (name, help))
+				lines.append('# TYPE %s gauge' % name)
+				hosts = self._hosts.keys()
+				hosts.sort()
+				for host in hosts:
+					if self._hosts[host].get(key) is not None:
+						lines.append('%s{host="%s"} %r' % (name,
+							self._escape(host),
+							float(self._hosts[host][key] * factor)))
+			# Write to a temporary file first so that the collector never sees
+			# a partially written file.
+			tmp = '%s.%d.tmp' % (self.path, os.getpid())
+			f = open(tmp, 'w')
+			try:
+				f.write('\n'.join(lines) + '\n')
+			finally:
+				f.close()
+			os.rename(tmp, self.path)
+		finally:
+			self._mutex.release()
+
+	onerror = postrun
+
+
+
+class _TokenBucket(object):
+	"""
+	A token bucket refilling at rate tokens per second, holding at most burst
+	tokens.
+	"""
+
+	__slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+	def __init__(self, rate, burst):
+		"""Create a new, full bucket."""
+		self.rate = rate
+		self.burst = burst
+		self.tokens = float(burst)
+		self.stamp = time.time()
+
+	def refill(self, now):
+		"""Add the tokens accumulated since the last refill."""
+		self.tokens = min(self.burst,
+		                  self.tokens + (now - self.stamp) * self.rate)
+		self.stamp = now
+
+
+
+class BandwidthGovernor(object):
+	"""
+	Limits the bandwidth that all concurrent remote runs use together.
+	
+	The governor serves a token bucket on a Unix socket from a thread of this
+	process. BackupRuns having a governor wrap their remote-schema in a relay,
+	which is this module run as "wardrobe.py relay". The relay forwards
+	rdiff-backup's connection to the remote host, but asks the governor before
+	passing on each chunk of data, in either direction.
+	
+	Besides the global rate, each host may be capped to a rate of its own and
+	given a priority. If bandwidth is scarce, requests of hosts with a higher
+	priority are served first. Hosts are identified the way rdiff-backup
+	passes them to the remote-schema, including the user name, if any.
+	"""
+
+	_quantum = 16384
+	"""The largest number of bytes a request has to wait for at once."""
+
+	def _getrate(self):
+		"""
+		The number of bytes per second all relays may transfer together.
+		"""
+		return self._bucket.rate
+
+	def _setrate(self, value):
+		if not isinstance(value, (int, long)) or value < 1:
+			raise TypeError('rate has to be an int >= 1')
+		self._bucket.rate = value
+		self._bucket.burst = value
+
+	rate = property(_getrate, _setrate)
+
+	def _getpath(self):
+		"""The path of the Unix socket. Read-only."""
+		return self._path
+
+	path = property(_getpath)
+
+	def _getrunning(self):
+		"""Whether the governor is serving requests. Read-only."""
+		return self._thread is not None
+
+	running = property(_getrunning)
+
+	def __init__(self, rate, path=None):
+		"""
+		Create a new governor allowing rate bytes per second.
+		
+		path is the Unix socket to listen on. If it is not supplied, a socket
+		in a new temporary directory is used.
+		"""
+		self._bucket = _TokenBucket(1, 1)
+		self.rate = rate
+		self._bucket.tokens = float(rate)
+		if path is None:
+			path = os.path.join(tempfile.mkdtemp(prefix='wardrobe-'),
+			                    'governor.sock')
+		self._path = path
+		self._hosts = {}
+		self._pending = []
+		self._sequence = 0
+		self._listener = None
+		self._thread = None
+		self._stopping = False
+		self._mutex = threading.Lock()
+
+	def limit(self, host, rate=None, priority=0):
+		"""
+		Cap the bandwidth of host to rate bytes per second (None for no cap of
+		its own) and set its priority. The default priority is 0.
+		"""
+		if not (isinstance(rate, (int, long)) and rate >= 1 or rate is None):
+			raise TypeError('rate has to be an int >= 1 or None')
+		if not isinstance(priority, int):
+			raise TypeError('priority has to be an int')
+		bucket = None
+		if rate is not None:
+			bucket = _TokenBucket(rate, rate)
+		self._mutex.acquire()
+		try:
+			self._hosts[host] = (bucket, priority)
+		finally:
+			self._mutex.release()
+
+	def relayschema(self, schema):
+		"""
+		Return a remote-schema running the given one through a relay limited
+		by this governor.
+		"""
+		script = os.path.abspath(__file__)
+		if script[-4:] in ('.pyc', '.pyo'):
+			script = script[:-1]
+		# rdiff-backup replaces %s by the host, so the relay receives the host
+		# and the original schema, which it fills in itself.
+		return '%s %s relay %s %%s %s' % tuple([pipes.quote(
+			s.replace('%', '%%')) for s in (sys.executable, script, self.path,
+			schema)])
+
+	def start(self):
+		"""
+		Start serving requests in a background thread, if not already running.
+		"""
+		self._mutex.acquire()
+		try:
+			if self._thread is not None:
+				return
+			self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			self._listener.bind(self.path)
+			self._listener.listen(16)
+			self._stopping = False
+			self._thread = threading.Thread(target=self._serve,
+			                                name='BandwidthGovernor')
+			self._thread.setDaemon(True)
+			self._thread.start()
+			atexit.register(self.stop)
+		finally:
+			self._mutex.release()
+
+	def stop(self):
+		"""
+		Stop serving requests and remove the socket. Relays still running will
+		continue without a limit.
+		"""
+		self._mutex.acquire()
+		try:
+			thread = self._thread
+			if thread is None:
+				return
+			self._stopping = True
+		finally:
+			self._mutex.release()
+		thread.join()
+		self._listener.close()
+		try:
+			os.unlink(self.path)
+		except OSError:
+			pass
+		self._thread = None
+
+	def _serve(self):
+		"""Accept relays and answer their requests until stopped."""
+		clients = {}
+		while not self._stopping:
+			if self._pending:
+				timeout = 0.01
+			else:
+				timeout = 0.5
+			(ready, w, x) = select.select([self._listener] + clients.keys(),
+			                              [], [], timeout)
+			for s in ready:
+				if s is self._listener:
+					(conn, address) = s.accept()
+					clients[conn] = ''
+					continue
+				try:
+					data = s.recv(4096)
+				except socket.error:
+					data = ''
+				if not data:
+					s.close()
+					del clients[s]
+					self._pending = [r for r in self._pending if r[2] is not s]
+					continue
+				lines = (clients[s] + data).split('\n')
+				clients[s] = lines.pop()
+				for line in lines:
+					# Each request is a line "host count".
+					try:
+						(host, count) = line.rsplit(' ', 1)
+						count = int(count)
+					except ValueError:
+						continue
+					self._sequence += 1
+					self._pending.append((-self._hosts.get(host, (None, 0))[1],
+					                      self._sequence, s, host, count))
+			self._grant(time.time())
+		for s in clients:
+			s.close()
+
+	def _grant(self, now):
+		"""
+		Answer the pending requests that can be served now, in order of
+		priority, then age.
+		"""
+		self._bucket.refill(now)
+		self._pending.sort()
+		waiting = []
+		for (index, request) in enumerate(self._pending):
+			(priority, sequence, conn, host, count) = request
+			if self._bucket.tokens < min(count, self._quantum,
+			                             self._bucket.burst):
+				# Do not let requests of lower priority starve this one.
+				waiting.extend(self._pending[index:])
+				break
+			grant = min(count, int(self._bucket.tokens))
+			bucket = self._hosts.get(host, (None, 0))[0]
+			if bucket is not None:
+				bucket.refill(now)
+				if bucket.tokens < min(count, self._quantum, bucket.burst):
+					waiting.append(request)
+					continue
+				grant = min(grant, int(bucket.tokens))
+				bucket.tokens -= grant
+			self._bucket.tokens -= grant
+			try:
+				conn.sendall('%d\n' % grant)
+			except socket.error:
+				pass
+		self._pending = waiting
+
+
+
+def relay(path, host, schema):
+	"""
+	Run the remote-schema for host, forwarding stdin and stdout to it, limited
+	by the BandwidthGovernor listening on path. Return the exit code.
+	
+	This is what BandwidthGovernor.relayschema() runs. If the governor cannot
+	be reached, data is forwarded without a limit.
+	"""
+	process = subprocess.Popen(schema % host, shell=True,
+	                           stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+	                           close_fds=True)
+	governor = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		governor.connect(path)
+		replies = governor.makefile('rb')
+	except socket.error, e:
+		sys.stderr.write('wardrobe relay: not limiting, %s\n' % e)
+		governor = None
+	stdin = sys.stdin.fileno()
+	down = process.stdout.fileno()
+	# Map each source to its destination, the data read but not written yet
+	# and the number of bytes granted by the governor but not written yet.
+	routes = {stdin: process.stdin.fileno(), down: sys.stdout.fileno()}
+	buffers = {stdin: '', down: ''}
+	credit = {stdin: 0, down: 0}
+	eof = {}
+	for fd in routes.values():
+		# Writing must not block, or both directions could wait for each other.
+		fcntl.fcntl(fd, fcntl.F_SETFL,
+		            fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+	while down in routes:
+		readable = [fd for fd in routes if not buffers[fd] and fd not in eof]
+		writable = [routes[fd] for fd in routes if buffers[fd]]
+		(r, w, x) = select.select(readable, writable, [])
+		for fd in r:
+			buffers[fd] = os.read(fd, 65536)
+			if not buffers[fd]:
+				eof[fd] = True
+		for fd in routes.keys():
+			if buffers[fd] and routes[fd] in w:
+				if not credit[fd]:
+					credit[fd] = len(buffers[fd])
+					if governor is not None:
+						try:
+							governor.sendall('%s %d\n' % (host, credit[fd]))
+							credit[fd] = int(replies.readline())
+						except (socket.error, ValueError):
+							sys.stderr.write('wardrobe relay: not limiting '
+							                 'anymore, lost the governor\n')
+							governor = None
+				try:
+					count = os.write(routes[fd], buffers[fd][:credit[fd]])
+				except OSError, e:
+					if e.errno == errno.EAGAIN:
+						continue
+					if e.errno != errno.EPIPE:
+						raise e
+					# The reader is gone, discard what it would have read.
+					buffers[fd] = ''
+					eof[fd] = True
+					continue
+				buffers[fd] = buffers[fd][count:]
+				credit[fd] -= count
+			if fd in eof and not buffers[fd]:
+				# Pass the end of file on.
+				if fd == stdin:
+					process.stdin.close()
+				del routes[fd]
+	return process.wait()
+
+
+
+class SSHMasterPool(object):
+	"""
+	Keeps a multiplexing SSH master connection per remote host, so that all
+	runs to a host share it instead of each doing a handshake of its own.
+	
+	BackupRuns having a pool rewrite their remote-schema, if it runs ssh, to
+	use the pool's control sockets. BackupQueue opens the masters of the
+	jobs it is about to start in the background, checking and reopening
+	those that have expired, and closes them when it is done. Masters also
+	exit by themselves after having been idle for persist seconds. Runs to a
+	host without a master connect the usual way.
+	"""
+
+	_parallel = 16
+	"""The maximum number of ssh processes to run at the same time."""
+
+	def _getpersist(self):
+		"""
+		The number of seconds a master stays open without being used.
+		Defaults to 300.
+		"""
+		return self._persist
+
+	def _setpersist(self, value):
+		if not isinstance(value, int) or value < 1:
+			raise TypeError('persist has to be an int >= 1')
+		self._persist = value
+
+	persist = property(_getpersist, _setpersist)
+
+	def _getconnecttimeout(self):
+		"""
+		The number of seconds to wait for a host to accept the connection of a
+		master, so that unreachable hosts do not hold up the others. Defaults
+		to 10.
+		"""
+		return self._connecttimeout
+
+	def _setconnecttimeout(self, value):
+		if not isinstance(value, int) or value < 1:
+			raise TypeError('connecttimeout has to be an int >= 1')
+		self._connecttimeout = value
+
+	connecttimeout = property(_getconnecttimeout, _setconnecttimeout)
+
+	def _getcommand(self):
+		"""The ssh command to use. Defaults to 'ssh'."""
+		return self._command
+
+	def _setcommand(self, value):
+		if not isinstance(value, basestring):
+			raise TypeError('command has to be a string')
+		self._command = value
+
+	command = property(_getcommand, _setcommand)
+
+	def _getdirectory(self):
+		"""The directory containing the control sockets. Read-only."""
+		return self._directory
+
+	directory = property(_getdirectory)
+
+	def __init__(self, directory=None, persist=300, command='ssh',
+	             connecttimeout=10):
+		"""
+		Create a new pool keeping its control sockets in directory, by default
+		a new temporary directory. You may supply persist, command and
+		connecttimeout as a convenience.
+		"""
+		if directory is None:
+			directory = tempfile.mkdtemp(prefix='wardrobe-ssh-')
+		self._directory = directory
+		self.persist = persist
+		self.command = command
+		self.connecttimeout = connecttimeout
+		self._opened = {}
+
+	def _controlpath(self):
+		"""Return the ControlPath option, in ssh's own syntax."""
+		return 'ControlPath=%s' % os.path.join(self.directory, '%r@%h:%p')
+
+	def _control(self, specs, args):
+		"""
+		Run ssh with args for each host spec, at most _parallel at the same
+		time. Return the list of specs for which it failed.
+		"""
+		specs = list(specs)
+		failed = []
+		for start in xrange(0, len(specs), self._parallel):
+			processes = []
+			for spec in specs[start:start + self._parallel]:
+				cmdline = [self.command, '-o', self._controlpath()] + args + \
+				          [spec]
+				null = open(os.devnull, 'r+')
+				try:
+					processes.append((spec, subprocess.Popen(cmdline,
+						stdin=null, stdout=null, stderr=null, close_fds=True)))
+				finally:
+					null.close()
+			failed.extend([spec for (spec, p) in processes if p.wait()])
+		return failed
+
+	def open(self, specs):
+		"""
+		Open masters to the given hosts in parallel, unless they are open
+		already; masters that have expired are opened again. Hosts are given
+		as "host" or "user@host".
+		
+		Return the list of hosts that could not be connected to.
+		"""
+		specs = list(specs)
+		missing = self._control(specs, ['-O', 'check'])
+		failed = self._control(missing, ['-o', 'ControlMaster=yes',
+			'-o', 'ControlPersist=%d' % self.persist, '-o', 'BatchMode=yes',
+			'-o', 'ConnectTimeout=%d' % self.connecttimeout, '-N', '-f'])
+		for spec in specs:
+			if spec not in failed:
+				self._opened[spec] = True
+		return failed
+
+	def close(self, specs=None):
+		"""
+		Close the masters to the given hosts in parallel, by default all that
+		have been opened by this pool.
+		"""
+		if specs is None:
+			specs = self._opened.keys()
+		specs = list(specs)
+		self._control(specs, ['-O', 'exit'])
+		for spec in specs:
+			self._opened.pop(spec, None)
+
+	def rewrite(self, schema):
+		"""
+		Return the remote-schema changed to use the control sockets, or
+		unchanged if it does not start with the ssh command.
+		"""
+		parts = schema.split(None, 1)
+		if not parts or parts[0] != self.command:
+			return schema
+		options = '-o ControlMaster=no -o %s' % pipes.quote(
+			self._controlpath().replace('%', '%%'))
+		return ' '.join([parts[0], options] + parts[1:])
+
+
+
+class RetryPolicy(object):
+	"""
+	Decides whether and when a failed run is retried.
+	
+	A failure is transient, and retried, if the output does not contain a
+	message known to denote a permanent problem, but either the exit code is
+	one of those used for failed connections or the output contains a
+	message known to denote a temporary problem. All other failures are
+	permanent. Subclasses may override the patterns or transient().
+	
+	The first retry is made after delay seconds, each further one factor
+	times as late, but never later than maxdelay. To keep retries of hosts
+	that failed together from hitting the network together again, each delay
+	is shortened by a random fraction of up to jitter.
+	"""
+
+	_transientcodes = (255,)
+	"""Exit codes denoting a failed connection; 255 is used by ssh."""
+
+	_transientpattern = re.compile(
+		r'Connection (timed out|refused|reset|closed)|No route to host|'
+		r'Network is unreachable|Lost connection|Broken pipe|'
+		r'Temporary failure in name resolution|Resource temporarily '
+		r'unavailable|(ssh|kex)_exchange_identification', re.IGNORECASE)
+	"""Matches output denoting a temporary problem."""
+
+	_permanentpattern = re.compile(
+		r'Permission denied|Host key verification failed|'
+		r'Could not resolve hostname .*: Name or service not known|'
+		r'No space left on device')
+	"""Matches output denoting a problem retrying will not solve."""
+
+	def _getattempts(self):
+		"""
+		The maximum number of attempts, including the first one. Defaults
+		to 3.
+		"""
+		return self._attempts
+
+	def _setattempts(self, value):
+		if not isinstance(value, int) or value < 1:
+			raise TypeError('attempts has to be an int >= 1')
+		self._attempts = value
+
+	attempts = property(_getattempts, _setattempts)
+
+	def _getdelay(self):
+		"""The number of seconds before the first retry. Defaults to 60."""
+		return self._delay
+
+	def _setdelay(self, value):
+		if not isinstance(value, (int, long, float)) or value < 0:
+			raise TypeError('delay has to be a number >= 0')
+		self._delay = value
+
+	delay = property(_getdelay, _setdelay)
+
+	def _getfactor(self):
+		"""
+		The factor each further delay is multiplied by. Defaults to 2.
+		"""
+		return self._factor
+
+	def _setfactor(self, value):
+		if not isinstance(value, (int, long, float)) or value < 1:
+			raise TypeError('factor has to be a number >= 1')
+		self._factor = value
+
+	factor = property(_getfactor, _setfactor)
+
+	def _getmaxdelay(self):
+		"""The maximum number of seconds before a retry. Defaults to 3600."""
+		return self._maxdelay
+
+	def _setmaxdelay(self, value):
+		if not isinstance(value, (int, long, float)) or value < 0:
+			raise TypeError('maxdelay has to be a number >= 0')
+		self._maxdelay = value
+
+	maxdelay = property(_getmaxdelay, _setmaxdelay)
+
+	def _getjitter(self):
+		"""
+		The maximum fraction each delay is randomly shortened by, between 0
+		and 1. Defaults to 0.5.
+		"""
+		return self._jitter
+
+	def _setjitter(self, value):
+		if not isinstance(value, (int, long, float)) or not 0 <= value <= 1:
+			raise TypeError('jitter has to be a number between 0 and 1')
+		self._jitter = value
+
+	jitter = property(_getjitter, _setjitter)
+
+	def __init__(self, attempts=3, delay=60, factor=2, maxdelay=3600,
+	             jitter=0.5):
+		"""
+		Create a new policy. You may supply attempts, delay, factor, maxdelay
+		and jitter as a convenience.
+		"""
+		self.attempts = attempts
+		self.delay = delay
+		self.factor = factor
+		self.maxdelay = maxdelay
+		self.jitter = jitter
+
+	def transient(self, result):
+		"""Return whether the failure described by a RunResult is transient."""
+		output = '\n'.join(result.tail)
+		if self._permanentpattern.search(output):
+			return False
+		return result.returncode in self._transientcodes or \
+		       self._transientpattern.search(output) is not None
+
+	def retry(self, result, attempt):
+		"""
+		Return the number of seconds to wait before retrying a run that failed
+		as described by a RunResult in the given attempt, counting from 1, or
+		None if it is not to be retried.
+		"""
+		if result.succeeded or attempt >= self.attempts or \
+		   not self.transient(result):
+			return None
+		delay = min(self.delay * self.factor ** (attempt - 1), self.maxdelay)
+		return delay * (1 - self.jitter * random.random())
+
+
+
+class CircuitBreaker(object):
+	"""
+	Keeps track of failing hosts, so that a host that is down does not use up
+	a worker on each attempt.
+	
+	After threshold consecutive failed runs of a host, its circuit opens and
+	its jobs are skipped for cooldown seconds. Then a single run is let
+	through: if it succeeds, the circuit closes, else it stays open for
+	another cooldown. Hosts are identified by the host property of their
+	runs. This class is thread-safe.
+	"""
+
+	def _getthreshold(self):
+		"""
+		The number of consecutive failures after which a host's circuit
+		opens. Defaults to 3.
+		"""
+		return self._threshold
+
+	def _setthreshold(self, value):
+		if not isinstance(value, int) or value < 1:
+			raise TypeError('threshold has to be an int >= 1')
+		self._threshold = value
+
+	threshold = property(_getthreshold, _setthreshold)
+
+	def _getcooldown(self):
+		"""
+		The number of seconds a host's circuit stays open. Defaults to 3600.
+		"""
+		return self._cooldown
+
+	def _setcooldown(self, value):
+		if not isinstance(value, (int, long, float)) or value < 0:
+			raise TypeError('cooldown has to be a number >= 0')
+		self._cooldown = value
+
+	cooldown = property(_getcooldown, _setcooldown)
+
+	def _getpath(self):
+		"""
+		The file the state is kept in, so that it outlives the process, or
+		None to keep it in memory only. Set when created.
+		"""
+		return self._path
+
+	path = property(_getpath)
+
+	def __init__(self, threshold=3, cooldown=3600, path=None):
+		"""
+		Create a new breaker, reading the state from path if it is set and
+		exists. You may supply threshold and cooldown as a convenience.
+		"""
+		self.threshold = threshold
+		self.cooldown = cooldown
+		self._path = path
+		self._mutex = threading.Lock()
+		# Map hosts to [consecutive failures, time the circuit closes].
+		self._state = {}
+		if path is not None and os.path.exists(path):
+			f = open(path)
+			try:
+				for (host, state) in json.load(f).iteritems():
+					self._state[host.encode('utf-8')] = state
+			finally:
+				f.close()
+
+	def _save(self):
+		"""Write the state to path, if set. Called with the mutex held."""
+		if self.path is None:
+			return
+		# Write to a temporary file first so that a crash does not lose the
+		# previous state.
+		tmp = '%s.%d.tmp' % (self.path, os.getpid())
+		f = open(tmp, 'w')
+		try:
+			json.dump(self._state, f)
+		finally:
+			f.close()
+		os.rename(tmp, self.path)
+
+	def isopen(self, host, now=None):
+		"""Return whether the circuit of host is open."""
+		if now is None:
+			now = time.time()
+		self._mutex.acquire()
+		try:
+			state = self._state.get(host)
+			return state is not None and state[0] >= self.threshold and \
+			       now < state[1]
+		finally:
+			self._mutex.release()
+
+	def allow(self, host, now=None):
+		"""
+		Return whether a run of host may be started now. If the cooldown of
+		an open circuit is over, this lets a single run through.
+		"""
+		if now is None:
+			now = time.time()
+		self._mutex.acquire()
+		try:
+			state = self._state.get(host)
+			if state is None or state[0] < self.threshold:
+				return True
+			if now < state[1]:
+				return False
+			# Keep the circuit open for others until the result is known.
+			state[1] = now + self.cooldown
+			return True
+		finally:
+			self._mutex.release()
+
+	def record(self, host, succeeded, now=None):
+		"""Record the outcome of a run of host."""
+		if now is None:
+			now = time.time()
+		self._mutex.acquire()
+		try:
+			if succeeded:
+				if self._state.pop(host, None) is not None:
+					self._save()
+				return
+			state = self._state.setdefault(host, [0, 0])
+			state[0] += 1
+			if state[0] >= self.threshold:
+				state[1] = now + self.cooldown
+			self._save()
+		finally:
+			self._mutex.release()
+
+
+
+def _optionschema(possible):
+	"""
+	Turn a dict mapping Option types to sequences of option names into a tuple
+	of (propertyname, name, type) tuples, sorted by name, and a dict mapping
+	property names to Options holding the default value.
+	
+	The Options in the dict are shared by all instances and must not be
+	modified.
+	"""
+	schema = []
+	defaults = {}
+	for (type_, names) in possible.iteritems():
+		for name in names:
+			o = Option(name, type_)
+			schema.append((o.propertyname, name, type_))
+			defaults[o.propertyname] = o
+	schema.sort(key=lambda x: x[1])
+	return (tuple(schema), defaults)
+
+
+
+class OptionRun(object):
+	"""
+	Defines options to a run of rdiff-backup and provides wrappers around it.
+	
+	Options are only stored in an instance if they have been set on it. All
+	others are looked up in the parent, or are the defaults shared by all
+	instances, so creating a run based on another one is cheap.
+	
+	The Options in effect are resolved once and cached, so looking one up
+	does not walk the chain of parents. Like Defaultable, every run knows the
+	runs based on it and invalidates their caches when its options change.
+	
+	This class is not to be used directly. Instead, use one of the derived
+	classes, which define the supported options.
+	"""
+
+	_schema = ()
+	_defaultoptions = {}
+
+	def __getattr__(self, name):
+		"""
+		Retrieve one of the virtual properties.
+		
+		These will be served from the Options set on this instance or its
+		parents.
+		"""
+		if name[0] != '_' and name in self._defaultoptions:
+			return self._option(name).value
+		raise AttributeError(name)
+
+	def __setattr__(self, name, value):
+		"""
+		Set one of the virtual properties.
+		
+		This creates an Option on this instance, overriding the parent's.
+		"""
+		if name[0] == '_' or \
+		   isinstance(getattr(type(self), name, None), property):
+			return object.__setattr__(self, name, value)
+		if name in self._defaultoptions:
+			o = self._options.get(name)
+			if o is None:
+				default = self._defaultoptions[name]
+				o = Option(default.name, default.type)
+				o.value = value
+				self._options[name] = o
+				self._invalidate()
+			else:
+				# The resolved options refer to o, which changes in place.
+				o.value = value
+			return o.value
+		raise AttributeError(name)
+
+	def __delattr__(self, name):
+		"""
+		"Delete" one of the virtual properties. This will actually set them back
+		to their default value, i.e. the parent's value or, for top-level
+		runs, the Option's default.
+		"""
+		if name not in self._defaultoptions:
+			raise AttributeError(name)
+		if name in self._options:
+			del self._options[name]
+			self._invalidate()
+		return self._option(name).value
+
+	def _resolve(self):
+		"""
+		Return a dict mapping all property names to the Options in effect for
+		this instance, computing it if necessary. Runs that do not set any
+		options share the dict of their parent.
+		"""
+		r = self._resolved
+		if r is None:
+			if self._parent is None:
+				r = self._defaultoptions
+			else:
+				r = self._parent._resolve()
+			if self._options:
+				r = dict(r)
+				r.update(self._options)
+			self._resolved = r
+		return r
+
+	def _invalidate(self):
+		"""
+		Forget the resolved options of this instance and of all runs based on
+		it, directly or indirectly.
+		"""
+		if self._resolved is None:
+			# Resolving a child's options resolves its parent's first. So if
+			# this cache is empty, there are no caches below that depend on it.
+			return
+		self._resolved = None
+		if self._children is not None:
+			for child in self._children.keys():
+				child._invalidate()
+
+	def _option(self, name):
+		"""
+		Return the Option for the given property name that is in effect for
+		this instance.
+		"""
+		return self._resolve()[name]
+
+	def _getdestination(self):
+		"""The destination of the run."""
+		return self._destination.value
+
+	def _setdestination(self, value):
+		if not isinstance(value, Destination):
+			raise TypeError('destination has to be a Destination')
+		self._destination.defaulting = False
+		self._destination.value = value
+
+	destination = property(_getdestination, _setdestination)
+
+	def _gethistory(self):
+		"""
+		The RunHistory to record this run in after it has finished. Backups
+		are recorded with their session statistics, verifications as such;
+		other runs are not recorded.
+		
+		Inherited from the parent. Defaults to None, which means not to record
+		anything.
+		"""
+		return self._history.value
+
+	def _sethistory(self, value):
+		if not (isinstance(value, RunHistory) or value is None):
+			raise TypeError('history has to be a RunHistory or None')
+		self._history.value = value
+
+	history = property(_gethistory, _sethistory)
+
+	def _getgovernor(self):
+		"""
+		The BandwidthGovernor limiting the bandwidth of this run's connection
+		to a remote system.
+		
+		Inherited from the parent. Defaults to None, which means not to limit
+		the bandwidth. The governor is started when the run is.
+		"""
+		return self._governor.value
+
+	def _setgovernor(self, value):
+		if not (isinstance(value, BandwidthGovernor) or value is None):
+			raise TypeError('governor has to be a BandwidthGovernor or None')
+		self._governor.value = value
+
+	governor = property(_getgovernor, _setgovernor)
+
+	def _getsshpool(self):
+		"""
+		The SSHMasterPool whose master connection this run uses to reach a
+		remote system.
+		
+		Inherited from the parent. Defaults to None, which means that each run
+		opens a connection of its own.
+		"""
+		return self._sshpool.value
+
+	def _setsshpool(self, value):
+		if not (isinstance(value, SSHMasterPool) or value is None):
+			raise TypeError('sshpool has to be an SSHMasterPool or None')
+		self._sshpool.value = value
+
+	sshpool = property(_getsshpool, _setsshpool)
+
+	def _getcommand(self):
+		"""
+		The command to run as rdiff-backup, as a tuple of strings, the first
+		being the program and the others arguments to put in front of the
+		options. A string is accepted as a command without arguments.
+		
+		Inherited from the parent. Defaults to ('rdiff-backup',). Set it to
+		run rdiff-backup from a different location or, for testing, a program
+		simulating it.
+		"""
+		return self._command.value
+
+	def _setcommand(self, value):
+		if isinstance(value, str):
+			value = (value,)
+		value = tuple(value)
+		if not value:
+			raise TypeError('command must not be empty')
+		for v in value:
+			if not isinstance(v, str):
+				raise TypeError('command has to be a string or strings')
+		self._command.value = value
+
+	command = property(_getcommand, _setcommand)
+
+	def _getretrypolicy(self):
+		"""
+		The RetryPolicy deciding whether and when a failed run is retried,
+		both by run() and by a BackupQueue.
+		
+		Inherited from the parent. Defaults to None, which means never to
+		retry.
+		"""
+		return self._retrypolicy.value
+
+	def _setretrypolicy(self, value):
+		if not (isinstance(value, RetryPolicy) or value is None):
+			raise TypeError('retrypolicy has to be a RetryPolicy or None')
+		self._retrypolicy.value = value
+
+	retrypolicy = property(_getretrypolicy, _setretrypolicy)
+
+	def _gethost(self):
+		"""
+		The name identifying this run's host in a RunHistory: the host name of
+		the destination or, if it is local, the destination path. Read-only.
+		"""
+		if self.destination.host is not None:
+			return self.destination.host
+		return self.destination.string
+
+	host = property(_gethost)
+
+	def _gethooks(self):
+		"""
+		The list of RunHooks to notify about this run: those of the parent,
+		followed by the ones added to this instance.
+		
+		Assigning a sequence of RunHooks replaces the ones of this instance,
+		but not those of the parent. The returned list is a copy; use addhook()
+		to add to it.
+		"""
+		r = []
+		if self._parent is not None:
+			r.extend(self._parent.hooks)
+		r.extend(self._hooks)
+		return r
+
+	def _sethooks(self, value):
+		value = list(value)
+		for hook in value:
+			if not isinstance(hook, RunHook):
+				raise TypeError('hooks have to be RunHooks')
+		self._hooks = value
+
+	hooks = property(_gethooks, _sethooks)
+
+	def _inherits(self):
+		"""
+		Return whether the command line of this instance is the parent's,
+		except for the paths. Only called if there is a parent.
+		"""
+		return not self._options and self._governor.defaulting and \
+		       self._sshpool.defaulting and self._command.defaulting
+
+	def _getprefix(self):
+		"""
+		Return the command line without the paths, i.e. the command name,
+		options and, for backups, filters.
+		"""
+		parent = self._parent
+		if parent is not None and self._inherits():
+			# Nothing differs from the parent, which might have the prefix
+			# precompiled.
+			return parent._getprefix()
+		r = list(self.command)
+		for (propertyname, name, type_) in self._schema:
+			if propertyname == 'remoteschema':
+				r.extend(self._getremoteschemaparams())
+			else:
+				r.extend(self._option(propertyname).params)
+		return r
+
+	def _getremoteschemaparams(self):
+		"""
+		Return the parameters for the remote-schema option, rewritten for the
+		SSH master pool and the bandwidth governor, if set.
+		"""
+		o = self._option('remoteschema')
+		if self.sshpool is None and self.governor is None:
+			return o.params
+		schema = o.value
+		if schema is None:
+			# rdiff-backup's default.
+			schema = 'ssh %s rdiff-backup --server'
+			if self.sshcompression:
+				schema = 'ssh -C %s rdiff-backup --server'
+		if self.sshpool is not None:
+			schema = self.sshpool.rewrite(schema)
+		if self.governor is not None:
+			schema = self.governor.relayschema(schema)
+		return ['--remote-schema', schema]
+
+	def _getcmdline(self):
+		"""
+		A list of strings representing the command line. Read-only.
+		"""
+		raise NotImplementedError('has to be subclassed')
+
+	cmdline = property(_getcmdline)
+
+	def __init__(self, parent=None):
+		"""
+		Initialize the settings common to all runs, possibly based on the
+		settings of another run. The derived classes check the type of parent.
+		"""
+		self._options = {}
+		self._parent = parent
+		self._resolved = None
+		self._children = None
+		self._hooks = ()
+		if parent is not None:
+			if parent._children is None:
+				parent._children = weakref.WeakKeyDictionary()
+			parent._children[self] = True
+		if parent:
+			self._destination = Defaultable(parent._destination, Destination)
+			self._history = Defaultable(parent._history)
+			self._governor = Defaultable(parent._governor)
+			self._sshpool = Defaultable(parent._sshpool)
+			self._command = Defaultable(parent._command)
+			self._retrypolicy = Defaultable(parent._retrypolicy)
+		else:
+			self._destination = Defaultable(Destination(), Destination)
+			self._history = Defaultable(None)
+			self._governor = Defaultable(None)
+			self._sshpool = Defaultable(None)
+			self._command = Defaultable(('rdiff-backup',))
+			self._retrypolicy = Defaultable(None)
+
+	def child(self, source, destination):
+		"""
+		Return a new run based on this template for the host whose backups
+		are made from the given Source to the given Destination.
+		"""
+		raise NotImplementedError('has to be subclassed')
+
+	def start(self, capture=True):
+		"""
+		Start rdiff-backup with these settings and return a RunHandle without
+		waiting for it to finish.
+		
+		If capture is set, rdiff-backup's output will be available as events
+		from the handle. If not, it is passed through to this process' stdout
+		and stderr.
+		"""
+		cmdline = self.cmdline
+		if self.governor is not None:
+			self.governor.start()
+		for hook in self.hooks:
+			hook.prerun(self, cmdline)
+		started = time.time()
+		try:
+			return RunHandle(cmdline, capture, self._finished)
+		except Exception, e:
+			# Let the hooks see the end of the run they have seen start.
+			self._finished(RunResult(cmdline, None, started, time.time(), [],
+			                         error=e))
+			raise
+
+	def addhook(self, hook):
+		"""Add a RunHook to this instance."""
+		if not isinstance(hook, RunHook):
+			raise TypeError('hook has to be a RunHook')
+		self._hooks = list(self._hooks) + [hook]
+
+	def _finished(self, result):
+		"""
+		Called with the RunResult after rdiff-backup has exited.
+		"""
+		for hook in self.hooks:
+			if result.succeeded:
+				hook.postrun(self, result)
+			else:
+				hook.onerror(self, result)
+
+	def run(self, deadline=None):
+		"""
+		Run rdiff-backup with these settings.
+		
+		If deadline (in seconds since the epoch) is set and rdiff-backup is
+		still running then, it will be terminated, and killed if it does not
+		exit within 30 seconds. Always returns True. If rdiff-backup failed or
+		has been terminated, a CalledProcessError will be raised.
+		
+		If a retrypolicy is set, failed runs are retried as it decides,
+		unless the retry would start after the deadline. rdiff-backup's output
+		is then read by this process in order to classify failures, and
+		written to its stdout and stderr.
+		"""
+		policy = self.retrypolicy
+		attempt = 1
+		while True:
+			handle = self.start(policy is not None)
+			terminated = False
+			try:
+				while not handle.done:
+					remaining = None
+					if deadline is not None:
+						remaining = deadline - time.time()
+						if remaining <= 0:
+							handle.stop()
+							terminated = True
+							break
+					if not handle.fds:
+						# The output is not captured.
+						if remaining is None:
+							break
+						time.sleep(min(remaining, 1))
+						continue
+					for event in handle.poll(1):
+						if event.stream == 'stderr':
+							sys.stderr.write('%s\n' % event.line)
+						else:
+							sys.stdout.write('%s\n' % event.line)
+				result = handle.wait()
+			except:
+				# rdiff-backup runs in a session of its own, a Ctrl-C does not
+				# reach it.
+				handle.stop()
+				raise
+			if result.succeeded:
+				return True
+			delay = None
+			if policy is not None and not terminated:
+				delay = policy.retry(result, attempt)
+			if delay is None or \
+			   (deadline is not None and time.time() + delay >= deadline):
+				raise subprocess.CalledProcessError(result.returncode,
+				                                    result.cmdline)
+			time.sleep(delay)
+			attempt += 1
+
+
+
+class BackupRun(OptionRun):
+	"""
+	Defines options to an rdiff-backup backup-mode run and provides wrappers
+	around it.
+	"""
+
+	# These are the supported settings, grouped by type or default value.
+	(_schema, _defaultoptions) = _optionschema({
+	False: (
+		'create-full-path', 'force', 'never-drop-acls',
+		'override-chars-to-quote', 'preserve-numerical-ids',
+		'use-compatible-timestamps',),
+	True: (
+		'no-acls', 'no-compare-inode', 'no-compression', 'no-eas',
+		'no-file-statistics', 'no-hard-links', 'no-resource-forks',
+		'ssh-no-compression',),
+	Ternary: (
+		'carbonfile',),
+	str: (
+		'group-mapping-file', 'no-compression-regexp', 'remote-schema',
+		'remote-tempdir', 'tempdir', 'user-mapping-file',),
+	int: (
+		'terminal-verbosity', 'verbosity',),
+	})
+
+	def _getsource(self):
+		"""The source of the backup run."""
+		return self._source.value
+
+	def _setsource(self, value):
+		if not isinstance(value, Source):
+			raise TypeError('source has to be a Source')
+		self._source.defaulting = False
+		self._source.value = value
+
+	source = property(_getsource, _setsource)
+
+	def _getfilters(self):
+		"""The FilterSet of the backup run."""
+		return self._filters
+
+	def _setfilters(self, value):
+		if not isinstance(value, FilterSet):
+			raise TypeError('filters has to be a FilterSet')
+		self._filters = value
+
+	filters = property(_getfilters, _setfilters)
+
+	def _gethost(self):
+		"""
+		The name identifying this run's host in a RunHistory: the host name of
+		the source or, if the source is local, the destination path. Read-only.
+		"""
+		if self.source.host is not None:
+			return self.source.host
+		return self.destination.string
+
+	host = property(_gethost)
+
+	def _inherits(self):
+		"""
+		Return whether the command line of this instance is the parent's,
+		except for source and destination.
+		"""
+		filters = self._filters
+		parent = self._parent._filters
+		# The spill settings change the parameters of the same filters.
+		return OptionRun._inherits(self) and \
+		       filters._filters is parent._filters and \
+		       filters.spilldir == parent.spilldir and \
+		       filters.spillthreshold == parent.spillthreshold
+
+	def _getprefix(self):
+		"""
+		Return the command line without source and destination, i.e. the
+		command name, options and filters.
+		"""
+		parent = self._parent
+		if parent is not None and self._inherits():
+			return parent._getprefix()
+		r = OptionRun._getprefix(self)
+		r.extend(self.filters.params)
+		return r
+
+	def _getcmdline(self):
+		"""
+		A list of strings representing the command line.
+		
+		Command name, options, source and destination are included.
+		Read-only.
+		"""
+		r = self._getprefix()
+		r.append(str(self.source))
+		r.append(str(self.destination))
+		return r
+
+	cmdline = property(_getcmdline)
+
+	def __init__(self, parent=None):
+		"""
+		Create a new backup run, possibly based on the settings of another.
+		"""
+		if parent is not None and not isinstance(parent, BackupRun):
+			raise TypeError('parent has to be a BackupRun')
+		OptionRun.__init__(self, parent)
+		if parent:
+			self._source = Defaultable(parent._source, Source)
+			self._filters = parent.filters.copy()
+		else:
+			self._source = Defaultable(Source(), Source)
+			self._filters = FilterSet()
+
+	def estimate(self):
+		"""
+		Return a SelectionEstimate of the files this run would back up, by
+		evaluating its filters locally. Only works for local sources.
+		"""
+		if self.source.host is not None:
+			raise SettingCombinationError('cannot estimate a remote source')
+		return Selection(self.filters, self.source.string).estimate()
+
+	def child(self, source, destination):
+		"""
+		Return a new BackupRun based on this template, using the given Source
+		and Destination.
+		"""
+		r = BackupRun(self)
+		r.source = source
+		r.destination = destination
+		return r
+
+	def freeze(self):
+		"""
+		Return a FrozenBackupRun, an immutable snapshot of the current settings
+		of this instance, including those inherited from its parents.
+		"""
+		return FrozenBackupRun(self)
+
+	def _finished(self, result):
+		"""
+		Called with the RunResult after rdiff-backup has exited.
+		"""
+		OptionRun._finished(self, result)
+		if self.history is not None:
+			statistics = None
+			for s in self.destination.sessionstatistics(1):
+				# Only use statistics written by this run.
+				if s.time >= int(result.started):
+					statistics = s
+			self.history.record(self.host, self.destination.string, result,
+			                    statistics)
+
+
+
+class RemoveOlderRun(OptionRun):
+	"""
+	Defines options to an rdiff-backup run removing old increments from a
+	repository (--remove-older-than) and provides wrappers around it.
+	
+	The time to remove increments older than has to be set as removeolderthan,
+	in any format rdiff-backup accepts, for example "4W" or "20B".
+	"""
+
+	# These are the supported settings, grouped by type or default value.
+	(_schema, _defaultoptions) = _optionschema({
+	False: (
+		'force', 'use-compatible-timestamps',),
+	True: (
+		'ssh-no-compression',),
+	str: (
+		'remote-schema', 'remote-tempdir', 'remove-older-than', 'tempdir',),
+	int: (
+		'terminal-verbosity', 'verbosity',),
+	})
+
+	def _getcmdline(self):
+		"""
+		A list of strings representing the command line.
+		
+		Command name, options and destination are included. Read-only.
+		"""
+		if self.removeolderthan is None:
+			raise SettingCombinationError('removeolderthan is not set')
+		r = self._getprefix()
+		r.append(str(self.destination))
+		return r
+
+	cmdline = property(_getcmdline)
+
+	def __init__(self, parent=None):
+		"""
+		Create a new run, possibly based on the settings of another.
+		"""
+		if parent is not None and not isinstance(parent, RemoveOlderRun):
+			raise TypeError('parent has to be a RemoveOlderRun')
+		OptionRun.__init__(self, parent)
+
+	def child(self, source, destination):
+		"""
+		Return a new RemoveOlderRun based on this template, pruning the given
+		Destination.
+		"""
+		r = RemoveOlderRun(self)
+		r.destination = destination
+		return r
+
+
+
+class VerifyRun(OptionRun):
+	"""
+	Defines options to an rdiff-backup run verifying the files of a repository
+	against their stored checksums (--verify) and provides wrappers around it.
+	
+	If history is set, the result is recorded as a verification of host.
+	"""
+
+	# These are the supported settings, grouped by type or default value.
+	(_schema, _defaultoptions) = _optionschema({
+	False: (
+		'use-compatible-timestamps',),
+	True: (
+		'ssh-no-compression',),
+	str: (
+		'remote-schema', 'remote-tempdir', 'tempdir', 'verify-at-time',),
+	int: (
+		'terminal-verbosity', 'verbosity',),
+	})
+
+	def _gethost(self):
+		"""
+		The name identifying the verified host in a RunHistory.
+		
+		Not inherited. Defaults to the host of the destination or, if it is
+		local, the destination path. Set it to the host of the backups in the
+		repository, as child() does, to have verifications and backups of a
+		host recorded under the same name.
+		"""
+		if self._hostname is not None:
+			return self._hostname
+		return OptionRun._gethost(self)
+
+	def _sethost(self, value):
+		if not (isinstance(value, basestring) or value is None):
+			raise TypeError('host has to be a string or None')
+		self._hostname = value
+
+	host = property(_gethost, _sethost)
+
+	def _getcmdline(self):
+		"""
+		A list of strings representing the command line.
+		
+		Command name, options and destination are included. Read-only.
+		"""
+		r = self._getprefix()
+		if self.verifyattime is None:
+			r.append('--verify')
+		r.append(str(self.destination))
+		return r
+
+	cmdline = property(_getcmdline)
+
+	def __init__(self, parent=None):
+		"""
+		Create a new run, possibly based on the settings of another.
+		"""
+		if parent is not None and not isinstance(parent, VerifyRun):
+			raise TypeError('parent has to be a VerifyRun')
+		OptionRun.__init__(self, parent)
+		self._hostname = None
+
+	def child(self, source, destination):
+		"""
+		Return a new VerifyRun based on this template, verifying the given
+		Destination, which contains the backups of the given Source.
+		"""
+		r = VerifyRun(self)
+		r.destination = destination
+		if source.host is not None:
+			r.host = source.host
+		return r
+
+	def _finished(self, result):
+		"""
+		Called with the RunResult after rdiff-backup has exited.
+		"""
+		OptionRun._finished(self, result)
+		if self.history is not None:
+			self.history.recordverification(self.host,
+			                                self.destination.string, result)
+
+
+
+class RestoreRun(OptionRun):
+	"""
+	Defines options to an rdiff-backup run restoring a path from a repository
+	(--restore-as-of) and provides wrappers around it.
+	
+	The point in time to restore is set as restoreasof, in any format
+	rdiff-backup accepts, and defaults to the most recent backup. Use
+	restores() to create one run per path and add them to a BackupQueue to
+	restore them concurrently. With a verbosity of 5, rdiff-backup reports
+	each file it restores, which the queue passes to its listener.
+	"""
+
+	# These are the supported settings, grouped by type or default value.
+	(_schema, _defaultoptions) = _optionschema({
+	False: (
+		'force', 'never-drop-acls', 'preserve-numerical-ids',
+		'use-compatible-timestamps',),
+	True: (
+		'no-acls', 'no-eas', 'ssh-no-compression',),
+	str: (
+		'group-mapping-file', 'remote-schema', 'remote-tempdir',
+		'restore-as-of', 'tempdir', 'user-mapping-file',),
+	int: (
+		'terminal-verbosity', 'verbosity',),
+	})
+
+	def _getpath(self):
+		"""
+		The path to restore, relative to the repository. Copied from the parent
+		when created. Defaults to '', which means the whole repository.
+		"""
+		return self._path
+
+	def _setpath(self, value):
+		if not isinstance(value, basestring):
+			raise TypeError('path has to be a string')
+		self._path = value
+
+	path = property(_getpath, _setpath)
+
+	def _gettarget(self):
+		"""
+		The Source to restore the path to, usually below the Source of the
+		backups. Copied from the parent when created. Has to be set.
+		"""
+		return self._target
+
+	def _settarget(self, value):
+		if not (isinstance(value, Source) or value is None):
+			raise TypeError('target has to be a Source or None')
+		self._target = value
+
+	target = property(_gettarget, _settarget)
+
+	def _getcmdline(self):
+		"""
+		A list of strings representing the command line.
+		
+		Command name, options, the path in the repository and the target are
+		included. Read-only.
+		"""
+		if self.target is None:
+			raise SettingCombinationError('target is not set')
+		r = self._getprefix()
+		if self.restoreasof is None:
+			r.extend(['--restore-as-of', 'now'])
+		source = self.destination.string
+		if self.path.strip('/'):
+			source = '%s/%s' % (source.rstrip('/'), self.path.strip('/'))
+		r.append(source)
+		r.append(str(self.target))
+		return r
+
+	cmdline = property(_getcmdline)
+
+	def __init__(self, parent=None):
+		"""
+		Create a new run, possibly based on the settings of another.
+		"""
+		if parent is not None and not isinstance(parent, RestoreRun):
+			raise TypeError('parent has to be a RestoreRun')
+		OptionRun.__init__(self, parent)
+		if parent:
+			self._path = parent.path
+			self._target = parent.target
+		else:
+			self._path = ''
+			self._target = None
+
+	def _below(self, source, path):
+		"""Return a copy of the Source with path appended to its directory."""
+		directory = source.directory
+		if directory is None:
+			directory = source.defaultdir
+		return Source(os.path.join(directory, path.strip('/')), source.host,
+		              source.user)
+
+	def child(self, source, destination):
+		"""
+		Return a new RestoreRun based on this template, restoring path from the
+		given Destination to the same path below the given Source.
+		"""
+		r = RestoreRun(self)
+		r.destination = destination
+		r.target = self._below(source, self.path)
+		return r
+
+	def restores(self, destination, paths, target):
+		"""
+		Return a list of new RestoreRuns based on this template, one for each
+		of the paths in the repository at the given Destination. Each path is
+		restored to the same path below the given Source.
+		"""
+		r = []
+		for path in paths:
+			run = RestoreRun(self)
+			run.destination = destination
+			run.path = path
+			run.target = self._below(target, path)
+			r.append(run)
+		return r
+
+
+
+class FrozenBackupRun(BackupRun):
+	"""
+	An immutable snapshot of a BackupRun, to be used as a template.
+	
+	Do not create instances directly, use BackupRun.freeze() instead. The
+	command line without source and destination is computed only once, and
+	BackupRuns based on a frozen template that only set source and destination
+	reuse it. Trying to change any setting raises a FrozenError.
+	"""
+
+	def __setattr__(self, name, value):
+		"""Refuse to set any public attribute."""
+		if name[0] == '_':
+			return object.__setattr__(self, name, value)
+		raise FrozenError('cannot set %s of a frozen BackupRun' % name)
+
+	def __delattr__(self, name):
+		"""Refuse to delete any attribute."""
+		raise FrozenError('cannot delete %s of a frozen BackupRun' % name)
+
+	def __init__(self, template, prefix=None):
+		"""
+		Create a snapshot of the given BackupRun.
+		
+		If prefix is set, it is used as the command line without source and
+		destination instead of computing it, which is only correct if it has
+		been computed from the same settings before.
+		"""
+		BackupRun.__init__(self)
+		for (propertyname, name, type_) in self._schema:
+			o = template._option(propertyname)
+			if o is not self._defaultoptions[propertyname]:
+				c = Option(name, type_)
+				c.value = o.value
+				self._options[propertyname] = c
+		self._source = Defaultable(template.source, Source)
+		self._destination = Defaultable(template.destination, Destination)
+		self._history = Defaultable(template.history)
+		self._governor = Defaultable(template.governor)
+		self._sshpool = Defaultable(template.sshpool)
+		self._command = Defaultable(template.command)
+		self._retrypolicy = Defaultable(template.retrypolicy)
+		self._hooks = tuple(template.hooks)
+		self._filters = template.filters.freeze()
+		if prefix is None:
+			prefix = BackupRun._getprefix(self)
+		self._prefix = tuple(prefix)
+
+	def _getprefix(self):
+		"""Return the precompiled command line without source and destination."""
+		return list(self._prefix)
+
+	def addhook(self, hook):
+		"""Refuse to add a hook."""
+		raise FrozenError('cannot add hooks to a frozen BackupRun')
+
+	def freeze(self):
+		"""Return this instance, it is frozen already."""
+		return self
+
+	def commandline(self, source, destination):
+		"""
+		Return the command line for a run of this template with the given
+		Source and Destination.
+		"""
+		r = list(self._prefix)
+		r.append(str(source))
+		r.append(str(destination))
+		return r
+
+
+
+class Job(object):
+	"""
+	A single entry in a BackupQueue: the run to execute and, after it has been
+	executed, its outcome.
+	"""
+
+	def _getrun(self):
+		"""
+		The run to execute. Read-only.
+		
+		If the job has been created for a template, the run is created by the
+		template's child() method when it is first needed.
+		"""
+		if self._run is None:
+			self._run = self._template.child(self._source, self._destination)
+			self._template = self._source = self._destination = None
+		return self._run
+
+	run = property(_getrun)
+
+	def _getsucceeded(self):
+		"""
+		Whether the run finished with an exit code of zero. Read-only.
+		
+		Returns None if the job has not been executed (yet).
+		"""
+		if self.finished is None:
+			return None
+		return self.returncode == 0 and self.error is None
+
+	succeeded = property(_getsucceeded)
+
+	def _getelapsed(self):
+		"""
+		The wall-clock time in seconds the run took, or None if it has not
+		finished yet. Read-only.
+		"""
+		if self.started is None or self.finished is None:
+			return None
+		return self.finished - self.started
+
+	elapsed = property(_getelapsed)
+
+	def __init__(self, run, host=None, source=None, destination=None):
+		"""
+		Create a new job for the given run.
+		
+		host is a free-form label used for reporting. If it is not supplied,
+		the host of the run's source will be used, if there is one.
+		
+		If source and destination are supplied, run is a template and the run
+		to execute is its child for them, created only when it is needed.
+		"""
+		self._run = None
+		self._template = self._source = self._destination = None
+		if source is None and destination is None:
+			self._run = run
+			if host is None and isinstance(run, BackupRun):
+				host = run.source.host
+		else:
+			(self._template, self._source) = (run, source)
+			self._destination = destination
+			if host is None:
+				host = source.host
+		self.host = host
+		self.skipped = None
+		self.terminated = None
+		self.handle = None
+		self.result = None
+		self.returncode = None
+		self.error = None
+		self.started = None
+		self.finished = None
+		# The number of this attempt, the time it may be started at, if it is
+		# a retry, and the job retrying this one, if any.
+		self.attempt = 1
+		self.notbefore = None
+		self.retry = None
+		# The disk of the destination, once a queue with spread has needed it.
+		self.disk = None
+		# The time the process of a terminated job is killed if it is still
+		# running then.
+		self.killat = None
+
+	def _peek(self):
+		"""
+		Return the run, or the template it will be created from, and a list
+		of the Places the run connects to, without creating the run: source
+		and destination of a backup, repository and target of a restore and
+		the repository of other runs.
+		"""
+		if self._run is None:
+			run = self._template
+			# A restore's target is below the source.
+			(source, destination) = (self._source, self._destination)
+		else:
+			run = self._run
+			source = None
+			if isinstance(run, BackupRun):
+				source = run.source
+			elif isinstance(run, RestoreRun):
+				source = run.target
+			destination = run.destination
+		if isinstance(run, (BackupRun, RestoreRun)):
+			return (run, [source, destination])
+		return (run, [destination])
+
+	def __repr__(self):
+		if self.skipped is not None:
+			return '<Job %r: skipped, %s>' % (self.host, self.skipped)
+		if self.terminated is not None:
+			return '<Job %r: terminated, %s>' % (self.host, self.terminated)
+		return '<Job %r: %s>' % (self.host, {
+			None: 'pending', True: 'succeeded', False: 'failed',
+			}[self.succeeded])
+
+
+
+class Schedule(object):
+	"""
+	Decides which of the pending jobs of a BackupQueue are run, and in which
+	order.
+	
+	This class is not to be used directly. Instead, use one of the derived
+	classes or develop your own.
+	"""
+
+	def plan(self, jobs):
+		"""
+		Given a list of jobs, return a tuple of a list of those that should be
+		run, in the order they should be started in, and a dict mapping the
+		others to a short reason for skipping them.
+		
+		Implementations must neither change the jobs nor the state of the
+		schedule, so that a queue can be planned without running it.
+		"""
+		raise NotImplementedError('has to be subclassed')
+
+	def order(self, jobs):
+		"""
+		Called by BackupQueue.run() with the pending jobs. Return the list of
+		jobs to run, as planned, and set the skipped attribute of the others.
+		
+		Implementations keeping state for a run of the queue reset it here.
+		"""
+		(r, skipped) = self.plan(jobs)
+		for (job, reason) in skipped.iteritems():
+			job.skipped = reason
+		return r
+
+	def admit(self, job, now):
+		"""
+		Called right before a job is started. Return None to start it, or a
+		short reason to skip it instead.
+		"""
+		return None
+
+	def expired(self, job, now):
+		"""
+		Called repeatedly for each running job. Return None to let it run, or
+		a short reason to terminate it.
+		"""
+		return None
+
+	def finished(self, jobs):
+		"""
+		Called with all jobs passed to order() after those that have been
+		started are done.
+		"""
+
+
+
+class StalestFirst(Schedule):
+	"""
+	Schedule that starts the hosts which have been least recently backed up
+	first.
+	
+	The age of a host's last backup is read from the current_mirror marker in
+	its (local) Destination. Hosts without a readable repository are assumed
+	to have never been backed up and come first.
+	"""
+
+	def _getminage(self):
+		"""
+		If set, skip hosts that have been backed up less than this number of
+		seconds ago.
+		
+		Defaults to None, which means to consider all hosts.
+		"""
+		return self._minage
+
+	def _setminage(self, value):
+		if not (isinstance(value, (int, long, float)) or value is None):
+			raise TypeError('minage has to be a number or None')
+		self._minage = value
+
+	minage = property(_getminage, _setminage)
+
+	def _getlimit(self):
+		"""
+		If set, run only this number of the least recently backed up hosts.
+		
+		Defaults to None, which means no limit.
+		"""
+		return self._limit
+
+	def _setlimit(self, value):
+		if not (isinstance(value, int) or value is None):
+			raise TypeError('limit has to be an int or None')
+		self._limit = value
+
+	limit = property(_getlimit, _setlimit)
+
+	def __init__(self, minage=None, limit=None):
+		"""
+		Create a new schedule. You may supply minage and limit as a
+		convenience.
+		"""
+		self.minage = minage
+		self.limit = limit
+
+	def ages(self, jobs, now=None):
+		"""
+		Return a list of (age, job) tuples, age being the number of seconds
+		since the last successful backup of the job's destination, or None if
+		that is unknown.
+		"""
+		if now is None:
+			now = time.time()
+		r = []
+		for job in jobs:
+			last = job.run.destination.lastbackup
+			if last is None:
+				r.append((None, job))
+			else:
+				r.append((now - last, job))
+		return r
+
+	def plan(self, jobs):
+		"""
+		Return the jobs ordered by descending age of their last backup, leaving
+		out those not matching minage and limit.
+		"""
+		ages = self.ages(jobs)
+		# Unknown ages sort first. The index keeps the sort stable.
+		decorated = []
+		for (index, (age, job)) in enumerate(ages):
+			if age is None:
+				decorated.append((0, 0, index, job))
+			else:
+				decorated.append((1, -age, index, job))
+		decorated.sort()
+		r = []
+		skipped = {}
+		for (known, age, index, job) in decorated:
+			if self.minage is not None and known and -age < self.minage:
+				skipped[job] = 'backed up %d seconds ago' % -age
+			elif self.limit is not None and len(r) >= self.limit:
+				skipped[job] = 'over limit'
+			else:
+				r.append(job)
+		return (r, skipped)
+
+
+
+class Estimator(object):
+	"""
+	Estimates how long the job of a BackupQueue is going to take.
+	
+	The estimate is the average ElapsedTime of the last backups of the job's
+	host. It is taken from a RunHistory if one is set, else from the session
+	statistics in the job's (local) Destination. Hosts without any statistics
+	are assumed to take default seconds.
+	"""
+
+	def _getdefault(self):
+		"""
+		The estimate in seconds for hosts without statistics. Defaults to 3600.
+		"""
+		return self._default
+
+	def _setdefault(self, value):
+		if not isinstance(value, (int, long, float)):
+			raise TypeError('default has to be a number')
+		self._default = value
+
+	default = property(_getdefault, _setdefault)
+
+	def _getcount(self):
+		"""
+		The number of most recent backups to average over. Defaults to 3.
+		"""
+		return self._count
+
+	def _setcount(self, value):
+		if not isinstance(value, int) or value < 1:
+			raise TypeError('count has to be an int >= 1')
+		self._count = value
+
+	count = property(_getcount, _setcount)
+
+	def _gethistory(self):
+		"""
+		The RunHistory to read durations from.
+		
+		Defaults to None, which means to read the session statistics files.
+		"""
+		return self._history
+
+	def _sethistory(self, value):
+		if not (isinstance(value, RunHistory) or value is None):
+			raise TypeError('history has to be a RunHistory or None')
+		self._history = value
+
+	history = property(_gethistory, _sethistory)
+
+	def __init__(self, default=3600, count=3, history=None):
+		"""
+		Create a new estimator. You may supply default, count and history as a
+		convenience.
+		"""
+		self.default = default
+		self.count = count
+		self.history = history
+
+	def estimate(self, job):
+		"""Return the expected duration of a job in seconds."""
+		if self.history is not None:
+			durations = self.history.durations(job.run.host, self.count)
+		else:
+			durations = []
+			for s in job.run.destination.sessionstatistics(self.count):
+				if s.get('ElapsedTime') is not None:
+					durations.append(s['ElapsedTime'])
+		if not durations:
+			return self.default
+		return sum(durations) / float(len(durations))
+
+	def makespan(self, jobs, workers):
+		"""
+		Return the predicted number of seconds it takes to run the jobs, in the
+		given order, with the given number of concurrent workers.
+		"""
+		slots = [0.0] * min(workers, len(jobs))
+		for job in jobs:
+			# Each job is started by the worker that becomes free first.
+			t = heapq.heappop(slots)
+			heapq.heappush(slots, t + self.estimate(job))
+		if not slots:
+			return 0.0
+		return max(slots)
+
+
+
+class LongestFirst(Schedule):
+	"""
+	Schedule that starts the jobs that are expected to take longest first.
+	
+	Running long jobs first keeps a single long job from starting last and
+	delaying the end of the whole queue. Durations are estimated by an
+	Estimator.
+	"""
+
+	def _getestimator(self):
+		"""
+		The Estimator to use. Defaults to an Estimator with default settings.
+		"""
+		return self._estimator
+
+	def _setestimator(self, value):
+		if not isinstance(value, Estimator):
+			raise TypeError('estimator has to be an Estimator')
+		self._estimator = value
+
+	estimator = property(_getestimator, _setestimator)
+
+	def __init__(self, estimator=None):
+		"""
+		Create a new schedule. You may supply estimator as a convenience.
+		"""
+		if estimator is None:
+			estimator = Estimator()
+		self.estimator = estimator
+
+	def plan(self, jobs):
+		"""Return all jobs, ordered by descending expected duration."""
+		decorated = []
+		for (index, job) in enumerate(jobs):
+			# The index keeps the sort stable.
+			decorated.append((-self.estimator.estimate(job), index, job))
+		decorated.sort()
+		return ([job for (duration, index, job) in decorated], {})
+
+
+
+class Window(Schedule):
+	"""
+	Schedule that only runs the jobs that are expected to finish before a
+	deadline, for example the end of the nightly backup window.
+	
+	A job is only started if it is estimated to finish before the deadline;
+	jobs still running at the deadline are terminated, and killed if they do
+	not exit shortly after. The hosts of these jobs are deferred: if
+	deferfile is set, they are written into it, and the next run of the
+	window starts with them. Within the deferred and the other jobs, another
+	schedule decides the order.
+	"""
+
+	def _getdeadline(self):
+		"""
+		The end of the window: either seconds since the epoch, or a string
+		"HH:MM", meaning HH:MM local time on the day the queue starts. See
+		start for windows spanning midnight.
+		"""
+		return self._deadline
+
+	def _setdeadline(self, value):
+		if isinstance(value, basestring):
+			if not re.match(r'^\d{1,2}:\d\d$', value):
+				raise ValueError('deadline has to be in the format HH:MM')
+		elif not isinstance(value, (int, long, float)):
+			raise TypeError('deadline has to be a number or a string')
+		self._deadline = value
+
+	deadline = property(_getdeadline, _setdeadline)
+
+	def _getstart(self):
+		"""
+		The beginning of the window as a string "HH:MM" local time, only used
+		with a deadline given as "HH:MM".
+		
+		If it is later in the day than the deadline, the window spans
+		midnight: a queue starting after start ends at the deadline on the
+		next day. A queue starting after the deadline, but before start, is
+		outside of the window and runs nothing.
+		
+		Defaults to None, which means that the window ends at the deadline on
+		the day the queue starts.
+		"""
+		return self._start
+
+	def _setstart(self, value):
+		if isinstance(value, basestring):
+			if not re.match(r'^\d{1,2}:\d\d$', value):
+				raise ValueError('start has to be in the format HH:MM')
+		elif value is not None:
+			raise TypeError('start has to be a string or None')
+		self._start = value
+
+	start = property(_getstart, _setstart)
+
+	def _getestimator(self):
+		"""
+		The Estimator to use. Defaults to an Estimator with default settings.
+		"""
+		return self._estimator
+
+	def _setestimator(self, value):
+		if not isinstance(value, Estimator):
+			raise TypeError('estimator has to be an Estimator')
+		self._estimator = value
+
+	estimator = property(_getestimator, _setestimator)
+
+	def _getschedule(self):
+		"""
+		The Schedule deciding the order of the jobs. Jobs it leaves out are
+		skipped, but not deferred.
+		
+		Defaults to None, which means to use LongestFirst with this window's
+		estimator.
+		"""
+		return self._schedule
+
+	def _setschedule(self, value):
+		if not (isinstance(value, Schedule) or value is None):
+			raise TypeError('schedule has to be a Schedule or None')
+		self._schedule = value
+
+	schedule = property(_getschedule, _setschedule)
+
+	def _getdeferfile(self):
+		"""
+		The path of the file to record the deferred hosts in, one per line.
+		
+		Defaults to None, which means not to remember deferred hosts.
+		"""
+		return self._deferfile
+
+	def _setdeferfile(self, value):
+		if not (isinstance(value, basestring) or value is None):
+			raise TypeError('deferfile has to be a string or None')
+		self._deferfile = value
+
+	deferfile = property(_getdeferfile, _setdeferfile)
+
+	def __init__(self, deadline, estimator=None, schedule=None,
+	             deferfile=None, start=None):
+		"""
+		Create a new window ending at deadline. You may supply estimator,
+		schedule, deferfile and start as a convenience.
+		"""
+		if estimator is None:
+			estimator = Estimator()
+		self.deadline = deadline
+		self.start = start
+		self.estimator = estimator
+		self.schedule = schedule
+		self.deferfile = deferfile
+		self._end = None
+		self._deferred = []
+
+	def end(self, now=None):
+		"""
+		Return the deadline in seconds since the epoch, as seen at now. It is
+		in the past if now is after the window.
+		"""
+		if not isinstance(self.deadline, basestring):
+			return self.deadline
+		if now is None:
+			now = time.time()
+		(hour, minute) = [int(x) for x in self.deadline.split(':')]
+		t = time.localtime(now)
+		r = time.mktime((t[0], t[1], t[2], hour, minute, 0, 0, 0, -1))
+		if r > now or self.start is None:
+			return r
+		(starthour, startminute) = [int(x) for x in self.start.split(':')]
+		begin = time.mktime((t[0], t[1], t[2], starthour, startminute, 0, 0,
+		                     0, -1))
+		if (starthour, startminute) > (hour, minute) and begin <= now:
+			# The window spans midnight and has begun today. mktime()
+			# normalizes the day after the last one of a month.
+			r = time.mktime((t[0], t[1], t[2] + 1, hour, minute, 0, 0, 0, -1))
+		return r
+
+	def deferred(self):
+		"""
+		Return the list of hosts recorded in deferfile by the last run.
+		"""
+		if self.deferfile is None:
+			return []
+		try:
+			f = open(self.deferfile)
+		except IOError, e:
+			if e.errno == errno.ENOENT:
+				return []
+			raise e
+		try:
+			return [line.strip() for line in f if line.strip()]
+		finally:
+			f.close()
+
+	def plan(self, jobs):
+		"""
+		Return the jobs in the order of schedule, those of deferred hosts
+		first.
+		"""
+		schedule = self.schedule
+		if schedule is None:
+			schedule = LongestFirst(self.estimator)
+		(jobs, skipped) = schedule.plan(jobs)
+		deferred = dict.fromkeys(self.deferred())
+		first = []
+		rest = []
+		for job in jobs:
+			if job.run.host in deferred:
+				first.append(job)
+			else:
+				rest.append(job)
+		return (first + rest, skipped)
+
+	def order(self, jobs):
+		"""Fix the deadline for this run and return the planned jobs."""
+		self._end = self.end()
+		self._deferred = []
+		return Schedule.order(self, jobs)
+
+	def admit(self, job, now):
+		"""
+		Refuse to start the job if it would not finish before the deadline.
+		"""
+		if self._end is None:
+			self._end = self.end(now)
+		if now + self.estimator.estimate(job) > self._end:
+			self._deferred.append(job)
+			return 'would not finish before deadline'
+		return None
+
+	def expired(self, job, now):
+		"""Terminate the job if the deadline has passed."""
+		if self._end is not None and now >= self._end:
+			self._deferred.append(job)
+			return 'deadline reached'
+		return None
+
+	def finished(self, jobs):
+		"""Write the hosts of the deferred jobs into deferfile."""
+		if self.deferfile is None:
+			return
+		# Write to a temporary file first so that a crash does not lose the
+		# hosts deferred last time.
+		tmp = '%s.%d.tmp' % (self.deferfile, os.getpid())
+		f = open(tmp, 'w')
+		try:
+			for job in self._deferred:
+				f.write('%s\n' % job.run.host)
+		finally:
+			f.close()
+		os.rename(tmp, self.deferfile)
+
+
+
+class VerifyRotation(Schedule):
+	"""
+	Schedule that verifies a rotating sample of hosts, so that all of them are
+	verified once every days runs of the queue.
+	
+	Each run, the hosts that have least recently been verified successfully
+	according to the history are chosen, never verified ones first. The
+	sample has 1/days of the hosts, rounded up, or limit hosts if that is
+	less. If budget is set, jobs are neither started nor kept running after
+	that many seconds; hosts whose verification did not finish remain at the
+	front of the rotation.
+	"""
+
+	def _gethistory(self):
+		"""The RunHistory the verifications are recorded in."""
+		return self._history
+
+	def _sethistory(self, value):
+		if not isinstance(value, RunHistory):
+			raise TypeError('history has to be a RunHistory')
+		self._history = value
+
+	history = property(_gethistory, _sethistory)
+
+	def _getdays(self):
+		"""
+		The number of runs after which all hosts have been verified. Defaults
+		to 7.
+		"""
+		return self._days
+
+	def _setdays(self, value):
+		if not isinstance(value, int) or value < 1:
+			raise TypeError('days has to be an int >= 1')
+		self._days = value
+
+	days = property(_getdays, _setdays)
+
+	def _getlimit(self):
+		"""
+		If set, verify at most this number of hosts per run.
+		
+		Defaults to None, which means no limit besides the rotation.
+		"""
+		return self._limit
+
+	def _setlimit(self, value):
+		if not ((isinstance(value, int) and value >= 1) or value is None):
+			raise TypeError('limit has to be an int >= 1 or None')
+		self._limit = value
+
+	limit = property(_getlimit, _setlimit)
+
+	def _getbudget(self):
+		"""
+		The number of seconds the verifications of a run may take.
+		
+		Defaults to None, which means no limit.
+		"""
+		return self._budget
+
+	def _setbudget(self, value):
+		if not (isinstance(value, (int, long, float)) or value is None):
+			raise TypeError('budget has to be a number or None')
+		self._budget = value
+
+	budget = property(_getbudget, _setbudget)
+
+	def __init__(self, history, days=7, limit=None, budget=None):
+		"""
+		Create a new rotation based on history. You may supply days, limit
+		and budget as a convenience.
+		"""
+		self.history = history
+		self.days = days
+		self.limit = limit
+		self.budget = budget
+		self._end = None
+
+	def plan(self, jobs):
+		"""
+		Return the sample of the jobs to verify this time, least recently
+		verified first.
+		"""
+		decorated = []
+		for (index, job) in enumerate(jobs):
+			last = self.history.lastverified(job.run.host)
+			# Hosts never verified sort first. The index keeps the sort stable.
+			decorated.append((last is not None, last, index, job))
+		decorated.sort()
+		size = -(-len(jobs) // self.days)
+		if self.limit is not None:
+			size = min(size, self.limit)
+		r = []
+		skipped = {}
+		for (known, last, index, job) in decorated:
+			if len(r) < size:
+				r.append(job)
+			else:
+				skipped[job] = 'not in this sample'
+		return (r, skipped)
+
+	def order(self, jobs):
+		"""Start the budget for this run and return the planned jobs."""
+		self._end = None
+		if self.budget is not None:
+			self._end = time.time() + self.budget
+		return Schedule.order(self, jobs)
+
+	def admit(self, job, now):
+		"""Refuse to start the job if the budget has been used up."""
+		if self._end is not None and now >= self._end:
+			return 'budget exhausted'
+		return None
+
+	def expired(self, job, now):
+		"""Terminate the job if the budget has been used up."""
+		if self._end is not None and now >= self._end:
+			return 'budget exhausted'
+		return None
+
+
+
+class BackupQueue(object):
+	"""
+	Executes a number of BackupRuns with a bounded number of concurrent
+	rdiff-backup processes.
+	
+	All processes are started and watched from the thread calling run(); their
+	output is read without blocking. A failing run does not abort the queue;
+	its exit code or exception is recorded in its Job instead.
+	
+	If the run of a failed job has a retrypolicy, a new job retrying it is
+	added when the policy decides so. It waits for its delay in the pending
+	list, without taking up a worker.
+	"""
+
+	_grace = 30
+	"""Seconds a terminated job may take to exit before it is killed."""
+
+	def _getworkers(self):
+		"""
+		The maximum number of rdiff-backup processes to run concurrently.
+		
+		Has to be an int of at least 1. Defaults to 4.
+		"""
+		return self._workers
+
+	def _setworkers(self, value):
+		if not isinstance(value, int) or value < 1:
+			raise TypeError('workers has to be an int >= 1')
+		self._workers = value
+
+	workers = property(_getworkers, _setworkers)
+
+	def _getlistener(self):
+		"""
+		A callable that will be called with a Job and a RunEvent for every line
+		of output of a running job.
+		
+		Defaults to None, which means that output is discarded. The last lines
+		of each job's output are always available in its result.
+		"""
+		return self._listener
+
+	def _setlistener(self, value):
+		if not (callable(value) or value is None):
+			raise TypeError('listener has to be callable or None')
+		self._listener = value
+
+	listener = property(_getlistener, _setlistener)
+
+	def _getjobs(self):
+		"""
+		A list of all jobs that have been added to this queue, in the order they
+		have been added. Read-only.
+		"""
+		return list(self._jobs)
+
+	jobs = property(_getjobs)
+
+	def _getschedule(self):
+		"""
+		The Schedule deciding which pending jobs are run in which order.
+		
+		Defaults to None, which means to run all jobs in the order they have
+		been added.
+		"""
+		return self._schedule
+
+	def _setschedule(self, value):
+		if not (isinstance(value, Schedule) or value is None):
+			raise TypeError('schedule has to be a Schedule or None')
+		self._schedule = value
+
+	schedule = property(_getschedule, _setschedule)
+
+	def _getlocks(self):
+		"""
+		A LockRegistry used to lock each job's destination while it is running.
+		
+		Jobs whose destination is locked by another thread or process are
+		skipped. Defaults to None, which means not to lock.
+		"""
+		return self._locks
+
+	def _setlocks(self, value):
+		if not (isinstance(value, LockRegistry) or value is None):
+			raise TypeError('locks has to be a LockRegistry or None')
+		self._locks = value
+
+	locks = property(_getlocks, _setlocks)
+
+	def _getprune(self):
+		"""
+		A RemoveOlderRun template to prune each destination with after it has
+		been backed up successfully.
+		
+		The prune of a destination is started right after its backup, before
+		any other pending job, while the repository's metadata is still
+		cached. Each destination is pruned only once per run() of the queue.
+		Prunes are neither refused nor terminated by the schedule. Defaults
+		to None, which means not to prune.
+		"""
+		return self._prune
+
+	def _setprune(self, value):
+		if not (isinstance(value, RemoveOlderRun) or value is None):
+			raise TypeError('prune has to be a RemoveOlderRun or None')
+		self._prune = value
+
+	prune = property(_getprune, _setprune)
+
+	def _getspread(self):
+		"""
+		If set, run at most this number of jobs per repository disk at the
+		same time, starting pending jobs on other disks first, so that
+		concurrent jobs do not compete for a disk.
+		
+		The disk of a local destination is its device, that of a remote one
+		its host. Defaults to None, which means not to take disks into
+		account.
+		"""
+		return self._spread
+
+	def _setspread(self, value):
+		if not ((isinstance(value, int) and value >= 1) or value is None):
+			raise TypeError('spread has to be an int >= 1 or None')
+		self._spread = value
+
+	spread = property(_getspread, _setspread)
+
+	def _getbreaker(self):
+		"""
+		A CircuitBreaker recording the outcome of each job except prunes, keyed
+		by the host of its run. Jobs of hosts whose circuit is open are
+		skipped.
+		
+		Defaults to None, which means to start the jobs of all hosts.
+		"""
+		return self._breaker
+
+	def _setbreaker(self, value):
+		if not (isinstance(value, CircuitBreaker) or value is None):
+			raise TypeError('breaker has to be a CircuitBreaker or None')
+		self._breaker = value
+
+	breaker = property(_getbreaker, _setbreaker)
+
+	def __init__(self, workers=4, schedule=None, locks=None, listener=None,
+	             prune=None, spread=None, breaker=None):
+		"""
+		Create a new, empty queue that will use at most workers concurrent
+		rdiff-backup processes.
+		
+		You may supply schedule, locks, listener, prune, spread and breaker as
+		a convenience.
+		"""
+		self.workers = workers
+		self.schedule = schedule
+		self.locks = locks
+		self.listener = listener
+		self.prune = prune
+		self.spread = spread
+		self.breaker = breaker
+		self._pruned = {}
+		self._jobs = []
+		self._pending = []
+		# Map each disk to the number of pending jobs on it, or None if the
+		# disks of the pending jobs have not been determined yet, see spread.
+		self._diskcount = None
+		self._running = []
+		# The jobs passed to the schedule at the beginning of the current
+		# cycle, or None if there is none, see step().
+		self._cycle = None
+		# Map each SSHMasterPool to a dict mapping the hosts opened this cycle
+		# to the time they have last been opened or checked.
+		self._pools = {}
+		# The thread opening SSH masters in the background, if any.
+		self._opener = None
+		self._condition = threading.Condition()
+
+	def _getrunning(self):
+		"""A list of the jobs running right now. Read-only."""
+		return list(self._running)
+
+	running = property(_getrunning)
+
+	def __len__(self):
+		"""Return the number of jobs that have not been started yet."""
+		return len(self._pending)
+
+	def predict(self, estimator=None):
+		"""
+		Return the predicted number of seconds it takes to run the pending
+		jobs in the order the schedule would start them. Jobs the schedule
+		would skip are not counted.
+		
+		Durations are estimated by estimator. If it is not supplied, the
+		schedule's estimator is used if it has one, else an Estimator with
+		default settings.
+		"""
+		jobs = list(self._pending)
+		if self.schedule is not None:
+			(jobs, skipped) = self.schedule.plan(jobs)
+		if estimator is None:
+			estimator = getattr(self.schedule, 'estimator', None) or Estimator()
+		return estimator.makespan(jobs, self.workers)
+
+	def add(self, run, host=None):
+		"""
+		Add a run, usually a BackupRun, to the queue and return the Job
+		representing it.
+		
+		See Job for the meaning of host.
+		"""
+		if not isinstance(run, OptionRun):
+			raise TypeError('run has to be an OptionRun')
+		job = Job(run, host)
+		self._condition.acquire()
+		try:
+			self._jobs.append(job)
+			self._pending.append(job)
+			self._counted(job)
+		finally:
+			self._condition.release()
+		return job
+
+	def addhosts(self, hosts, generator, template):
+		"""
+		Add one job per host, each running the child of the template run for
+		the Source and Destination the SDGenerator creates for that host.
+		hosts may be any iterable, for example an Inventory.
+		
+		The children are only created by the template's child() method when
+		they are needed, usually when the job is started, so that adding large
+		fleets is cheap. Return the list of added jobs.
+		"""
+		if not isinstance(generator, SDGenerator):
+			raise TypeError('generator has to be an SDGenerator')
+		if not isinstance(template, OptionRun):
+			raise TypeError('template has to be an OptionRun')
+		r = [Job(template, host, source, destination)
+		     for (host, source, destination) in generator.generateall(hosts)]
+		self._condition.acquire()
+		try:
+			self._jobs.extend(r)
+			self._pending.extend(r)
+			# Their disks are unknown until their runs have been created.
+			self._diskcount = None
+		finally:
+			self._condition.release()
+		return r
+
+	def _openpools(self):
+		"""
+		Open the SSH master connections to the remote hosts of the next
+		workers pending jobs in a background thread, so that neither the
+		connections nor unreachable hosts hold up the running jobs. Masters
+		that have not been checked for half their persist time are checked
+		and, if they have expired, opened again.
+		
+		Jobs started before their master is open connect the usual way.
+		"""
+		if self._opener is not None and self._opener.isAlive():
+			return
+		now = time.time()
+		self._condition.acquire()
+		try:
+			jobs = []
+			for job in self._pending:
+				if len(jobs) >= self.workers:
+					break
+				if job.notbefore is None or job.notbefore <= now:
+					jobs.append(job)
+		finally:
+			self._condition.release()
+		new = {}
+		for job in jobs:
+			(run, places) = job._peek()
+			if run.sshpool is None:
+				continue
+			for place in places:
+				if place is None or place.host is None:
+					continue
+				spec = place.host
+				if place.user is not None:
+					spec = '%s@%s' % (place.user, place.host)
+				opened = self._pools.setdefault(run.sshpool, {})
+				if now - opened.get(spec, 0) >= run.sshpool.persist / 2.0:
+					opened[spec] = now
+					new.setdefault(run.sshpool, []).append(spec)
+		if not new:
+			return
+		self._opener = threading.Thread(target=self._open, args=(new,),
+		                                name='BackupQueue opener')
+		self._opener.setDaemon(True)
+		self._opener.start()
+
+	def _open(self, new):
+		"""Open the masters to the hosts of a dict mapping pools to hosts."""
+		for (pool, specs) in new.iteritems():
+			pool.open(specs)
+
+	def _closepools(self):
+		"""Close the SSH master connections opened this cycle."""
+		if self._opener is not None:
+			# It takes at most the pools' connecttimeout.
+			self._opener.join()
+			self._opener = None
+		pools = self._pools
+		self._pools = {}
+		for (pool, specs) in pools.iteritems():
+			pool.close(specs.keys())
+
+	def _disk(self, job):
+		"""
+		Return a key identifying the disk of the job's destination, see spread.
+		
+		The key is determined only once per job and kept in its disk
+		attribute, so that pending jobs are not stat()ed over and over.
+		"""
+		if job.disk is not None:
+			return job.disk
+		destination = job.run.destination
+		if destination.host is not None:
+			job.disk = destination.host
+			return job.disk
+		path = os.path.abspath(destination.string)
+		while True:
+			try:
+				job.disk = os.stat(path).st_dev
+				return job.disk
+			except OSError:
+				# The repository does not exist yet, use its parent's disk.
+				parent = os.path.dirname(path)
+				if parent == path:
+					return None
+				path = parent
+
+	def _next(self, running=()):
+		"""
+		Remove the next job that may be started next to the running ones from
+		the pending list and return it. Retries are not started before their
+		delay is over.
+		
+		Return None if there are no such jobs left.
+		"""
+		now = time.time()
+		self._condition.acquire()
+		try:
+			if not self._pending:
+				return None
+			busy = {}
+			if self.spread is not None:
+				for job in running:
+					disk = self._disk(job)
+					busy[disk] = busy.get(disk, 0) + 1
+				if self._diskcount is None:
+					counts = {}
+					for job in self._pending:
+						disk = self._disk(job)
+						counts[disk] = counts.get(disk, 0) + 1
+					self._diskcount = counts
+				# Stop right away if all pending jobs are on busy disks,
+				# instead of scanning them each time a worker is free.
+				for (disk, count) in self._diskcount.iteritems():
+					if count and busy.get(disk, 0) < self.spread:
+						break
+				else:
+					return None
+			for (index, job) in enumerate(self._pending):
+				if job.notbefore is not None and job.notbefore > now:
+					# A retry still waiting for its delay.
+					continue
+				if self.spread is None:
+					self._diskcount = None
+					return self._pending.pop(index)
+				disk = self._disk(job)
+				if busy.get(disk, 0) < self.spread:
+					self._diskcount[disk] -= 1
+					return self._pending.pop(index)
+			return None
+		finally:
+			self._condition.release()
+
+	def _counted(self, job):
+		"""
+		Count a job that has been added to the pending ones on its disk, if
+		the disks are being counted. Call with _condition acquired.
+		"""
+		if self._diskcount is None:
+			return
+		if job.disk is None:
+			# Determined when needed.
+			self._diskcount = None
+			return
+		self._diskcount[job.disk] = self._diskcount.get(job.disk, 0) + 1
+
+	def _start(self, job):
+		"""
+		Start a job, recording an error instead of raising.
+		
+		Return whether the job is running now.
+		"""
+		if self._scheduled(job):
+			reason = self.schedule.admit(job, time.time())
+			if reason is not None:
+				job.skipped = reason
+				return False
+		if self.locks is not None:
+			try:
+				self.locks.lock(job.run.destination.string)
+			except Locker.AcquireError:
+				job.skipped = 'destination is locked'
+				return False
+		# Ask last, allow() lets only a single run through a circuit whose
+		# cooldown is over.
+		if self._guarded(job) and \
+		   not self.breaker.allow(job.run.host, time.time()):
+			job.skipped = 'circuit open'
+			if self.locks is not None:
+				self.locks.unlock(job.run.destination.string)
+			return False
+		job.started = time.time()
+		try:
+			job.handle = job.run.start()
+		except Exception, e:
+			job.error = e
+			self._finish(job)
+			return False
+		return True
+
+	def _finish(self, job):
+		"""
+		Record the outcome of a job that has been started and release its lock.
+		"""
+		if job.handle is not None:
+			job.result = job.handle.wait()
+			job.returncode = job.result.returncode
+		job.finished = time.time()
+		if self.locks is not None:
+			self.locks.unlock(job.run.destination.string)
+		if self.prune is not None and job.succeeded and \
+		   isinstance(job.run, BackupRun):
+			self._addprune(job)
+		if job.result is not None and job.terminated is None:
+			if self._guarded(job):
+				self.breaker.record(job.run.host, job.succeeded, job.finished)
+			if not job.succeeded:
+				self._addretry(job)
+
+	def _scheduled(self, job):
+		"""
+		Return whether the schedule decides if a job may start or keep
+		running. Prunes are exempt: they are short, and schedules estimate
+		and defer jobs by the host of a backup, which a prune does not have.
+		"""
+		return self.schedule is not None and \
+		       not isinstance(job.run, RemoveOlderRun)
+
+	def _guarded(self, job):
+		"""
+		Return whether a job is subject to the breaker. Prunes are not, they
+		do not connect to the host.
+		"""
+		return self.breaker is not None and \
+		       not isinstance(job.run, RemoveOlderRun)
+
+	def _addretry(self, job):
+		"""
+		Add a job retrying a failed one to the pending ones if the retrypolicy
+		of its run decides so.
+		"""
+		policy = job.run.retrypolicy
+		if policy is None:
+			return
+		delay = policy.retry(job.result, job.attempt)
+		if delay is None:
+			return
+		retry = Job(job.run, job.host)
+		retry.attempt = job.attempt + 1
+		retry.notbefore = job.finished + delay
+		retry.disk = job.disk
+		job.retry = retry
+		self._condition.acquire()
+		try:
+			self._jobs.append(retry)
+			self._pending.append(retry)
+			self._counted(retry)
+		finally:
+			self._condition.release()
+
+	def _addprune(self, job):
+		"""
+		Add a job pruning the destination of a finished backup job in front of
+		the pending ones, unless that destination has been pruned already.
+		"""
+		destination = job.run.destination
+		if destination.string in self._pruned:
+			return
+		self._pruned[destination.string] = True
+		prune = Job(self.prune.child(job.run.source, destination), job.host)
+		prune.disk = job.disk
+		self._condition.acquire()
+		try:
+			self._jobs.append(prune)
+			self._pending.insert(0, prune)
+			self._counted(prune)
+		finally:
+			self._condition.release()
+
+	def purge(self):
+		"""
+		Remove the jobs that have finished or have been skipped from jobs and
+		return them, so that a queue jobs are added to indefinitely does not
+		grow. Destinations whose prune has been purged may be pruned again.
+		"""
+		self._condition.acquire()
+		try:
+			keep = []
+			r = []
+			for job in self._jobs:
+				if job.finished is None and job.skipped is None:
+					keep.append(job)
+					continue
+				r.append(job)
+				if isinstance(job.run, RemoveOlderRun):
+					self._pruned.pop(job.run.destination.string, None)
+			self._jobs = keep
+			return r
+		finally:
+			self._condition.release()
+
+	def cancel(self, reason='cancelled'):
+		"""
+		Remove all pending jobs from the queue, marking them as skipped for
+		the given reason, and return them.
+		"""
+		self._condition.acquire()
+		try:
+			r = self._pending
+			self._pending = []
+			self._diskcount = None
+		finally:
+			self._condition.release()
+		for job in r:
+			job.skipped = reason
+		return r
+
+	def waiting(self):
+		"""
+		Return the number of seconds until the earliest pending retry may be
+		started, 0 if other jobs are pending, or None if none are.
+		"""
+		now = time.time()
+		self._condition.acquire()
+		try:
+			r = None
+			for job in self._pending:
+				wait = max((job.notbefore or now) - now, 0)
+				if r is None or wait < r:
+					r = wait
+			return r
+		finally:
+			self._condition.release()
+
+	def _fill(self, running, started):
+		"""
+		Start pending jobs until workers jobs are running or no more can be
+		started. Append the jobs to the running list if they are running now
+		and to the started list in any case.
+		"""
+		while len(running) < self.workers:
+			job = self._next(running)
+			if job is None:
+				break
+			started.append(job)
+			if self._start(job):
+				running.append(job)
+		self._openpools()
+
+	def _pump(self, running):
+		"""
+		Wait a short while for output of the running jobs and pass it to the
+		listener. Terminate the jobs the schedule says have expired.
+		
+		Return the list of jobs still running afterwards.
+		"""
+		fds = {}
+		timeout = 1
+		for job in running:
+			if not job.handle.fds:
+				# Output is complete, but the process has not exited yet.
+				timeout = 0.05
+			for fd in job.handle.fds:
+				fds[fd] = job
+		if fds:
+			(ready, w, x) = select.select(fds.keys(), [], [], timeout)
+			for fd in ready:
+				job = fds[fd]
+				for event in job.handle.read(fd):
+					if self.listener is not None:
+						self.listener(job, event)
+		else:
+			time.sleep(timeout)
+		now = time.time()
+		r = []
+		for job in running:
+			if job.handle.done:
+				self._finish(job)
+				continue
+			if self._scheduled(job) and job.terminated is None:
+				reason = self.schedule.expired(job, now)
+				if reason is not None:
+					job.terminated = reason
+					job.killat = now + self._grace
+					job.handle.terminate()
+			elif job.killat is not None and now >= job.killat:
+				# It does not react to SIGTERM.
+				job.handle.terminate(signal.SIGKILL)
+				job.killat = None
+			r.append(job)
+		return r
+
+	def _stop(self, running, reason):
+		"""
+		Terminate the jobs of the running list that have not finished yet for
+		the given reason, wait for them to exit, killing those that take
+		longer than the grace period, and record their outcome.
+		"""
+		for job in running:
+			if job.finished is None:
+				if job.terminated is None:
+					job.terminated = reason
+				job.handle.terminate()
+		end = time.time() + self._grace
+		for job in running:
+			if job.finished is None:
+				job.handle.stop(max(end - time.time(), 0))
+				self._finish(job)
+
+	def _begincycle(self):
+		"""
+		Let the schedule order the pending jobs, which resets its state, and
+		start opening the SSH masters of the first ones. Return the jobs the
+		schedule has left out; it has marked them as skipped.
+		"""
+		self._condition.acquire()
+		try:
+			self._cycle = list(self._pending)
+			skipped = []
+			if self.schedule is not None:
+				self._pending = self.schedule.order(self._pending)
+				# It may have left out jobs.
+				self._diskcount = None
+				kept = dict.fromkeys([id(job) for job in self._pending])
+				skipped = [job for job in self._cycle if id(job) not in kept]
+		finally:
+			self._condition.release()
+		self._pruned = {}
+		self._openpools()
+		return skipped
+
+	def _endcycle(self):
+		"""Close the SSH masters and tell the schedule the cycle is over."""
+		cycle = self._cycle
+		self._cycle = None
+		try:
+			self._closepools()
+		finally:
+			if self.schedule is not None:
+				self.schedule.finished(cycle)
+
+	def step(self):
+		"""
+		Do a share of the work of run(): start pending jobs on free workers
+		and wait up to a second for output of the running ones. Return the
+		jobs that have finished or have been skipped meanwhile.
+		
+		This lets callers like Daemon run the queue alongside other work and
+		add jobs to it while it runs. The first step after the queue has been
+		idle begins a cycle like run() does: the schedule orders the pending
+		jobs and SSH masters are opened. Jobs added during a cycle are started
+		in the order they have been added. Once no jobs are running or
+		pending, the cycle ends: the masters are closed and the schedule's
+		finished() is called.
+		"""
+		done = []
+		if self._cycle is None:
+			if not self._pending:
+				return []
+			# Jobs the schedule has left out.
+			done = self._begincycle()
+		started = []
+		self._fill(self._running, started)
+		# Jobs that have been skipped or could not be started.
+		done.extend([job for job in started if job.handle is None])
+		if self._running:
+			try:
+				running = self._pump(self._running)
+			except select.error, e:
+				if e.args[0] != errno.EINTR:
+					raise
+				# Interrupted by a signal, the next step continues.
+				return done
+			for job in self._running:
+				if job.finished is not None:
+					done.append(job)
+			self._running = running
+		if not self._running and self.waiting() is None:
+			self._endcycle()
+		return done
+
+	def stop(self, reason='stopped'):
+		"""
+		Terminate the running jobs for the given reason, wait for them to
+		exit and end the current cycle. Pending jobs are kept. Return the
+		jobs that have been running.
+		"""
+		r = self._running
+		self._running = []
+		try:
+			self._stop(r, reason)
+		finally:
+			if self._cycle is not None:
+				self._endcycle()
+		return r
+
+	def run(self):
+		"""
+		Execute all pending jobs and wait for them to finish.
+		
+		If a schedule is set, it is consulted first; jobs it leaves out are
+		removed from the queue without being run. Return the list of jobs that
+		have been executed, including prunes and retries, in the order they
+		have been started.
+		"""
+		started = []
+		self._begincycle()
+		try:
+			while True:
+				self._fill(self._running, started)
+				if not self._running:
+					wait = self.waiting()
+					if wait is None:
+						break
+					# Only retries are pending, none of them may be started
+					# yet.
+					time.sleep(wait)
+					continue
+				self._running = self._pump(self._running)
+		finally:
+			# Do not leave processes running, destinations locked or SSH
+			# masters open if the listener raised or the queue has been
+			# interrupted.
+			self.stop('queue aborted')
+		return started
+
+
+
+class Config(object):
+	"""
+	A fleet of hosts described in a declarative file: filter sets, BackupRun
+	templates based on each other, SDGenerators and groups of hosts backed up
+	using a template and a generator.
+	
+	A file whose name ends in '.json' contains a JSON object with the members
+	"filters", "templates", "generators" and "groups", each mapping names to
+	definitions. Any other file is read as INI, each definition being a
+	section named after its kind and name, for example [template unix].
+	
+	A filter set is a list of filters, each being the name of an rdiff-backup
+	filter option without dashes, followed by its value, if any, for example
+	"exclude /proc/*". "filters NAME" includes another filter set. In INI
+	files, the list is the value of the "filters" option, one per line.
+	
+	A template may set any of the options of a BackupRun by property name, for
+	example "preservenumericalids". "parent" names the template it is based
+	on, "filters" names the filter sets it adds to those of its parent and
+	"command" is the command to run instead of rdiff-backup.
+	
+	A generator is a PullCompleteHost, set up by "basedir" and optionally
+	"user", "regex" and "subst".
+	
+	A group names its "template" and "generator" and either lists its "hosts"
+	or names the file of an Inventory, relative to the configuration file, as
+	"inventory", optionally with its "format" and "field". In INI files, hosts
+	and filter set names are separated by whitespace.
+	
+	The filter sets and templates are frozen. If cache is set, the compiled
+	settings are stored in that file and reused as long as the configuration
+	file does not change, which skips parsing it and resolving the templates.
+	"""
+
+	_version = 3
+	"""The version of the cache format."""
+
+	_filterclasses = dict((c._param, c) for c in (
+		Exclude, ExcludeDeviceFiles, ExcludeFilelist, ExcludeGlobbingFilelist,
+		ExcludeOtherFilesystems, ExcludeRegexp, ExcludeSpecialFiles,
+		ExcludeSockets, ExcludeSymbolicLinks, Include, IncludeFilelist,
+		IncludeGlobbingFilelist, IncludeRegexp, IncludeSpecialFiles,
+		IncludeSymbolicLinks, MaxFileSize, MinFileSize))
+	"""Map filter option names to Filter classes."""
+
+	def __init__(self, path, cache=None):
+		"""
+		Load the configuration file at path. You may supply the path of the
+		cache file as a convenience.
+		
+		Raise ConfigError if the file is malformed or refers to undefined
+		names.
+		"""
+		self.path = path
+		self.cache = cache
+		self.filters = {}
+		self.templates = {}
+		self.generators = {}
+		self.groups = {}
+		self.cached = False
+		compiled = self._load()
+		if compiled is None:
+			f = open(path, 'rb')
+			try:
+				# Stat before reading: if the file changes meanwhile, the cache
+				# is out of date on the next load instead of stale for good.
+				st = os.fstat(f.fileno())
+				content = f.read()
+			finally:
+				f.close()
+			compiled = self._compile(self._parse(content))
+			if cache is not None:
+				self._store(st, hashlib.sha1(content).hexdigest(), compiled)
+		self._build(compiled)
+
+	def _load(self):
+		"""
+		Return the compiled settings stored in the cache, or None if there is
+		no cache or it is out of date.
+		
+		The cache is up to date if modification time and size of the file are
+		the ones stored with it, or if its contents have the stored hash.
+		"""
+		if self.cache is None:
+			return None
+		try:
+			f = open(self.cache, 'rb')
+			try:
+				(key, compiled) = cPickle.load(f)
+			finally:
+				f.close()
+			(version, mtime, size, digest) = key
+		except Exception:
+			# Missing, unreadable or corrupt caches are simply rebuilt. Not all
+			# unpickling errors derive from StandardError.
+			return None
+		if version != self._version:
+			return None
+		st = os.stat(self.path)
+		if (st.st_mtime, st.st_size) != (mtime, size):
+			f = open(self.path, 'rb')
+			try:
+				if hashlib.sha1(f.read()).hexdigest() != digest:
+					return None
+			finally:
+				f.close()
+			# Only the modification time has changed.
+			self._store(st, digest, compiled)
+		self.cached = True
+		return compiled
+
+	def _store(self, st, digest, compiled):
+		"""Write the compiled settings to the cache."""
+		key = (self._version, st.st_mtime, st.st_size, digest)
+		# Write to a temporary file first so that concurrent runs never read a
+		# partially written cache.
+		tmp = '%s.%d.tmp' % (self.cache, os.getpid())
+		f = open(tmp, 'wb')
+		try:
+			cPickle.dump((key, compiled), f, cPickle.HIGHEST_PROTOCOL)
+		finally:
+			f.close()
+		os.rename(tmp, self.cache)
+
+	def _plain(self, value):
+		"""
+		Return value with all unicode strings in it, as returned by the JSON
+		parser, converted to str.
+		"""
+		if isinstance(value, unicode):
+			return value.encode('utf-8')
+		if isinstance(value, dict):
+			r = {}
+			for (k, v) in value.iteritems():
+				r[self._plain(k)] = self._plain(v)
+			return r
+		if isinstance(value, list):
+			return [self._plain(v) for v in value]
+		return value
+
+	def _parse(self, content):
+		"""
+		Parse the contents of the file and return a dict mapping the kinds of
+		definitions to dicts mapping names to definitions.
+		"""
+		if self.path.endswith('.json'):
+			try:
+				data = self._plain(json.loads(content))
+			except ValueError, e:
+				raise ConfigError('%s: %s' % (self.path, e))
+			if not isinstance(data, dict):
+				raise ConfigError('%s: not a JSON object' % self.path)
+		else:
+			parser = ConfigParser.RawConfigParser()
+			try:
+				parser.readfp(StringIO.StringIO(content), self.path)
+			except ConfigParser.Error, e:
+				raise ConfigError(str(e))
+			kinds = {'filters': 'filters', 'template': 'templates',
+			         'generator': 'generators', 'group': 'groups'}
+			data = {}
+			for section in parser.sections():
+				parts = section.split(None, 1)
+				if len(parts) != 2 or parts[0] not in kinds:
+					raise ConfigError('%s: unknown section [%s]'
+					                  % (self.path, section))
+				items = dict(parser.items(section))
+				if parts[0] == 'filters':
+					items = [l for l in items.get('filters', '').splitlines()
+					         if l.strip()]
+				data.setdefault(kinds[parts[0]], {})[parts[1]] = items
+		for (kind, definitions) in data.iteritems():
+			if kind not in ('filters', 'templates', 'generators', 'groups'):
+				raise ConfigError('%s: unknown member %r' % (self.path, kind))
+			if not isinstance(definitions, dict):
+				raise ConfigError('%s: %s has to map names to definitions'
+				                  % (self.path, kind))
+			for (name, definition) in definitions.iteritems():
+				if not isinstance(definition, (kind == 'filters' and list or
+				                               dict)):
+					raise ConfigError('%s: malformed definition of %r in %s'
+					                  % (self.path, name, kind))
+		return data
+
+	def _names(self, value):
+		"""Return a list of names given as a list or a string."""
+		if isinstance(value, basestring):
+			return value.split()
+		return list(value)
+
+	def _value(self, where, name, value):
+		"""
+		Convert a setting of a template, given as a string in INI files, to
+		the type of the BackupRun option.
+		"""
+		if name not in BackupRun._defaultoptions:
+			raise ConfigError('%s: unknown setting %r in %s'
+			                  % (self.path, name, where))
+		type_ = BackupRun._defaultoptions[name].type
+		if not isinstance(value, str) or type_ is str:
+			return value
+		if type_ is int:
+			try:
+				return int(value)
+			except ValueError:
+				raise ConfigError('%s: %s of %s has to be an int'
+				                  % (self.path, name, where))
+		v = value.strip().lower()
+		if v in ('1', 'yes', 'true', 'on'):
+			return True
+		if v in ('0', 'no', 'false', 'off'):
+			return False
+		if type_ is Ternary and v in ('', 'none'):
+			return None
+		raise ConfigError('%s: %s of %s has to be a boolean'
+		                  % (self.path, name, where))
+
+	def _filterset(self, name, definitions, sets, building):
+		"""
+		Return the FilterSet defined as name, creating it and the sets it
+		includes if necessary.
+		"""
+		if name in sets:
+			return sets[name]
+		if name not in definitions:
+			raise ConfigError('%s: undefined filter set %r' % (self.path, name))
+		if name in building:
+			raise ConfigError('%s: filter set %r includes itself'
+			                  % (self.path, name))
+		building[name] = True
+		r = FilterSet()
+		for line in definitions[name]:
+			parts = line.split(None, 1)
+			if parts and parts[0] == 'filters' and len(parts) == 2:
+				r.extend(self._filterset(parts[1].strip(), definitions, sets,
+				                         building))
+				continue
+			c = parts and self._filterclasses.get(parts[0])
+			if not c:
+				raise ConfigError('%s: unknown filter %r in filter set %r'
+				                  % (self.path, line, name))
+			if issubclass(c, FlagFilter):
+				if len(parts) != 1:
+					raise ConfigError('%s: %s in filter set %r takes no value'
+					                  % (self.path, parts[0], name))
+				r.extend(c())
+			elif len(parts) != 2:
+				raise ConfigError('%s: %s in filter set %r needs a value'
+				                  % (self.path, parts[0], name))
+			elif issubclass(c, IntFilter):
+				try:
+					r.extend(c(int(parts[1])))
+				except ValueError:
+					raise ConfigError('%s: %s in filter set %r needs an int'
+					                  % (self.path, parts[0], name))
+			else:
+				r.extend(c(parts[1]))
+		del building[name]
+		sets[name] = r
+		return r
+
+	def _template(self, name, data, sets, templates, building):
+		"""
+		Return the BackupRun defined as name, creating it and its parents if
+		necessary.
+		"""
+		if name in templates:
+			return templates[name]
+		definitions = data.get('templates', {})
+		if name not in definitions:
+			raise ConfigError('%s: undefined template %r' % (self.path, name))
+		if name in building:
+			raise ConfigError('%s: template %r is based on itself'
+			                  % (self.path, name))
+		building[name] = True
+		definition = definitions[name]
+		parent = None
+		if definition.get('parent') is not None:
+			parent = self._template(definition['parent'], data, sets,
+			                        templates, building)
+		r = BackupRun(parent)
+		for (setting, value) in definition.iteritems():
+			if setting == 'parent':
+				continue
+			if setting == 'command':
+				try:
+					r.command = self._names(value)
+				except TypeError:
+					raise ConfigError('%s: invalid command in template %r'
+					                  % (self.path, name))
+				continue
+			if setting == 'filters':
+				for n in self._names(value):
+					r.filters.extend(self._filterset(n, data.get('filters', {}),
+					                                 sets, {}))
+				continue
+			where = 'template %r' % name
+			try:
+				setattr(r, setting, self._value(where, setting, value))
+			except TypeError:
+				raise ConfigError('%s: invalid %s in %s'
+				                  % (self.path, setting, where))
+		del building[name]
+		templates[name] = r
+		return r
+
+	def _setnames(self, name, definitions):
+		"""
+		Return the names of the filter sets a template and its parents add, in
+		the order their filters are used.
+		"""
+		definition = definitions[name]
+		r = []
+		if definition.get('parent') is not None:
+			r = self._setnames(definition['parent'], definitions)
+		if 'filters' in definition:
+			r.extend(self._names(definition['filters']))
+		return r
+
+	def _leaves(self, filterset, interned):
+		"""
+		Return the filters of a FilterSet as a list of (option name, value)
+		tuples, the value being None for flag filters. Equal tuples are
+		shared using the interned dict, so that the cache stores them once.
+		"""
+		r = []
+		for f in filterset.leaves():
+			if isinstance(f, FlagFilter):
+				leaf = (f._param, None)
+			else:
+				leaf = (f._param, f.value)
+			r.append(interned.setdefault(leaf, leaf))
+		return r
+
+	def _strings(self, strings):
+		"""Return a tuple of the strings, interned."""
+		return tuple([intern(s) for s in strings])
+
+	def _compile(self, data):
+		"""
+		Resolve the parsed definitions into a dict of plain values that
+		_build() turns into objects.
+		
+		Filter sets are compiled into lists of filters and their parameters,
+		templates into the options in effect, the names of the filter sets
+		they use, their parameters, their precompiled command lines and their
+		commands.
+		"""
+		compiled = {'filters': {}, 'templates': {}, 'generators': {},
+		            'groups': {}}
+		sets = {}
+		interned = {}
+		for name in data.get('filters', {}):
+			s = self._filterset(name, data['filters'], sets, {})
+			compiled['filters'][name] = (self._leaves(s, interned),
+			                             self._strings(s.params))
+		templates = {}
+		for name in data.get('templates', {}):
+			t = self._template(name, data, sets, templates, {}).freeze()
+			options = {}
+			for (propertyname, o) in t._options.iteritems():
+				options[propertyname] = o.value
+			compiled['templates'][name] = (
+				options, tuple(self._setnames(name, data['templates'])),
+				self._strings(t.filters.params), self._strings(t._prefix),
+				t.command)
+		for (name, definition) in data.get('generators', {}).iteritems():
+			if 'basedir' not in definition:
+				raise ConfigError('%s: generator %r has no basedir'
+				                  % (self.path, name))
+			for setting in definition:
+				if setting not in ('basedir', 'user', 'regex', 'subst'):
+					raise ConfigError('%s: unknown setting %r in generator %r'
+					                  % (self.path, setting, name))
+			compiled['generators'][name] = dict(definition)
+		for (name, definition) in data.get('groups', {}).iteritems():
+			for setting in ('template', 'generator'):
+				kind = setting + 's'
+				if definition.get(setting) not in compiled[kind]:
+					raise ConfigError('%s: group %r needs a defined %s'
+					                  % (self.path, name, setting))
+			hosts = inventory = None
+			if 'hosts' in definition:
+				hosts = self._names(definition['hosts'])
+			elif 'inventory' in definition:
+				path = os.path.join(os.path.dirname(self.path),
+				                    definition['inventory'])
+				inventory = (path, definition.get('format'),
+				             definition.get('field', 'host'))
+			else:
+				raise ConfigError('%s: group %r has neither hosts nor an '
+				                  'inventory' % (self.path, name))
+			compiled['groups'][name] = (hosts, inventory,
+			                            definition['generator'],
+			                            definition['template'])
+		return compiled
+
+	def _frozenset(self, leaves, params, shared):
+		"""
+		Return a frozen FilterSet of compiled filters and parameters. Equal
+		filters are shared between sets using the shared dict.
+		"""
+		filters = []
+		for leaf in leaves:
+			f = shared.get(leaf)
+			if f is None:
+				(param, value) = leaf
+				if value is None:
+					f = self._filterclasses[param]()
+				else:
+					f = self._filterclasses[param](value)
+				shared[leaf] = f
+			filters.append(f)
+		r = FilterSet()
+		r._filters = filters
+		r._frozen = params
+		return r
+
+	def _frozenrun(self, options, filters, prefix, command):
+		"""
+		Return a FrozenBackupRun of compiled settings, without creating the
+		BackupRun it would be a snapshot of.
+		"""
+		r = FrozenBackupRun.__new__(FrozenBackupRun)
+		BackupRun.__init__(r)
+		for (propertyname, value) in options.iteritems():
+			default = BackupRun._defaultoptions[propertyname]
+			o = Option(default.name, default.type)
+			o.value = value
+			r._options[propertyname] = o
+		r._command = Defaultable(command)
+		r._filters = filters
+		r._prefix = prefix
+		return r
+
+	def _build(self, compiled):
+		"""
+		Create the objects from the compiled settings.
+		
+		Templates using the same filter sets share a FrozenBackupRun's
+		FilterSet, which reuses the filters of the named sets.
+		"""
+		shared = {}
+		for (name, (leaves, params)) in compiled['filters'].iteritems():
+			self.filters[name] = self._frozenset(leaves, params, shared)
+		sets = {}
+		for (name, template) in compiled['templates'].iteritems():
+			(options, setnames, params, prefix, command) = template
+			filters = sets.get(setnames)
+			if filters is None:
+				if len(setnames) == 1:
+					filters = self.filters[setnames[0]]
+				else:
+					filters = FilterSet()
+					for n in setnames:
+						filters._filters.extend(self.filters[n]._filters)
+					filters._frozen = params
+				sets[setnames] = filters
+			self.templates[name] = self._frozenrun(options, filters, prefix,
+			                                       command)
+		for (name, settings) in compiled['generators'].iteritems():
+			g = PullCompleteHost(settings['basedir'], settings.get('user'))
+			if 'regex' in settings:
+				g.regex = settings['regex']
+			if 'subst' in settings:
+				g.subst = settings['subst']
+			self.generators[name] = g
+		for (name, group) in compiled['groups'].iteritems():
+			(hosts, inventory, generator, template) = group
+			if hosts is None:
+				hosts = Inventory(*inventory)
+			self.groups[name] = (hosts, self.generators[generator],
+			                     self.templates[template])
+
+	def addto(self, queue, names=None):
+		"""
+		Add the hosts of the groups with the given names, or of all groups in
+		order of their names, to a BackupQueue. Return the list of added jobs.
+		"""
+		if names is None:
+			names = sorted(self.groups)
+		r = []
+		for name in names:
+			r.extend(queue.addhosts(*self.groups[name]))
+		return r
+
+
+
+class Daemon(object):
+	"""
+	Backs up the hosts of a Config continuously, starting each host's backup
+	as soon as it is due, instead of being started periodically.
+	
+	The templates and the time of each host's last backup are kept in memory.
+	A host is due when its last successful backup is interval seconds old; a
+	host whose backup failed or has been terminated is retried after retry
+	seconds. The time of the last backup is read from the repository once,
+	when the host first appears in the configuration. Due hosts are added to
+	a BackupQueue, least recently backed up first, and run by its workers.
+	The queue's schedule, if any, orders the hosts due at the same time and
+	is reset whenever the queue has been idle, see BackupQueue.step().
+	
+	serve() runs until SIGTERM or SIGINT is received, which terminates the
+	running backups. SIGHUP reloads the configuration; if it cannot be
+	loaded, the previous one stays in effect.
+	"""
+
+	def _getinterval(self):
+		"""
+		The number of seconds after which a host is backed up again. Defaults
+		to 86400, one day.
+		"""
+		return self._interval
+
+	def _setinterval(self, value):
+		if not isinstance(value, (int, long, float)) or value <= 0:
+			raise TypeError('interval has to be a positive number')
+		self._interval = value
+
+	interval = property(_getinterval, _setinterval)
+
+	def _getretry(self):
+		"""
+		The number of seconds after which a failed backup is retried. Defaults
+		to 3600.
+		"""
+		return self._retry
+
+	def _setretry(self, value):
+		if not isinstance(value, (int, long, float)) or value <= 0:
+			raise TypeError('retry has to be a positive number')
+		self._retry = value
+
+	retry = property(_getretry, _setretry)
+
+	def __init__(self, path, cache=None, interval=86400, retry=3600,
+	             queue=None):
+		"""
+		Create a new daemon for the configuration file at path and load it.
+		You may supply the path of the Config cache, interval, retry and the
+		BackupQueue to run the backups in as a convenience; the default queue
+		has four workers.
+		"""
+		self.path = path
+		self.cache = cache
+		self.interval = interval
+		self.retry = retry
+		if queue is None:
+			queue = BackupQueue()
+		self.queue = queue
+		# Map each host to its (template, source, destination).
+		self._hosts = {}
+		# Map each host to the time of its last successful backup or None.
+		self._last = {}
+		# Map each host whose last backup failed to the time it failed.
+		self._failed = {}
+		# Map the hosts of pending or running jobs to their jobs.
+		self._active = {}
+		self._stopping = False
+		self._reloading = False
+		self._wakeup = None
+		self.load()
+
+	def log(self, message):
+		"""Write a message to stderr."""
+		sys.stderr.write('%s wardrobe: %s\n'
+		                 % (time.strftime('%Y-%m-%d %H:%M:%S'), message))
+
+	def load(self):
+		"""
+		Load the configuration, keeping the state of the hosts it still
+		contains. Raise ConfigError if it cannot be loaded.
+		"""
+		config = Config(self.path, self.cache)
+		hosts = {}
+		for name in sorted(config.groups):
+			(inventory, generator, template) = config.groups[name]
+			for (host, source, destination) in \
+			    generator.generateall(inventory):
+				if host in hosts:
+					raise ConfigError('%s: host %r is in more than one group'
+					                  % (self.path, host))
+				hosts[host] = (template, source, destination)
+		for host in hosts:
+			if host not in self._last:
+				self._last[host] = hosts[host][2].lastbackup
+		for host in self._last.keys():
+			if host not in hosts:
+				del self._last[host]
+				self._failed.pop(host, None)
+		self._hosts = hosts
+
+	def _due(self, host):
+		"""Return the time the host is due, or 0 if it is overdue."""
+		if host in self._failed:
+			return self._failed[host] + self.retry
+		if self._last[host] is None:
+			return 0
+		return self._last[host] + self.interval
+
+	def dispatch(self, now=None):
+		"""
+		Add the hosts that are due now and not queued or running yet to the
+		queue. Return the list of added jobs.
+		"""
+		if now is None:
+			now = time.time()
+		due = []
+		for host in self._hosts:
+			if host not in self._active and self._due(host) <= now:
+				due.append((self._last[host] is not None, self._last[host],
+				            host))
+		due.sort()
+		r = []
+		for (known, last, host) in due:
+			(template, source, destination) = self._hosts[host]
+			job = self.queue.add(template.child(source, destination), host)
+			self._active[host] = job
+			r.append(job)
+		return r
+
+	def _finished(self, job):
+		"""
+		Update the state of the job's host after it has finished. Prunes the
+		queue runs after backups are ignored.
+		"""
+		if self._active.get(job.host) is not job:
+			return
+		if job.retry is not None:
+			self._active[job.host] = job.retry
+			self.log('backup of %s failed: %s, retrying in %.0f seconds'
+			         % (job.host, job.error or 'exit code %s' % job.returncode,
+			            job.retry.notbefore - time.time()))
+			return
+		del self._active[job.host]
+		if job.host not in self._last:
+			# The host has been removed from the configuration meanwhile.
+			return
+		if job.succeeded:
+			self._last[job.host] = job.started
+			self._failed.pop(job.host, None)
+			self.log('backup of %s succeeded after %.0f seconds'
+			         % (job.host, job.elapsed))
+		elif job.terminated is not None:
+			# Like a failure, or the next dispatch() would start it again
+			# right away.
+			self._failed[job.host] = job.finished
+			self.log('backup of %s terminated: %s' % (job.host, job.terminated))
+		elif job.skipped is not None:
+			self._failed[job.host] = time.time()
+			self.log('backup of %s skipped: %s' % (job.host, job.skipped))
+		else:
+			self._failed[job.host] = job.finished
+			reason = job.error or 'exit code %s' % job.returncode
+			self.log('backup of %s failed: %s' % (job.host, reason))
+
+	def _signal(self, signum, frame):
+		"""Handle SIGHUP, SIGTERM and SIGINT."""
+		if signum == signal.SIGHUP:
+			self._reloading = True
+		else:
+			self._stopping = True
+		try:
+			os.write(self._wakeup[1], 'x')
+		except OSError:
+			# The pipe is full, the loop will wake up anyway.
+			pass
+
+	def _sleep(self, timeout):
+		"""
+		Wait up to timeout seconds, or until a signal has been received.
+		"""
+		try:
+			(ready, w, x) = select.select([self._wakeup[0]], [], [],
+			                              max(timeout, 0))
+		except select.error, e:
+			if e.args[0] != errno.EINTR:
+				raise
+			return
+		if ready:
+			os.read(self._wakeup[0], 4096)
+
+	def _step(self):
+		"""
+		Let the queue start jobs on free workers and wait for the running ones
+		up to a second, or wait until the next host is due if none are
+		running.
+		"""
+		for job in self.queue.step():
+			self._finished(job)
+		if self.queue.running:
+			return
+		nextdue = None
+		for host in self._hosts:
+			if host not in self._active:
+				due = self._due(host)
+				if nextdue is None or due < nextdue:
+					nextdue = due
+		wait = self.queue.waiting()
+		if wait is not None and \
+		   (nextdue is None or time.time() + wait < nextdue):
+			nextdue = time.time() + wait
+		if nextdue is None:
+			# Nothing to do until the configuration is reloaded.
+			nextdue = time.time() + self.interval
+		self._sleep(nextdue - time.time())
+
+	def serve(self):
+		"""
+		Back up the hosts until SIGTERM or SIGINT is received. Only one
+		daemon may serve per process, from the main thread.
+		"""
+		self._wakeup = os.pipe()
+		for fd in self._wakeup:
+			fcntl.fcntl(fd, fcntl.F_SETFL,
+			            fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		handlers = {}
+		for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+			handlers[signum] = signal.signal(signum, self._signal)
+		self._stopping = False
+		self.log('serving %d hosts' % len(self._hosts))
+		try:
+			while not self._stopping:
+				if self._reloading:
+					self._reloading = False
+					try:
+						self.load()
+						self.log('reloaded, serving %d hosts'
+						         % len(self._hosts))
+					except (ConfigError, CollisionError, EnvironmentError), e:
+						self.log('keeping the configuration: %s' % e)
+				self.dispatch()
+				self._step()
+				self.queue.purge()
+		finally:
+			for job in self.queue.stop('daemon stopped'):
+				self._finished(job)
+			for job in self.queue.cancel('daemon stopped'):
+				if self._active.get(job.host) is job:
+					del self._active[job.host]
+			for (signum, handler) in handlers.iteritems():
+				signal.signal(signum, handler)
+			for fd in self._wakeup:
+				os.close(fd)
+			self._wakeup = None
+			self.log('stopped')
+
+
+
+def _daemon(argv):
+	"""Run the daemon subcommand with the given arguments, see main()."""
+	parser = optparse.OptionParser(usage='%prog daemon [options] CONFIG')
+	parser.add_option('--cache', metavar='PATH',
+	                  help='cache the compiled configuration in PATH')
+	parser.add_option('--interval', type='float', default=86400,
+	                  metavar='SECONDS',
+	                  help='back up each host every SECONDS [%default]')
+	parser.add_option('--retry', type='float', default=3600,
+	                  metavar='SECONDS',
+	                  help='retry failed backups after SECONDS [%default]')
+	parser.add_option('--workers', type='int', default=4, metavar='N',
+	                  help='run at most N backups at once [%default]')
+	parser.add_option('--lock', metavar='DIR',
+	                  help='refuse to run if DIR is locked by another process')
+	(options, args) = parser.parse_args(argv)
+	if len(args) != 1:
+		parser.error('expected exactly one configuration file')
+	if options.lock is not None:
+		try:
+			# The lock is released when the process exits.
+			Locker(True, options.lock)
+		except Locker.AcquireError, e:
+			sys.stderr.write('wardrobe: %s is locked: %s\n' % (options.lock, e))
+			return 1
+	try:
+		daemon = Daemon(args[0], options.cache, options.interval,
+		                options.retry, BackupQueue(options.workers))
+	except (ConfigError, CollisionError, EnvironmentError), e:
+		sys.stderr.write('wardrobe: %s\n' % e)
+		return 1
+	daemon.serve()
+	return 0
+
+
+
+def main(argv=None):
+	"""
+	Run a subcommand given on the command line and return the exit code.
+	
+	"relay PATH HOST SCHEMA" relays a connection, see relay(). "daemon
+	[OPTIONS] CONFIG" backs up the hosts of a configuration file as they are
+	due, see Daemon; run it with --help to list the options. Both can be
+	run as "python -m wardrobe".
+	"""
+	if argv is None:
+		argv = sys.argv[1:]
+	if len(argv) == 4 and argv[0] == 'relay':
+		return relay(*argv[1:])
+	if argv and argv[0] == 'daemon':
+		return _daemon(argv[1:])
+	sys.stderr.write('usage: %s relay PATH HOST SCHEMA\n'
+	                 '       %s daemon [OPTIONS] CONFIG\n'
+	                 % (sys.argv[0], sys.argv[0]))
+	return 2
+
+
+
+if __name__ == '__main__':
+	sys.exit(main())